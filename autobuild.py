@@ -15,88 +15,198 @@ import time
 import string
 import glob
 import builder
-import pickle
-import zipfile
 from builder.git import *
 from builder.utils import *
 
 
-def pull_from_branch():
+def pull_from_branch(ctx):
     """Pulls commits from the repository."""
-    git_pull()
+    git_pull(ctx)
 
 
-def create_build_event():
+def create_build_event(ctx):
     """Creates and tags a new build for with today's number."""
     print('Creating a new build event.')
-    git_pull()
+    git_pull(ctx)
 
-    # Identifier/tag for today's build.
-    todaysBuild = todays_build_tag()
+    # Identifier/tag for the build (today's, unless given with --build).
+    todaysBuild = ctx.build_tag()
 
-    # Tag the source with the build identifier.
-    git_tag(todaysBuild)
+    # Tag the source with the build identifier. The clients have prepared
+    # for the announced commit, even if the branch has moved on since.
+    git_tag(todaysBuild, ctx, ctx.commit or None)
 
     # Prepare the build directory.
-    ev = builder.Event(todaysBuild)
+    ev = builder.Event(todaysBuild, ctx=ctx)
     ev.clean()
 
     # Save the version number and release type.
-    import build_version
-    build_version.find_version(quiet=True)
-    print(build_version.DOOMSDAY_VERSION_FULL, file=open(ev.file_path('version.txt'), 'wt'))
-    print(build_version.DOOMSDAY_RELEASE_TYPE, file=open(ev.file_path('releaseType.txt'), 'wt'))
-
-    update_changes()
+    version, releaseType = git_version(todaysBuild, ctx)
+    print(version, file=open(ev.file_path('version.txt'), 'wt'))
+    print(releaseType, file=open(ev.file_path('releaseType.txt'), 'wt'))
+
+    # Include the new build in the commit lookup index.
+    builder.BuildIndex(ctx=ctx).update()
+
+    update_changes(ctx)
+    return todaysBuild
+
+
+def run_platform_release(srcDir, taskDir, ctx, options='', logName='buildlog',
+                         errorLogName='builderrors'):
+    """Runs platform_release.py for the source in `srcDir`. The packages are
+    written to `taskDir`/releases and the logs to `taskDir`. The incremental
+    build directories and the artifact cache are shared by all builds."""
+    outputDir = os.path.join(taskDir, 'releases')
+    usageLog = os.path.join(taskDir, logName + '-usage.json')
+    if os.path.exists(usageLog): os.remove(usageLog)
+    print('platform_release.py...')
+    run_python3('"%s" "%s" --work "%s" --output "%s" --builds "%s" --artifacts "%s" '
+                '--branch %s --build %s %s > "%s" 2> "%s"' % \
+        (os.path.join(ctx.distribDir, 'platform_release.py'),
+         os.path.join(srcDir, 'doomsday'), os.path.join(taskDir, 'work'),
+         outputDir, os.path.join(ctx.cacheDir, 'builds'),
+         os.path.join(ctx.cacheDir, 'artifacts'), ctx.branch, ctx.build_tag()[5:], options,
+         os.path.join(taskDir, logName + '.txt'), os.path.join(taskDir, errorLogName + '.txt')),
+        cwd=ctx.distribDir, usage=usageLog)
+
+
+def speculative_build(ctx):
+    """Builds the commit given with --commit before it has been tagged.
+                  The packages end up in the artifact cache, where the
+                  actual build finds them if the tag is at the same commit.
+                  The build uses the branch's build worktree, like the
+                  actual build, so both share the incremental build
+                  directories."""
+    if not ctx.commit or not ctx.worktreeDir:
+        print('Speculative builds need a commit and worktrees (--commit, --worktrees).')
+        return
+    import signal
+    # When discarded, clean up before exiting.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+    # The pilot has already fetched the commit.
+    srcDir, taskDir = builder.prepare_task_source(ctx.build_tag() + ctx.tagModifier,
+                                                  'build', ctx.commit, persistent=True, ctx=ctx)
+    outputDir = os.path.join(taskDir, 'releases')
+    try:
+        os.mkdir(outputDir)
+        run_platform_release(srcDir, taskDir, ctx, logName='prebuildlog',
+                             errorLogName='prebuilderrors')
+    finally:
+        # The actual build gets the packages from the artifact cache;
+        # leftovers here would not count as new outputs. The worktree stays
+        # for the next build even if this one is discarded.
+        shutil.rmtree(outputDir, True)
+
+
+def warm_up(ctx):
+    """Prepares for building the commit given with --commit: fetches it,
+                  creates the worktree for today's build with its
+                  submodules, configures the incremental builds and loads
+                  the sources into the disk cache. Without worktrees, only
+                  the fetching and the disk cache are warmed up."""
+    if not ctx.commit:
+        print('The commit to prepare for must be given with --commit.')
+        return
+    import signal
+    # When discarded, remove the scratch worktree before exiting.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+    git_fetch(ctx)
+    if not ctx.worktreeDir:
+        # The build uses the shared checkout, which must not be touched.
+        # Configuring a scratch tree would not help either: the build
+        # directories are reconfigured when the source directory moves.
+        print('Configuring in advance needs worktrees (--worktrees).')
+        if ctx.mirrorDir:
+            # A scratch worktree brings the submodule mirrors up to date.
+            scratchDir = os.path.join(ctx.cacheDir, 'warmup-src')
+            try:
+                builder.worktree_add(scratchDir, ctx.commit, ctx)
+            finally:
+                builder.worktree_remove(scratchDir, ctx)
+        # Most files are the same at the new commit.
+        print('Read %i source files.' % preread_files(ctx.doomsdayDir))
+        return
+    # The build will use the same worktree if it gets tagged at this commit.
+    srcDir, taskDir = builder.prepare_task_source(ctx.build_tag() + ctx.tagModifier,
+                                                  'build', ctx.commit, persistent=True, ctx=ctx)
+    print('Read %i source files.' % preread_files(srcDir))
+    run_platform_release(srcDir, taskDir, ctx, options='--configure-only',
+                         logName='warmuplog', errorLogName='warmuperrors')
 
 
-def todays_platform_release():
+def todays_platform_release(ctx):
     """Build today's release for the current platform."""
     print("Building today's build.")
-    ev = builder.Event()
-
-    git_pull()
-
-    git_checkout(ev.tag() + builder.config.TAG_MODIFIER)
-
-    # We'll copy the new files to the build dir.
-    os.chdir(builder.config.DISTRIB_DIR)
-    oldFiles = DirState('releases', subdirs=False)
-
-    try:
-        print('platform_release.py...')
-        run_python3("platform_release.py > %s 2> %s" % \
-            ('buildlog.txt', 'builderrors.txt'))
-    except Exception as x:
-        print('Error during platform_release:', x)
-
-    for n in DirState('releases', subdirs=False).list_new_files(oldFiles):
-        # Copy any new files.
-        remote_copy(os.path.join('releases', n), ev.file_path(n))
-
-        if builder.config.APT_REPO_DIR:
-            # Copy also to the appropriate apt directory.
-            arch = 'i386'
-            if '_amd64' in n: arch = 'amd64'
-            remote_copy(os.path.join('releases', n),
-                        os.path.join(builder.config.APT_REPO_DIR,
-                                     builder.config.APT_DIST + \
-                                     '/main/binary-%s' % arch, n))
-
-    # Also the build logs.
-    remote_copy('buildlog.txt', ev.file_path('doomsday-out-%s.txt' % sys_id()))
-    remote_copy('builderrors.txt', ev.file_path('doomsday-err-%s.txt' % sys_id()))
-
-    #if 'linux' in sys_id():
-    #    remote_copy('dsfmod/fmod-out-%s.txt' % sys_id(), ev.file_path('fmod-out-%s.txt' % sys_id()))
-    #    remote_copy('dsfmod/fmod-err-%s.txt' % sys_id(), ev.file_path('fmod-err-%s.txt' % sys_id()))
-
-    git_checkout(builder.config.BRANCH)
-
-
-def sign_packages():
+    ev = builder.Event(ctx=ctx)
+
+    git_update(ctx)
+    if builder.speculative.adopt(ev.tag() + ctx.tagModifier, ctx):
+        print('Using the speculative build of the tagged commit.')
+
+    # The branch's build worktree stays in the same place from one build to
+    # the next, so the incremental build directories need no reconfiguring.
+    with builder.task_source(ev.tag() + ctx.tagModifier, 'build', persistent=True,
+                             ctx=ctx) as (srcDir, taskDir):
+        # We'll copy the new files to the build dir.
+        outputDir = os.path.join(taskDir, 'releases')
+        if not os.path.exists(outputDir): os.mkdir(outputDir)
+        oldFiles = DirState(outputDir, subdirs=False)
+        buildLog = os.path.join(taskDir, 'buildlog.txt')
+        errorLog = os.path.join(taskDir, 'builderrors.txt')
+        usageLog = os.path.join(taskDir, 'buildlog-usage.json')
+
+        try:
+            run_platform_release(srcDir, taskDir, ctx)
+        except Exception as x:
+            print('Error during platform_release:', x)
+
+        # All the files are copied in one batch.
+        transfer = builder.Transfer(ctx=ctx)
+        for n in DirState(outputDir, subdirs=False).list_new_files(oldFiles):
+            # Copy any new files.
+            transfer.add(os.path.join(outputDir, n), ev.file_path(n))
+
+            if ctx.aptRepoDir:
+                # Copy also to the appropriate apt directory.
+                arch = 'i386'
+                if '_amd64' in n: arch = 'amd64'
+                transfer.add(os.path.join(outputDir, n),
+                             os.path.join(ctx.aptRepoDir,
+                                          ctx.apt_dist() + \
+                                          '/main/binary-%s' % arch, n))
+
+        # Also the build logs.
+        transfer.add(buildLog, ev.file_path('doomsday-out-%s.txt' % sys_id()))
+        transfer.add(errorLog, ev.file_path('doomsday-err-%s.txt' % sys_id()))
+        for fn in sorted(glob.glob(os.path.join(taskDir, 'work', 'config*.log'))):
+            # Output of each configuration.
+            transfer.add(fn, ev.file_path('doomsday-out-%s-%s.txt' % \
+                                          (sys_id(), os.path.basename(fn)[:-4])))
+        if os.path.exists(usageLog):
+            transfer.add(usageLog, ev.file_path('usage-%s.json' % sys_id()))
+        for fn in sorted(glob.glob(os.path.join(taskDir, 'work', 'config*-usage.json'))):
+            # Resource usage of each configuration's commands.
+            transfer.add(fn, ev.file_path('usage-%s-%s.json' % \
+                                          (sys_id(), os.path.basename(fn)[:-11])))
+        for fn in sorted(glob.glob(os.path.join(taskDir, 'work', 'config*-timings.json'))):
+            # Compile and link times of each configuration.
+            transfer.add(fn, ev.file_path('timings-%s-%s.json' % \
+                                          (sys_id(), os.path.basename(fn)[:-13])))
+        for fn in sorted(glob.glob(os.path.join(taskDir, 'work', 'config*-reused.json'))):
+            # Packages reused from an identical earlier build.
+            transfer.add(fn, ev.file_path('reused-%s-%s.json' % \
+                                          (sys_id(), os.path.basename(fn)[:-12])))
+        transfer.run()
+
+        #if 'linux' in sys_id():
+        #    remote_copy('dsfmod/fmod-out-%s.txt' % sys_id(), ev.file_path('fmod-out-%s.txt' % sys_id()))
+        #    remote_copy('dsfmod/fmod-err-%s.txt' % sys_id(), ev.file_path('fmod-err-%s.txt' % sys_id()))
+
+
+def sign_packages(ctx):
     """Sign all packages in the latest build."""
-    ev = builder.Event(latestAvailable=True)
+    ev = builder.Event(latestAvailable=True, ctx=ctx)
     print("Signing build %i." % ev.number())
     for fn in os.listdir(ev.path()):
         if fn.endswith('.msi') or fn.endswith('.exe') or fn.endswith('.dmg') or fn.endswith('.deb'):
@@ -104,14 +214,14 @@ def sign_packages():
             os.system("gpg --output %s -ba %s" % (ev.file_path(fn) + '.sig', ev.file_path(fn)))
 
 
-def publish_packages():
+def publish_packages(ctx):
     """Publish all packages to SourceForge."""
-    ev = builder.Event(latestAvailable=True)
+    ev = builder.Event(latestAvailable=True, ctx=ctx)
     print("Publishing build %i." % ev.number())
     system_command('deng_copy_build_to_sourceforge.sh "%s"' % ev.path())
 
 
-def find_previous_tag(toTag, version):
+def find_previous_tag(toTag, version, ctx):
     """Finds the build tag preceding `toTag`.
 
     Arguments:
@@ -123,10 +233,22 @@ def find_previous_tag(toTag, version):
         Build tag ("buildNNNN").
         None, if there is no applicable previous build.
     """
-    builds = builder.events_by_time() # descending by timestamp
-
     print("Finding previous build for %s (version:%s)" % (toTag, version))
 
+    # The build index knows the builds and their versions without having
+    # to scan through every event directory.
+    index = builder.BuildIndex(ctx=ctx)
+    index.update()
+    number = builder.tag_number(toTag)
+    if number in index.builds:
+        prev = index.previous_build(number, version)
+        if prev is None and version is not None:
+            # Nothing suitable found. Fall back to a more lax search.
+            prev = index.previous_build(number)
+        return 'build%i' % prev if prev else None
+
+    builds = builder.events_by_time(ctx) # descending by timestamp
+
     # Disregard builds later than `toTag`.
     while len(builds) and builds[0][1].tag() != toTag:
         del builds[0]
@@ -147,23 +269,21 @@ def find_previous_tag(toTag, version):
                 return ev.tag()
 
     # Nothing suitable found. Fall back to a more lax search.
-    return find_previous_tag(toTag, None)
+    return find_previous_tag(toTag, None, ctx)
 
 
-def update_changes(debChanges=False):
+def update_changes(ctx, debChanges=False):
     """Generates the list of commits for the latest build."""
 
-    git_pull()
-    toTag = todays_build_tag()
-
-    import build_version
+    git_pull(ctx)
+    toTag = ctx.build_tag()
 
     # Look up the relevant version.
-    event = builder.Event(toTag)
+    event = builder.Event(toTag, ctx=ctx)
     refVersion = event.version()
 
     # Let's find the previous event of this version.
-    fromTag = find_previous_tag(toTag, refVersion)
+    fromTag = find_previous_tag(toTag, refVersion, ctx)
 
     if fromTag is None or toTag is None:
         # Range not defined.
@@ -171,14 +291,14 @@ def update_changes(debChanges=False):
 
     print('Changes for range', fromTag, '..', toTag)
 
-    changes = builder.Changes(fromTag, toTag)
+    changes = builder.Changes(fromTag, toTag, ctx)
 
     if debChanges:
         # Only update the Debian changelog.
         changes.generate('deb')
 
         # Also update the doomsday-fmod changelog (just version number).
-        #os.chdir(os.path.join(builder.config.DISTRIB_DIR, 'dsfmod'))
+        #os.chdir(os.path.join(ctx.distribDir, 'dsfmod'))
         #fmodVer = build_version.parse_cmake_for_version('../../doomsday/cmake/Version.cmake')
         #debVer = "%s.%s.%s-%s" % (fmodVer[0], fmodVer[1], fmodVer[2], todays_build_tag())
         #print "Marking new FMOD version:", debVer
@@ -191,201 +311,268 @@ def update_changes(debChanges=False):
         changes.generate('xml')
 
 
-def update_debian_changelog():
+def update_debian_changelog(ctx):
     """Updates the Debian changelog at (distrib)/debian/changelog."""
     # Update debian changelog.
-    update_changes(debChanges=True)
+    update_changes(ctx, debChanges=True)
 
 
-def build_source_package():
+def build_source_package(ctx):
     """Builds the source tarball and a Debian source package."""
-    update_debian_changelog()
-    git_pull()
-    ev = builder.Event(latestAvailable=True)
+    update_debian_changelog(ctx)
+    git_update(ctx)
+    ev = builder.Event(latestAvailable=True, ctx=ctx)
     print("Creating source tarball for build %i." % ev.number())
 
-    # Check distribution.
-    system_command("lsb_release -a | perl -n -e 'm/Codename:\s(.+)/ && print $1' > /tmp/distroname")
-    hostDistro = open('/tmp/distroname', 'rt').read()
+    # The generated changelog is rewritten for each distro and package.
+    changelog = open(os.path.join(ctx.doomsdayDir, 'debian/changelog'), 'rt').read()
+
+    # Resource usage of the packaging commands, for the build report.
+    usage = ev.file_path('usage-source.json')
+    if os.path.exists(usage): os.remove(usage)
+
     # Two of the most recent LTS releases, and the very latest release.
     # - bionic: 18.04 LTS
     # - focal: 20.04 LTS
     # - groovy: latest
     distros = ['bionic', 'focal', 'groovy']
 
-    for distro in distros:
-        for pkgName in ['doomsday', 'doomsday-server']:
-            isServerOnly = pkgName.endswith('-server')
-
-            os.chdir(os.path.join(builder.config.DISTRIB_DIR))
-            remkdir('srcwork')
-            os.chdir('srcwork')
-
-            if ev.release_type() == 'stable':
-                print('Stable packages will be prepared')
-                system_command('deng_package_source.sh stable %i %s' % (ev.number(), ev.version_base()))
-                pkgName += '-stable'
-            else:
-                system_command('deng_package_source.sh unstable %i %s' % (ev.number(), ev.version_base()))
-            for fn in os.listdir('.'):
-                if fn[:9] == 'doomsday-' and fn[-7:] == '.tar.gz' and ev.version_base() in fn:
-                    remote_copy(fn, ev.file_path(fn))
-                    break
-
-            # Create a source Debian package and upload it to Launchpad.
-            pkgVer = '%s.%i+%s' % (ev.version_base(), ev.number(), distro)
-            pkgDir = pkgName + '-%s' % pkgVer
-
-            print("Extracting", fn)
-            system_command('tar xzf %s' % fn)
-            print("Renaming", fn[:-7], 'to', pkgDir + '.orig')
-            os.rename(fn[:-7], pkgDir + '.orig')
-            print("Renamed.")
-
-            origName = pkgName + '_%s' % ev.version_base() + '.orig.tar.gz'
-            print("Symlink to", origName)
-            system_command('ln -s %s %s' % (fn, origName))
-
-            print("Extracting", fn)
-            system_command('tar xzf %s' % fn)
-            print("Renaming", fn[:-7], 'to', pkgDir)
-            os.rename(fn[:-7], pkgDir)
-            print("Renamed.")
-
-            os.chdir(pkgDir)
-            #system_command('echo "" | dh_make --yes -s -c gpl2 --file ../%s' % fn)
-            os.chdir('debian')
-            for fn in os.listdir('.'):
-                if fn[-3:].lower() == '.ex': os.remove(fn)
-            #os.remove('README.Debian')
-            #os.remove('README.source')
-
-            def gen_changelog(src, dst, extraSub=''):
-                system_command("sed 's/%s-build%i/%s/;%s' %s > %s" % (
-                        ev.version_base(), ev.number(), pkgVer, extraSub, src, dst))
-
-            # Figure out the name of the distribution.
-            dsub = ''
-            if distro != hostDistro:
-                dsub = 's/) %s;/) %s;/' % (hostDistro, distro)
-            if pkgName != 'doomsday':
-                if dsub: dsub += ';'
-                dsub += 's/^doomsday /%s /' % pkgName
-
-            dengDir = builder.config.DOOMSDAY_DIR
-
-            gen_changelog(os.path.join(dengDir, 'debian/changelog'), 'changelog', dsub)
-            control = open(os.path.join(dengDir, 'doomsday/build/debian/control')).read()
-            control = control.replace('${Arch}', 'i386 amd64')
-            control = control.replace('${Package}', pkgName)
-            control = control.replace('${DEBFULLNAME}', os.getenv('DEBFULLNAME'))
-            control = control.replace('${DEBEMAIL}', os.getenv('DEBEMAIL'))
-            extraCMakeOptions = ""
-            if isServerOnly:
-                for guiDep in ['libsdl2-dev', 'libsdl2-mixer-dev',
-                               'libxrandr-dev', 'libxxf86vm-dev',
-                               'libqt5opengl5-dev', 'libqt5x11extras5-dev',
-                               'libfluidsynth-dev']:
-                    control = control.replace(guiDep + ', ', '')
-                control = control.replace('port with enhanced graphics',
-                                          'port with enhanced graphics (server only)')
-                extraCMakeOptions = 's/COTIRE=OFF/COTIRE=OFF -DDENG_ENABLE_GUI=OFF/'
-            open('control', 'w').write(control)
-            system_command("sed 's/${BuildNumber}/%i/;s/..\/..\/doomsday/..\/doomsday/;"
-                        "s/APPNAME := doomsday/APPNAME := %s/;%s' "
-                        "%s/doomsday/build/debian/rules > rules" %
-                        (ev.number(), pkgName, extraCMakeOptions, dengDir))
-            os.chdir('..')
-            system_command('debuild -S')
-            os.chdir('..')
-            system_command('dput ppa:sjke/doomsday %s_%s_source.changes' % (pkgName, pkgVer))
-
-
-def rebuild_apt_repository():
+    # The branch may have moved on since the build was tagged.
+    with builder.task_source(ev.tag() + ctx.tagModifier, 'source', ctx=ctx) as (srcDir, taskDir):
+        srcWork = os.path.join(taskDir, 'srcwork')
+
+        for distro in distros:
+            for pkgName in ['doomsday', 'doomsday-server']:
+                isServerOnly = pkgName.endswith('-server')
+
+                remkdir(srcWork)
+
+                if ev.release_type() == 'stable':
+                    print('Stable packages will be prepared')
+                    system_command('deng_package_source.sh stable %i %s' % (ev.number(), ev.version_base()),
+                                   cwd=srcWork, usage=usage)
+                    pkgName += '-stable'
+                else:
+                    system_command('deng_package_source.sh unstable %i %s' % (ev.number(), ev.version_base()),
+                                   cwd=srcWork, usage=usage)
+                for fn in os.listdir(srcWork):
+                    if fn[:9] == 'doomsday-' and fn[-7:] == '.tar.gz' and ev.version_base() in fn:
+                        remote_copy(os.path.join(srcWork, fn), ev.file_path(fn))
+                        break
+
+                # Create a source Debian package and upload it to Launchpad.
+                pkgVer = '%s.%i+%s' % (ev.version_base(), ev.number(), distro)
+                pkgDir = pkgName + '-%s' % pkgVer
+
+                print("Extracting", fn)
+                system_command('tar xzf %s' % fn, cwd=srcWork)
+                print("Renaming", fn[:-7], 'to', pkgDir + '.orig')
+                os.rename(os.path.join(srcWork, fn[:-7]), os.path.join(srcWork, pkgDir + '.orig'))
+                print("Renamed.")
+
+                origName = pkgName + '_%s' % ev.version_base() + '.orig.tar.gz'
+                print("Symlink to", origName)
+                system_command('ln -s %s %s' % (fn, origName), cwd=srcWork)
+
+                print("Extracting", fn)
+                system_command('tar xzf %s' % fn, cwd=srcWork)
+                print("Renaming", fn[:-7], 'to', pkgDir)
+                os.rename(os.path.join(srcWork, fn[:-7]), os.path.join(srcWork, pkgDir))
+                print("Renamed.")
+
+                #system_command('echo "" | dh_make --yes -s -c gpl2 --file ../%s' % fn)
+                debDir = os.path.join(srcWork, pkgDir, 'debian')
+                for fn in os.listdir(debDir):
+                    if fn[-3:].lower() == '.ex': os.remove(os.path.join(debDir, fn))
+                #os.remove('README.Debian')
+                #os.remove('README.source')
+
+                dengDir = srcDir
+
+                out = open(os.path.join(debDir, 'changelog'), 'wt')
+                out.write(builder.deb_changelog_variant(changelog, package=pkgName,
+                                                        version=pkgVer, distribution=distro))
+                out.close()
+                control = open(os.path.join(dengDir, 'doomsday/build/debian/control')).read()
+                control = control.replace('${Arch}', 'i386 amd64')
+                control = control.replace('${Package}', pkgName)
+                control = control.replace('${DEBFULLNAME}', os.getenv('DEBFULLNAME'))
+                control = control.replace('${DEBEMAIL}', os.getenv('DEBEMAIL'))
+                extraCMakeOptions = ""
+                if isServerOnly:
+                    for guiDep in ['libsdl2-dev', 'libsdl2-mixer-dev',
+                                   'libxrandr-dev', 'libxxf86vm-dev',
+                                   'libqt5opengl5-dev', 'libqt5x11extras5-dev',
+                                   'libfluidsynth-dev']:
+                        control = control.replace(guiDep + ', ', '')
+                    control = control.replace('port with enhanced graphics',
+                                              'port with enhanced graphics (server only)')
+                    extraCMakeOptions = 's/COTIRE=OFF/COTIRE=OFF -DDENG_ENABLE_GUI=OFF/'
+                open(os.path.join(debDir, 'control'), 'w').write(control)
+                system_command("sed 's/${BuildNumber}/%i/;s/..\/..\/doomsday/..\/doomsday/;"
+                            "s/APPNAME := doomsday/APPNAME := %s/;%s' "
+                            "%s/doomsday/build/debian/rules > rules" %
+                            (ev.number(), pkgName, extraCMakeOptions, dengDir), cwd=debDir)
+                system_command('debuild -S', cwd=os.path.join(srcWork, pkgDir), usage=usage)
+                system_command('dput ppa:sjke/doomsday %s_%s_source.changes' % (pkgName, pkgVer),
+                               cwd=srcWork, usage=usage)
+
+
+def rebuild_apt_repository(ctx):
     """Rebuilds the Apt repository by running apt-ftparchive."""
-    aptDir = builder.config.APT_REPO_DIR
+    aptDir = ctx.aptRepoDir
+    aptDist = ctx.apt_dist()
     print('Rebuilding the apt repository in %s...' % aptDir)
 
-    os.system("apt-ftparchive generate ~/Dropbox/APT/ftparchive.conf")
-    os.system("apt-ftparchive -c %s release %s/%s > %s/%s/Release" % (builder.config.APT_CONF_FILE, aptDir, builder.config.APT_DIST, aptDir, builder.config.APT_DIST))
-    os.chdir("%s/%s" % (aptDir, builder.config.APT_DIST))
+    # The refresh publishes the latest build, so its report shows the
+    # resource usage.
+    try:
+        usage = builder.Event(latestAvailable=True, ctx=ctx).file_path('usage-apt.json')
+        if os.path.exists(usage): os.remove(usage)
+    except Exception:
+        # No builds yet.
+        usage = None
+
+    def call(cmd, cwd=None):
+        # Errors are ignored.
+        if usage:
+            builder.resources.run_sampled(cmd, usage, cwd=cwd)
+        else:
+            subprocess.call(cmd, shell=True, cwd=cwd)
+
+    call("apt-ftparchive generate ~/Dropbox/APT/ftparchive.conf")
+    call("apt-ftparchive -c %s release %s/%s > %s/%s/Release" % (ctx.apt_conf_file(), aptDir, aptDist, aptDir, aptDist))
+    distDir = os.path.join(aptDir, aptDist)
     try:
-        os.remove("Release.gpg")
+        os.remove(os.path.join(distDir, "Release.gpg"))
     except OSError:
         # Never mind.
         pass
-    os.system("gpg --output Release.gpg -ba Release")
-    os.system("~/Scripts/mirror-tree.py %s %s" % (aptDir, os.path.join(builder.config.EVENT_DIR, 'apt')))
+    call("gpg --output Release.gpg -ba Release", cwd=distDir)
+    # The packages in the mirror are links to the same files.
+    builder.store.link_tree(aptDir, os.path.join(ctx.eventDir, 'apt'))
 
 
-def purge_obsolete():
+def purge_obsolete(ctx):
     """Purge old builds from the event directory (old > 3 weeks)."""
     threshold = 3600 * 24 * 7 * 3
 
     # We'll keep a small number of events unpurgable.
-    totalCount = len(builder.find_old_events(0))
+    totalCount = len(builder.find_old_events(0, ctx))
 
     # Purge the old events.
     print('Deleting build events older than 3 weeks...')
-    for ev in builder.find_old_events(threshold):
+    for ev in builder.find_old_events(threshold, ctx):
         if totalCount > 5:
             print(ev.tag())
             shutil.rmtree(ev.path())
             totalCount -= 1
 
-    print('Purge done.')
+    # Packages of the deleted builds are still in the content store.
+    freed = builder.ContentStore(ctx).prune()
+    print('Purge done (%.1f MB freed from the content store).' % (freed / 1e6))
 
 
-def dir_cleanup():
+def dir_cleanup(ctx):
     """Purges empty build directories from the event directory."""
     print('Event directory cleanup starting...')
-    for emptyEventPath in builder.find_empty_events():
+    for emptyEventPath in builder.find_empty_events(ctx=ctx):
         print('Deleting', emptyEventPath)
         os.rmdir(emptyEventPath)
+    builder.worktree_prune(ctx)
     print('Cleanup done.')
 
 
-def system_command(cmd):
-    result = subprocess.call(cmd, shell=True)
-    if result != 0:
-        raise Exception("Error from " + cmd)
-
-
-def generate_apidoc():
+def generate_apidoc(ctx):
     """Run Doxygen to generate all API documentation."""
-    git_pull()
-
-    print("\nSDK docs...", file=sys.stderr)
-    os.chdir(os.path.join(builder.config.DOOMSDAY_DIR, 'doomsday'))
-    system_command('doxygen sdk.doxy >/dev/null 2>doxyissues-sdk.txt')
-    system_command('wc -l doxyissues-sdk.txt')
-
-    print("\nSDK docs for Qt Creator...", file=sys.stderr)
-    os.chdir(os.path.join(builder.config.DOOMSDAY_DIR, 'doomsday'))
-    system_command('doxygen sdk-qch.doxy >/dev/null 2>doxyissues-qch.txt')
-    system_command('wc -l doxyissues-qch.txt')
-
-    print("\nPublic API docs...", file=sys.stderr)
-    os.chdir(os.path.join(builder.config.DOOMSDAY_DIR, 'doomsday/apps/libdoomsday'))
-    system_command('doxygen api.doxy >/dev/null 2>../../doxyissues-api.txt')
-    system_command('wc -l ../../doxyissues-api.txt')
-
-
-def generate_wiki():
+    git_update(ctx)
+    ev = builder.Event(latestAvailable=True, ctx=ctx)
+    print("Generating API documentation for build %i." % ev.number())
+
+    # Resource usage of Doxygen, for the build report.
+    usage = ev.file_path('usage-apidoc.json')
+    if os.path.exists(usage): os.remove(usage)
+
+    # The generated documentation stays in the source tree.
+    with builder.task_source(ev.tag() + ctx.tagModifier, 'apidoc', persistent=True,
+                             ctx=ctx) as (srcDir, taskDir):
+        print("\nSDK docs...", file=sys.stderr)
+        docDir = os.path.join(srcDir, 'doomsday')
+        system_command('doxygen sdk.doxy >/dev/null 2>doxyissues-sdk.txt', cwd=docDir, usage=usage)
+        system_command('wc -l doxyissues-sdk.txt', cwd=docDir)
+
+        print("\nSDK docs for Qt Creator...", file=sys.stderr)
+        system_command('doxygen sdk-qch.doxy >/dev/null 2>doxyissues-qch.txt', cwd=docDir,
+                       usage=usage)
+        system_command('wc -l doxyissues-qch.txt', cwd=docDir)
+
+        print("\nPublic API docs...", file=sys.stderr)
+        apiDir = os.path.join(srcDir, 'doomsday/apps/libdoomsday')
+        system_command('doxygen api.doxy >/dev/null 2>../../doxyissues-api.txt', cwd=apiDir,
+                       usage=usage)
+        system_command('wc -l ../../doxyissues-api.txt', cwd=apiDir)
+
+
+def generate_wiki(ctx):
     """Automatically generate wiki pages."""
-    git_pull()
+    git_pull(ctx)
     sys.path += ['/Users/jaakko/Scripts']
     import dew
     dew.login()
     # Today's event data.
-    ev = builder.Event(latestAvailable=True)
+    ev = builder.Event(latestAvailable=True, ctx=ctx)
     if ev.release_type() == 'stable':
         dew.submitPage('Latest Doomsday release',
             '#REDIRECT [[Doomsday version %s]]' % ev.version())
     dew.logout()
 
 
-def show_help():
+def lookup_builds(ctx):
+    """Look up builds: (commit) shows the first build containing it;
+                  (buildN) lists its commits; (buildA) (buildB) lists
+                  the commits between two builds."""
+    args = ctx.args
+    if not args or len(args) > 2 or \
+            (len(args) == 2 and None in map(builder.tag_number, args)):
+        print('Usage: lookup (commit|buildNNNN) [buildNNNN]')
+        return None
+    index = builder.BuildIndex(ctx=ctx)
+    index.update()
+    if len(args) == 2:
+        commits = index.commits_between(builder.tag_number(args[0]),
+                                        builder.tag_number(args[1]))
+    elif builder.tag_number(args[0]) is not None:
+        commits = index.build_commits(builder.tag_number(args[0]))
+    else:
+        num = index.first_build(args[0])
+        if num is None:
+            print('%s is not in any build' % args[0])
+            return None
+        print('build%i' % num)
+        return 'build%i' % num
+    for commit in commits:
+        print(commit)
+    return commits
+
+
+def tune_build_settings(ctx):
+    """Benchmarks build settings (generator, unity builds, precompiled
+                  headers, link pool) for the branch's configurations
+                  and writes the best ones to cmake.<branch>.rsp.suggested
+                  in the cache directory. Optionally limited to the given
+                  settings."""
+    dimensions = ctx.args or builder.tune.DIMENSIONS
+    for dim in dimensions:
+        if dim not in builder.tune.DIMENSIONS:
+            raise Exception("Unknown setting: %s (choose from %s)" % \
+                            (dim, ', '.join(builder.tune.DIMENSIONS)))
+    git_update(ctx)
+    with builder.task_source(ctx.branch, 'tune', ctx=ctx) as (srcDir, taskDir):
+        return builder.tune.tune(os.path.join(srcDir, 'doomsday'),
+                                 os.path.join(taskDir, 'tune'), dimensions, ctx=ctx)
+
+
+def show_help(ctx):
     """Prints a description of each command."""
     for cmd in sorted_commands():
         if commands[cmd].__doc__:
@@ -400,10 +587,60 @@ def sorted_commands():
     return sc
 
 
+def command_line(name, ctx):
+    """Composes the autobuild.py command line for running a command in a
+    separate process with the settings of `ctx`."""
+    cmdLine = '"%s" %s' % (os.path.join(ctx.distribDir, 'autobuild.py'), name)
+    cmdLine += ' ' + ' '.join(ctx.args)
+    cmdLine += ' --distrib "%s" --doomsday "%s" --events "%s" --cache "%s"' % \
+        (ctx.distribDir, ctx.doomsdayDir, ctx.eventDir, ctx.cacheDir)
+    if ctx.aptRepoDir: cmdLine += ' --apt "%s"' % ctx.aptRepoDir
+    if ctx.worktreeDir: cmdLine += ' --worktrees "%s"' % ctx.worktreeDir
+    if ctx.mirrorDir: cmdLine += ' --mirrors "%s"' % ctx.mirrorDir
+    if ctx.tagModifier: cmdLine += ' --tagmod %s' % ctx.tagModifier
+    if ctx.commit: cmdLine += ' --commit %s' % ctx.commit
+    if ctx.build: cmdLine += ' --build %s' % ctx.build
+    cmdLine += ' --branch %s' % ctx.branch
+    return cmdLine
+
+
+def run_command(name, ctx=None, isolated=False, **options):
+    """Carries out an autobuild command in the calling process.
+
+    Arguments:
+        name:     Command name (see `commands`).
+        ctx:      Context for the command. If omitted, one is created from
+                  `options`, which are the keyword arguments of
+                  builder.config.Context (distribDir, eventDir, branch, ...).
+        isolated: Run the command in a separate Python interpreter instead.
+                  The command's return value is not available then.
+    Returns:
+        Dict with 'command', 'result' ('ok'), 'value' (return value of the
+        command) and 'duration' (seconds). Raises an exception if the
+        command fails.
+    """
+    if name not in commands:
+        raise Exception("Unknown command: " + name)
+    if ctx is None:
+        ctx = builder.config.Context(**options)
+    startedAt = time.time()
+    if isolated:
+        run_python3(command_line(name, ctx))
+        value = None
+    else:
+        value = commands[name](ctx)
+    return {'command': name,
+            'result': 'ok',
+            'value': value,
+            'duration': time.time() - startedAt}
+
+
 commands = {
     'pull': pull_from_branch,
     'create': create_build_event,
     'platform_release': todays_platform_release,
+    'prebuild': speculative_build,
+    'warmup': warm_up,
     'sign': sign_packages,
     'publish': publish_packages,
     'changes': update_changes,
@@ -412,6 +649,8 @@ commands = {
     'apt': rebuild_apt_repository,
     'purge': purge_obsolete,
     'cleanup': dir_cleanup,
+    'lookup': lookup_builds,
+    'tune': tune_build_settings,
     'apidoc': generate_apidoc,
     'wiki': generate_wiki,
     'help': show_help
@@ -420,7 +659,7 @@ commands = {
 if __name__ == '__main__':
     if len(sys.argv) < 2:
         print('The arguments must be: (command) [args]')
-        print('Commands:', string.join(sorted_commands()))
+        print('Commands:', ' '.join(sorted_commands()))
         print('Arguments:')
         print('--branch    Branch to use (default: master)')
         print('--distrib   "deng-distrib" directory')
@@ -428,10 +667,15 @@ if __name__ == '__main__':
         print('--events    Event directory (builds are stored here in subdirs)')
         print('--apt       Apt repository')
         print('--tagmod    Additional suffix for build tag for platform_release')
+        print('--cache     Directory for persistent caches (default: distrib/cache)')
+        print('--worktrees Directory for per-task git worktrees (default: shared checkout)')
+        print('--mirrors   Directory for local mirrors of the upstream repositories')
+        print('--commit    Commit that the command is about')
+        print('--build     Number of the build (default: today\'s build)')
         sys.exit(1)
 
     if sys.argv[1] not in commands:
         print('Unknown command:', sys.argv[1])
         sys.exit(1)
 
-    commands[sys.argv[1]]()
+    commands[sys.argv[1]](builder.config.context())
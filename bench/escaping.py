@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# Micro-benchmark of the changelog escapers (builder/changes.py) against the
+# earlier implementations, which replaced one character at a time.
+# Usage: bench/escaping.py [kilobytes of text]
+
+import os
+import sys
+import random
+import string
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from builder.changes import encodedText, xmlEncodedText
+
+
+def old_encodedText(logText):
+    logText = logText.replace('&', '&amp;')
+    logText = logText.replace('ä', '&auml;')
+    logText = logText.replace('ö', '&ouml;')
+    logText = logText.replace('Ä', '&Auml;')
+    logText = logText.replace('Ö', '&Ouml;')
+    logText = logText.replace('<', '&lt;')
+    logText = logText.replace('>', '&gt;')
+    logText = "".join([c for c in logText if c in string.whitespace or c > ' '])
+    return logText
+
+
+def old_xmlEncodedText(logText):
+    result = ''
+    for c in logText:
+        if c == '<':
+            result += '<![CDATA[<]]>'
+        elif c == '>':
+            result += '<![CDATA[>]]>'
+        elif c in str(string.whitespace) or c > ' ':
+            result += c
+    return result
+
+
+def commit_text(size):
+    """Ordinary commit message text with an occasional special character."""
+    words = ['Fixed', 'the', 'renderer', 'crash', 'when', 'loading', 'maps', 'with',
+             'a', 'missing', 'texture', 'Refactor', 'libcore', 'Client|UI', 'Äänet',
+             'x < y', 'a & b', '<b>', '\t', '\n']
+    rnd = random.Random(1)
+    parts = []
+    length = 0
+    while length < size:
+        word = rnd.choice(words)
+        parts.append(word)
+        length += len(word) + 1
+    return ' '.join(parts)
+
+
+def main():
+    size = int(sys.argv[1]) * 1024 if len(sys.argv) > 1 else 48 * 1024
+    text = commit_text(size)
+    special = ''.join(chr(c) for c in range(0, 128)) + 'äöÄÖ'
+    for new, old in [(encodedText, old_encodedText), (xmlEncodedText, old_xmlEncodedText)]:
+        if new(text) != old(text) or new(special) != old(special):
+            raise Exception("%s output differs from the old implementation" % new.__name__)
+    print('Escaping %.0f KB of commit text (best of 5):' % (len(text) / 1024))
+    for name, new, old in [('encodedText', encodedText, old_encodedText),
+                           ('xmlEncodedText', xmlEncodedText, old_xmlEncodedText)]:
+        times = []
+        for func in [old, new]:
+            times.append(min(timeit.repeat(lambda: func(text), number=10, repeat=5)) / 10)
+        print('  %-15s %7.2f ms -> %6.2f ms' % (name, times[0] * 1e3, times[1] * 1e3))
+
+
+if __name__ == '__main__':
+    main()
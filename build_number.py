@@ -1,12 +1,28 @@
 #!/usr/bin/env python3
 # Determining the number of a build.
 
+import os
 import time
 import sys
 
 def todays_build():
     now = time.localtime()
     return str((now.tm_year - 2011)*365 + now.tm_yday)
-    
+
+
+def next_build(lastBuild=0):
+    """Allocates the number for a new build: today's number, unless a build
+    with that number (or a later one) already exists."""
+    return str(max(int(todays_build()), int(lastBuild) + 1))
+
+
+def current_build():
+    """Number of the build being made: given with --build or in the
+    DOOMSDAY_BUILD environment variable, or today's number."""
+    if '--build' in sys.argv:
+        return sys.argv[sys.argv.index('--build') + 1]
+    return os.getenv('DOOMSDAY_BUILD') or todays_build()
+
+
 if '--print' in sys.argv:
-    print(todays_build())
+    print(current_build())
@@ -13,15 +13,14 @@ DOOMSDAY_VERSION_MINOR = 0
 DOOMSDAY_VERSION_REVISION = 0
 DOOMSDAY_RELEASE_TYPE = "Unstable"
 
-def parse_cmake_for_version(cmakeFile):
+def parse_cmake_text_for_version(text):
     versionMajor = 0
     versionMinor = 0
     versionRevision = 0
     versionName = ""
     releaseType = ""
 
-    f = open(cmakeFile, 'rt')
-    for line in f.readlines():
+    for line in text.splitlines(True):
         if line[:3] == "set":
             major = re.search(r'_VERSION_MAJOR.*([0-9]+)', line)
             if major:
@@ -43,6 +42,9 @@ def parse_cmake_for_version(cmakeFile):
 
     return (versionMajor, versionMinor, versionRevision, versionName, releaseType)
 
+def parse_cmake_for_version(cmakeFile):
+    return parse_cmake_text_for_version(open(cmakeFile, 'rt').read())
+
 def find_version(doomsdayDir = DOOMSDAY_DIR, quiet = False):
     if not quiet: print("Determining Doomsday version...", end=' ')
 
@@ -74,7 +76,7 @@ def find_version(doomsdayDir = DOOMSDAY_DIR, quiet = False):
 def version_summary(cmakeName):
     import sys
     import build_number
-    buildNum = build_number.todays_build()
+    buildNum = build_number.current_build()
 
     # Get the Doomsday version. We can use some of this information.
     find_version(True)
@@ -1,6 +1,44 @@
 # This is a Python module containing the builder sources.
+#
+# The submodules are imported on first use: the pilot runs from cron every
+# minute and most runs only need a couple of them.
 from . import config
-from .event import *
-from .changes import *
-#import git
-#import utils
+
+_EXPORTS = {
+    'event':      ['log_filename', 'Event', 'find_newest_event', 'find_old_events',
+                   'find_empty_events', 'events_by_time'],
+    'changes':    ['encodedText', 'xmlEncodedText', 'Output', 'DEB_CHANGELOG_HEADER',
+                   'deb_changelog_entry', 'deb_changelog_variant', 'Entry', 'Changes'],
+    'buildindex': ['INDEX_VERSION', 'index_path', 'tag_number', 'BuildIndex'],
+    'store':      ['ContentStore'],
+    'transfer':   ['Transfer'],
+    'worktree':   ['run_git_in', 'task_dir_path', 'worktree_add', 'worktree_checkout',
+                   'worktree_remove', 'worktree_prune', 'prepare_task_source', 'task_source']
+}
+
+_SUBMODULES = ['buildindex', 'changes', 'commitcache', 'config', 'event', 'git',
+               'mirror', 'resources', 'speculative', 'store', 'transfer', 'tune',
+               'utils', 'worktree']
+
+_NAME_MODULE = {}
+for _mod in _EXPORTS:
+    for _name in _EXPORTS[_mod]:
+        _NAME_MODULE[_name] = _mod
+
+
+def __getattr__(name):
+    import importlib
+    if name in _SUBMODULES:
+        return importlib.import_module('.' + name, __name__)
+    if name in _NAME_MODULE:
+        value = getattr(importlib.import_module('.' + _NAME_MODULE[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError("module 'builder' has no attribute '%s'" % name)
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_NAME_MODULE) | set(_SUBMODULES))
+
+
+__all__ = sorted(_NAME_MODULE)
@@ -0,0 +1,159 @@
+import os
+import pickle
+import subprocess
+import xml.etree.ElementTree as ElementTree
+from . import config
+
+# Increment when the format of the index changes.
+INDEX_VERSION = 1
+
+
+def index_path(ctx=None):
+    ctx = ctx or config.context()
+    return os.path.join(ctx.cacheDir, 'buildindex-v%i.pickle' % INDEX_VERSION)
+
+
+def tag_number(tag):
+    """Returns the build number of a "buildNNNN" tag, or None."""
+    if tag[:5] != 'build' or not tag[5:].isdigit(): return None
+    return int(tag[5:])
+
+
+class BuildIndex:
+    """Index of which commits were introduced in which builds.
+
+    Each build tag covers the commits reachable from it but not from the
+    preceding build tag. The commit→build mapping thus gives the first build
+    that contained a commit."""
+
+    def __init__(self, path=None, ctx=None):
+        self.ctx = ctx or config.context()
+        self.path = path or index_path(self.ctx)
+        self.builds = {}     # number -> {'from': tag, 'commits': [hash], 'version': str}
+        self.firstBuild = {} # hash -> number
+        self.modified = False
+        if os.path.exists(self.path):
+            try:
+                self.builds, self.firstBuild = pickle.load(open(self.path, 'rb'))
+            except Exception as x:
+                print('Rebuilding unreadable build index %s: %s' % (self.path, x))
+
+    def save(self):
+        if not self.modified: return
+        dirName = os.path.dirname(self.path)
+        if not os.path.exists(dirName): os.makedirs(dirName)
+        tmpName = self.path + '.%i.tmp' % os.getpid()
+        f = open(tmpName, 'wb')
+        pickle.dump((self.builds, self.firstBuild), f, 2)
+        f.close()
+        os.replace(tmpName, self.path)
+        self.modified = False
+
+    def git_build_tags(self):
+        """Returns the build numbers of all build tags in the repository."""
+        try:
+            tags = subprocess.check_output(['git', 'tag', '-l', 'build*'],
+                                           cwd=self.ctx.doomsdayDir).decode('utf-8').split()
+        except (OSError, subprocess.CalledProcessError):
+            return []
+        return [n for n in map(tag_number, tags) if n is not None]
+
+    def event_build_numbers(self):
+        if not os.path.exists(self.ctx.eventDir): return []
+        return [n for n in map(tag_number, os.listdir(self.ctx.eventDir)) if n is not None]
+
+    def event_version(self, number):
+        fn = os.path.join(self.ctx.eventDir, 'build%i' % number, 'version.txt')
+        if os.path.exists(fn): return open(fn).read().strip()
+        return None
+
+    def update(self):
+        """Indexes the builds that have been tagged or created since the
+        previous update. Returns the number of newly indexed builds."""
+        tagged = set(self.git_build_tags())
+        numbers = sorted(tagged | set(self.event_build_numbers()))
+        count = 0
+        prevTag = None
+        for num in numbers:
+            if num not in self.builds:
+                if num in tagged:
+                    commits = self.tag_commits(prevTag, 'build%i' % num)
+                else:
+                    commits = self.changes_commits(num)
+                self.add_build(num, prevTag, commits)
+                count += 1
+            if num in tagged:
+                prevTag = 'build%i' % num
+        # Versions are written after tagging, so fill in any missing ones.
+        for num in self.builds:
+            if self.builds[num]['version'] is None:
+                ver = self.event_version(num)
+                if ver:
+                    self.builds[num]['version'] = ver
+                    self.modified = True
+        self.save()
+        return count
+
+    def tag_commits(self, fromTag, toTag):
+        rng = '%s..%s' % (fromTag, toTag) if fromTag else toTag
+        return subprocess.check_output(['git', 'rev-list', rng],
+                                       cwd=self.ctx.doomsdayDir).decode('utf-8').split()
+
+    def changes_commits(self, number):
+        """Reads the commits of an untagged build from its changes.xml."""
+        fn = os.path.join(self.ctx.eventDir, 'build%i' % number, 'changes.xml')
+        if not os.path.exists(fn): return []
+        root = ElementTree.fromstring('<changes>' + open(fn, 'rt').read() + '</changes>')
+        return [sha.text.strip() for sha in root.iter('sha1') if sha.text]
+
+    def add_build(self, number, fromTag, commits):
+        self.builds[number] = {'from': fromTag,
+                               'commits': commits,
+                               'version': self.event_version(number)}
+        for commit in commits:
+            if commit not in self.firstBuild or self.firstBuild[commit] > number:
+                self.firstBuild[commit] = number
+        self.modified = True
+
+    def resolve(self, commit):
+        """Finds the full hash for a possibly abbreviated commit hash."""
+        if commit in self.firstBuild: return commit
+        matches = [c for c in self.firstBuild if c.startswith(commit)]
+        if len(matches) > 1:
+            raise Exception("Ambiguous commit: " + commit)
+        return matches[0] if matches else None
+
+    def first_build(self, commit):
+        """Returns the number of the first build containing the commit, or
+        None if the commit is not in any indexed build."""
+        commit = self.resolve(commit)
+        return self.firstBuild[commit] if commit else None
+
+    def build_commits(self, number):
+        """Returns the commits introduced in a build."""
+        if number not in self.builds: return []
+        return self.builds[number]['commits']
+
+    def commits_between(self, fromNumber, toNumber):
+        """Returns the commits introduced after build `fromNumber` up to and
+        including build `toNumber`."""
+        commits = []
+        for num in sorted(self.builds, reverse=True):
+            if fromNumber < num <= toNumber:
+                commits += [c for c in self.builds[num]['commits']
+                            if self.firstBuild[c] == num]
+        return commits
+
+    def previous_build(self, number, version=None):
+        """Returns the number of the latest build preceding `number` that
+        still has an event directory and whose major and minor version
+        match `version` (None matches any version)."""
+        existing = set(self.event_build_numbers())
+        for num in sorted(self.builds, reverse=True):
+            if num >= number or num not in existing: continue
+            if version is None:
+                return num
+            eventVer = self.builds[num]['version']
+            if eventVer and eventVer.split('.')[:2] == version.split('.')[:2]:
+                return num
+        return None
@@ -1,32 +1,104 @@
 # coding=utf-8
 import os
+import re
 import string
+import textwrap
+import subprocess
 from . import utils
 from .event import Event
+from .commitcache import CommitCache
 from . import config
 
-def encodedText(logText):
-    logText = logText.replace('&', '&amp;')
-    logText = logText.replace('ä', '&auml;')
-    logText = logText.replace('ö', '&ouml;')
-    logText = logText.replace('Ä', '&Auml;')
-    logText = logText.replace('Ö', '&Ouml;')
-    logText = logText.replace('<', '&lt;')
-    logText = logText.replace('>', '&gt;')
-    logText = "".join([c for c in logText if c in string.whitespace or c > ' '])
-    return logText
-
-
-def xmlEncodedText(logText):
-    result = ''
-    for c in logText:
-        if c == '<':
-            result += '<![CDATA[<]]>'
-        elif c == '>':
-            result += '<![CDATA[>]]>'
-        elif c in str(string.whitespace) or c > ' ':
-            result += c
-    return result
+# Control characters other than whitespace are dropped from the output.
+_CONTROL_CHARS = dict((chr(c), '') for c in range(ord(' ')) if chr(c) not in string.whitespace)
+
+_HTML_TABLE = dict(_CONTROL_CHARS, **{
+    '&': '&amp;',
+    'ä': '&auml;',
+    'ö': '&ouml;',
+    'Ä': '&Auml;',
+    'Ö': '&Ouml;',
+    '<': '&lt;',
+    '>': '&gt;'})
+
+_XML_TABLE = dict(_CONTROL_CHARS, **{
+    '<': '<![CDATA[<]]>',
+    '>': '<![CDATA[>]]>'})
+
+
+def _escaper(table):
+    """Returns a function that replaces all characters in `table` in a
+    single pass over the text."""
+    pattern = re.compile('[%s]' % re.escape(''.join(table.keys())))
+    lookup = lambda match: table[match.group()]
+    def escape(text):
+        if pattern.search(text) is None: return text
+        return pattern.sub(lookup, text)
+    return escape
+
+
+encodedText = _escaper(_HTML_TABLE)
+xmlEncodedText = _escaper(_XML_TABLE)
+
+
+class Output:
+    """Buffers the lines of a generated file and writes them out at once."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lines = []
+
+    def print(self, line):
+        self.lines.append(line)
+
+    def close(self):
+        out = open(self.path, 'wt')
+        if self.lines:
+            out.write('\n'.join(self.lines) + '\n')
+        out.close()
+
+
+DEB_CHANGELOG_HEADER = re.compile(r'^(\S+) \(([^)]+)\) ([^;]+);(.*)$', re.MULTILINE)
+
+
+def deb_changelog_entry(package, version, distribution, changes,
+                        urgency='medium', timestamp=None):
+    """Composes a complete Debian changelog entry (as `dch --create`,
+    `dch -a` and `dch --release` would produce it).
+
+    Arguments:
+        package:      Source package name.
+        version:      Package version ("2.3.0-build1234").
+        distribution: Target distribution ("focal").
+        changes:      List of change descriptions, one bullet each.
+        urgency:      Upload urgency.
+        timestamp:    Seconds since the epoch (default: now).
+    Returns:
+        Text of the entry.
+    """
+    import email.utils
+    name = os.getenv('DEBFULLNAME') or os.getenv('NAME') or config.BUILD_AUTHOR_NAME
+    addr = os.getenv('DEBEMAIL') or os.getenv('EMAIL') or config.BUILD_AUTHOR_EMAIL
+    text = '%s (%s) %s; urgency=%s\n\n' % (package, version, distribution, urgency)
+    for change in changes:
+        text += textwrap.fill(change, width=80, initial_indent='  * ',
+                              subsequent_indent='    ', break_long_words=False,
+                              break_on_hyphens=False) + '\n'
+    text += '\n -- %s <%s>  %s\n' % (name, addr,
+                                     email.utils.formatdate(timestamp, localtime=True))
+    return text
+
+
+def deb_changelog_variant(text, package=None, version=None, distribution=None):
+    """Rewrites the header lines of a Debian changelog for another
+    package name, version, or distribution. Arguments left as None are
+    kept as is."""
+    def rewrite(match):
+        return '%s (%s) %s;%s' % (package or match.group(1),
+                                  version or match.group(2),
+                                  distribution or match.group(3),
+                                  match.group(4))
+    return DEB_CHANGELOG_HEADER.sub(rewrite, text)
 
 
 class Entry:
@@ -84,9 +156,29 @@ class Entry:
             return self._message.replace('\n\n', '<br/><br/>').replace('\n', ' ').strip()
         return self._message.strip()
 
+    RECORD_ATTRIBS = ['subject', 'extra', 'author', 'date', 'link', 'hash',
+                      '_message', 'tags', 'reverted']
+
+    def record(self):
+        """Returns the parsed commit as a plain dict for caching. Guessed
+        tags are not included because they depend on the other commits."""
+        rec = {}
+        for attr in Entry.RECORD_ATTRIBS:
+            rec[attr] = getattr(self, attr)
+        return rec
+
+    @staticmethod
+    def from_record(rec):
+        entry = Entry()
+        for attr in Entry.RECORD_ATTRIBS:
+            setattr(entry, attr, rec[attr])
+        entry.tags = list(entry.tags)
+        return entry
+
 
 class Changes:
-    def __init__(self, fromTag, toTag):
+    def __init__(self, fromTag, toTag, ctx=None):
+        self.ctx = ctx or config.context()
         self.fromTag = fromTag
         self.toTag = toTag
         self.parse()
@@ -98,9 +190,55 @@ class Changes:
         return False
 
     def parse(self):
-        tmpName = '__ctmp'
-        oldDir = os.getcwd()
+        # Only the hashes of the range are needed from git; the commit
+        # metadata is usually already in the cache.
+        commits = subprocess.check_output(['git', 'rev-list', '%s..%s' % (self.fromTag, self.toTag)],
+                                          cwd=self.ctx.doomsdayDir).decode('utf-8').split()
+        cache = CommitCache(ctx=self.ctx)
+        missing = cache.missing(commits)
+        print('%i commits in range, %i not cached' % (len(commits), len(missing)))
+        if missing:
+            try:
+                for entry in self.fetch_entries(missing):
+                    cache.put(entry.hash, entry.record())
+            except subprocess.CalledProcessError:
+                pass
+            # The batch fails or omits commits if objects are missing (e.g.,
+            # in a shallow clone); try those one at a time.
+            for commit in cache.missing(missing):
+                try:
+                    for entry in self.fetch_entries([commit]):
+                        cache.put(entry.hash, entry.record())
+                except subprocess.CalledProcessError:
+                    pass
+            cache.save()
+
+        self.entries = []
+        self.debChangeEntries = []
+        for commit in commits:
+            if commit not in cache:
+                print(' - (skipped %s: commit metadata not available)' % commit)
+                continue
+            entry = Entry.from_record(cache.get(commit))
+
+            # Debian changelog just gets the subjects.
+            print(' -', entry.subject)
+            if entry.subject not in self.debChangeEntries and not \
+                self.should_ignore(entry.subject):
+                self.debChangeEntries.append(entry.subject)
+
+            if not self.should_ignore(entry.subject):
+                self.entries.append(entry)
+
+        self.deduce_tags()
+        self.remove_reverts()
 
+    def fetch_entries(self, commits):
+        """Reads and parses the metadata of the given commits from git.
+
+        Returns:
+            List of Entry instances.
+        """
         format = '[[Subject]]%s[[/Subject]]' + \
                  '[[Author]]%an[[/Author]]' + \
                  '[[Date]]%ai[[/Date]]' + \
@@ -108,15 +246,13 @@ class Changes:
                  '[[Hash]]%H[[/Hash]]' + \
                  '[[Message]]%b[[/Message]]'
 
-        os.chdir(config.DOOMSDAY_DIR)
-        os.system("git log %s..%s --format=\"%s\" >> %s" % (self.fromTag, self.toTag, format, tmpName))
-        logText = open(tmpName, 'rt').read()
-        os.remove(tmpName)
-        os.chdir(oldDir)
+        logText = subprocess.check_output(['git', 'log', '--no-walk=unsorted', '--stdin',
+                                           '--format=' + format],
+                                          input='\n'.join(commits).encode('utf-8'),
+                                          cwd=self.ctx.doomsdayDir).decode('utf-8')
 
         pos = 0
-        self.entries = []
-        self.debChangeEntries = []
+        entries = []
         while True:
             entry = Entry()
 
@@ -126,12 +262,6 @@ class Changes:
 
             entry.set_subject(logText[pos+11:end])
 
-            # Debian changelog just gets the subjects.
-            print(' -', entry.subject)
-            if entry.subject not in self.debChangeEntries and not \
-                self.should_ignore(entry.subject):
-                self.debChangeEntries.append(entry.subject)
-
             # Author.
             pos = logText.find('[[Author]]', pos)
             end = logText.find('[[/Author]]', pos)
@@ -157,11 +287,8 @@ class Changes:
             end = logText.find('[[/Message]]', pos)
             entry.set_message(logText[pos+11:end])
 
-            if not self.should_ignore(entry.subject):
-                self.entries.append(entry)
-
-        self.deduce_tags()
-        self.remove_reverts()
+            entries.append(entry)
+        return entries
 
     def all_tags(self):
         # These words are always considered to be valid tags.
@@ -229,15 +356,15 @@ class Changes:
         toTag = self.toTag
 
         if format == 'html':
-            out = open(Event(toTag).file_path('changes.html'), 'wt')
+            out = Output(Event(toTag, ctx=self.ctx).file_path('changes.html'))
 
             MAX_COMMITS = 100
             entries = self.entries[:MAX_COMMITS]
 
             if len(self.entries) > MAX_COMMITS:
-                print('<p>Showing %i of %i commits.' % (MAX_COMMITS, len(self.entries)), file=out)
-                print('The <a href="%s">oldest commit</a> is dated %s.</p>' % \
-                    (self.entries[-1].link, self.entries[-1].date), file=out)
+                out.print('<p>Showing %i of %i commits.' % (MAX_COMMITS, len(self.entries)))
+                out.print('The <a href="%s">oldest commit</a> is dated %s.</p>' % \
+                    (self.entries[-1].link, self.entries[-1].date))
 
             # Form groups.
             groups = self.form_groups(entries)
@@ -247,8 +374,8 @@ class Changes:
             for group in keys:
                 if not len(groups[group]): continue
 
-                print('<h3>%s</h3>' % group, file=out)
-                print('<ul>', file=out)
+                out.print('<h3>%s</h3>' % group)
+                out.print('<ul>')
 
                 # Write a list entry for each commit.
                 for entry in groups[group]:
@@ -260,64 +387,57 @@ class Changes:
                     others = self.pretty_group_list(otherGroups)
                     if others: others = ' (&rarr; %s)' % others
 
-                    print('<li>', file=out)
-                    print('<a href="%s">%s</a>: ' % (entry.link, entry.date[:10]), file=out)
-                    print('<b>%s</b>' % entry.subject, file=out)
-                    print('by <i>%s</i>%s' % (encodedText(entry.author), others), file=out)
-                    print('<blockquote style="color:#666;">%s</blockquote>' % entry.message(encodeHtml=True), file=out)
+                    out.print('<li>')
+                    out.print('<a href="%s">%s</a>: ' % (entry.link, entry.date[:10]))
+                    out.print('<b>%s</b>' % entry.subject)
+                    out.print('by <i>%s</i>%s' % (encodedText(entry.author), others))
+                    out.print('<blockquote style="color:#666;">%s</blockquote>' % entry.message(encodeHtml=True))
 
-                print('</ul>', file=out)
+                out.print('</ul>')
             out.close()
 
         elif format == 'xml':
-            out = open(Event(toTag).file_path('changes.xml'), 'wt')
-            print('<commitCount>%i</commitCount>' % len(self.entries), file=out)
-            print('<commits>', file=out)
+            out = Output(Event(toTag, ctx=self.ctx).file_path('changes.xml'))
+            out.print('<commitCount>%i</commitCount>' % len(self.entries))
+            out.print('<commits>')
             for entry in self.entries:
-                print('<commit>', file=out)
-                print('<submitDate>%s</submitDate>' % entry.date, file=out)
-                print('<author>%s</author>' % xmlEncodedText(entry.author), file=out)
-                print('<repositoryUrl>%s</repositoryUrl>' % entry.link, file=out)
-                print('<sha1>%s</sha1>' % entry.hash, file=out)
+                out.print('<commit>')
+                out.print('<submitDate>%s</submitDate>' % entry.date)
+                out.print('<author>%s</author>' % xmlEncodedText(entry.author))
+                out.print('<repositoryUrl>%s</repositoryUrl>' % entry.link)
+                out.print('<sha1>%s</sha1>' % entry.hash)
                 if entry.tags or entry.guessedTags:
-                    print('<tags>', file=out)
+                    out.print('<tags>')
                     for t in entry.tags:
-                        print('<tag guessed="false">%s</tag>' % xmlEncodedText(t), file=out)
+                        out.print('<tag guessed="false">%s</tag>' % xmlEncodedText(t))
                     for t in entry.guessedTags:
-                        print('<tag guessed="true">%s</tag>' % xmlEncodedText(t), file=out)
-                    print('</tags>', file=out)
-                print('<title>%s</title>' % entry.subject, file=out)
+                        out.print('<tag guessed="true">%s</tag>' % xmlEncodedText(t))
+                    out.print('</tags>')
+                out.print('<title>%s</title>' % entry.subject)
                 if len(entry.message()):
-                    print('<message>%s</message>' % entry.message(), file=out)
-                print('</commit>', file=out)
-            print('</commits>', file=out)
+                    out.print('<message>%s</message>' % entry.message())
+                out.print('</commit>')
+            out.print('</commits>')
             out.close()
 
         elif format == 'deb':
-            import build_version
-            build_version.find_version()
+            from .git import git_version
+            version, releaseType = git_version(toTag, self.ctx)
 
-            # Append the changes to the debian package changelog.
-            os.chdir(os.path.join(config.DOOMSDAY_DIR))
-
-            if not os.path.exists('debian'): os.mkdir('debian')
+            # Write a new debian package changelog.
+            debDir = os.path.join(self.ctx.doomsdayDir, 'debian')
+            if not os.path.exists(debDir): os.mkdir(debDir)
 
             # First we need to update the version.
-            debVersion = build_version.DOOMSDAY_VERSION_FULL + '-' + Event().tag()
+            debVersion = version + '-' + Event(ctx=self.ctx).tag()
 
             # Always make one entry.
             print('Marking new version...')
-            msg = 'New release: %s build %i.' % (build_version.DOOMSDAY_RELEASE_TYPE,
-                                                 Event().number())
-
-            # Reset the changelog.
-            os.system('rm -f debian/changelog && ' + \
-                'dch --check-dirname-level=0 --create --package doomsday -v %s "%s"' % (debVersion, msg))
-
+            msg = 'New release: %s build %i.' % (releaseType, Event(ctx=self.ctx).number())
             for entry in self.debChangeEntries:
-                # Quote it for the command line.
-                qch = entry.replace('"', '\\"').replace('!', '\\!')
-                print(' *', qch)
-                os.system("dch --check-dirname-level 0 -a \"%s\"" % qch)
+                print(' *', entry)
 
-            os.system('dch --release ""')
+            out = open(os.path.join(debDir, 'changelog'), 'wt')
+            out.write(deb_changelog_entry('doomsday', debVersion, utils.deb_distribution(),
+                                          [msg] + self.debChangeEntries))
+            out.close()
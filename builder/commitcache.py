@@ -0,0 +1,52 @@
+import os
+import pickle
+from . import config
+
+# Increment when the format of the cached records changes.
+CACHE_VERSION = 1
+
+
+def cache_path(ctx=None):
+    ctx = ctx or config.context()
+    return os.path.join(ctx.cacheDir, 'commits-v%i.pickle' % CACHE_VERSION)
+
+
+class CommitCache:
+    """Persistent store of parsed commit records, keyed by commit hash.
+    Commits never change, so a record is valid forever once parsed."""
+
+    def __init__(self, path=None, ctx=None):
+        self.path = path or cache_path(ctx)
+        self.records = {}
+        self.modified = False
+        if os.path.exists(self.path):
+            try:
+                self.records = pickle.load(open(self.path, 'rb'))
+            except Exception as x:
+                print('Ignoring unreadable commit cache %s: %s' % (self.path, x))
+
+    def __contains__(self, commit):
+        return commit in self.records
+
+    def get(self, commit):
+        return self.records.get(commit)
+
+    def put(self, commit, record):
+        self.records[commit] = record
+        self.modified = True
+
+    def missing(self, commits):
+        """Returns the commits (in the given order) that are not cached."""
+        return [c for c in commits if c not in self.records]
+
+    def save(self):
+        if not self.modified: return
+        dirName = os.path.dirname(self.path)
+        if not os.path.exists(dirName): os.makedirs(dirName)
+        # Write to a temporary file first so readers never see a partial cache.
+        tmpName = self.path + '.%i.tmp' % os.getpid()
+        f = open(tmpName, 'wb')
+        pickle.dump(self.records, f, 2)
+        f.close()
+        os.replace(tmpName, self.path)
+        self.modified = False
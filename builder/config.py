@@ -1,59 +1,135 @@
 import os
 import sys
+import threading
 
-def get_arg(label):
+def get_arg(label, argv=None):
     """Find the value for the command line option @a label."""
-    if label in sys.argv:
-        return sys.argv[sys.argv.index(label) + 1]
+    if argv is None: argv = sys.argv
+    if label in argv:
+        return argv[argv.index(label) + 1]
     return None
 
+
+def get_positional_args(argv=None):
+    """Returns the command line arguments following the command that are
+    not options (every option is followed by its value)."""
+    if argv is None: argv = sys.argv
+    args = []
+    i = 2
+    while i < len(argv):
+        if argv[i].startswith('--'):
+            i += 2
+            continue
+        args.append(argv[i])
+        i += 1
+    return args
+
 BUILD_AUTHOR_NAME = "skyjake"
 BUILD_AUTHOR_EMAIL = "skyjake@dengine.net"
 BUILD_URI = "http://files.dengine.net/builds"
 RFC_TIME = "%a, %d %b %Y %H:%M:%S +0000"
-if 'HOME' in os.environ:
-    EVENT_DIR = os.path.join(os.environ['HOME'], 'BuildMaster')
-else:
-    EVENT_DIR = '.'
-DISTRIB_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
-DOOMSDAY_DIR = ''
-APT_REPO_DIR = ''
-TAG_MODIFIER = ''
-BRANCH = 'master'
-
-val = get_arg('--distrib')
-if val is not None: DISTRIB_DIR = val
-
-val = get_arg('--doomsday')
-if val is not None: DOOMSDAY_DIR = val
-
-val = get_arg('--events')
-if val is not None: EVENT_DIR = val
-
-val = get_arg('--apt')
-if val is not None: APT_REPO_DIR = val
-
-val = get_arg('--branch')
-if val is not None: BRANCH = val
-
-val = get_arg('--tagmod')
-if val is not None: TAG_MODIFIER = val
-
-# Guess where Doomsday is located.
-if not DOOMSDAY_DIR and DISTRIB_DIR:
-    DOOMSDAY_DIR = os.path.abspath(os.path.join(DISTRIB_DIR, '..', 'deng'))
-
-# Determine APT repository path.
-oldCwd = os.getcwd()
-if DISTRIB_DIR:
-    DISTRIB_DIR = os.path.abspath(DISTRIB_DIR)
-    os.chdir(DISTRIB_DIR)
-import build_version
-build_version.find_version(quiet=True)
-if build_version.DOOMSDAY_RELEASE_TYPE == 'Stable':
-    APT_DIST = 'dists/stable'
-    APT_CONF_FILE = '~/Dropbox/APT/ftparchive-release-stable.conf'
-else:
-    APT_DIST = 'dists/unstable'
-    APT_CONF_FILE = '~/Dropbox/APT/ftparchive-release.conf'
-os.chdir(oldCwd)
+
+
+class Context:
+    """Locations and settings for builder operations. Builder functions get
+    everything from a context instead of module globals or the current
+    working directory, so operations with different contexts can be carried
+    out concurrently in one process."""
+
+    def __init__(self, distribDir=None, doomsdayDir=None, eventDir=None,
+                 aptRepoDir='', cacheDir=None, worktreeDir='', mirrorDir='',
+                 branch='master', tagModifier='', commit='', build='', args=[]):
+        if not distribDir:
+            distribDir = os.path.join(os.path.dirname(__file__), '..')
+        self.distribDir = os.path.abspath(distribDir)
+        # Guess where Doomsday is located.
+        if not doomsdayDir:
+            doomsdayDir = os.path.join(self.distribDir, '..', 'deng')
+        self.doomsdayDir = os.path.abspath(doomsdayDir)
+        if not eventDir:
+            if 'HOME' in os.environ:
+                eventDir = os.path.join(os.environ['HOME'], 'BuildMaster')
+            else:
+                eventDir = '.'
+        self.eventDir = eventDir
+        self.aptRepoDir = aptRepoDir
+        # Persistent caches are kept in the distrib directory by default.
+        self.cacheDir = os.path.abspath(cacheDir or os.path.join(self.distribDir, 'cache'))
+        self.worktreeDir = os.path.abspath(worktreeDir) if worktreeDir else ''
+        # Local bare mirrors of the upstream repositories (see builder.mirror).
+        self.mirrorDir = os.path.abspath(mirrorDir) if mirrorDir else ''
+        self.branch = branch
+        self.tagModifier = tagModifier
+        # Commit that the task is about, if known (see git_pull).
+        self.commit = commit
+        # Number of the build that the task is about; today's by default.
+        self.build = str(build) if build else ''
+        self.args = list(args)
+        self._releaseType = None
+
+    def build_tag(self):
+        """Tag of the build that the task is about ("buildNNNN")."""
+        if self.build: return 'build' + self.build
+        import build_number
+        return 'build' + build_number.todays_build()
+
+    def release_type(self):
+        """Release type of the branch ("Stable", "Unstable", ...). It is read
+        from the repository so the state of the working tree does not matter."""
+        if self._releaseType is None:
+            from .git import git_version
+            try:
+                self._releaseType = git_version(self.branch, self)[1]
+            except Exception:
+                import build_version
+                build_version.find_version(doomsdayDir=os.path.join(self.doomsdayDir, 'doomsday'),
+                                           quiet=True)
+                self._releaseType = build_version.DOOMSDAY_RELEASE_TYPE
+        return self._releaseType
+
+    def apt_dist(self):
+        """Distribution in the APT repository where packages are placed."""
+        if self.release_type() == 'Stable':
+            return 'dists/stable'
+        return 'dists/unstable'
+
+    def apt_conf_file(self):
+        if self.release_type() == 'Stable':
+            return '~/Dropbox/APT/ftparchive-release-stable.conf'
+        return '~/Dropbox/APT/ftparchive-release.conf'
+
+
+def parse_args(argv=None):
+    """Creates a Context from command line options."""
+    if argv is None: argv = sys.argv
+    return Context(distribDir=get_arg('--distrib', argv),
+                   doomsdayDir=get_arg('--doomsday', argv),
+                   eventDir=get_arg('--events', argv),
+                   aptRepoDir=get_arg('--apt', argv) or '',
+                   cacheDir=get_arg('--cache', argv),
+                   worktreeDir=get_arg('--worktrees', argv) or '',
+                   mirrorDir=get_arg('--mirrors', argv) or '',
+                   branch=get_arg('--branch', argv) or 'master',
+                   tagModifier=get_arg('--tagmod', argv) or '',
+                   commit=get_arg('--commit', argv) or '',
+                   build=get_arg('--build', argv) or '',
+                   args=get_positional_args(argv))
+
+
+_context = None
+_contextLock = threading.Lock()
+
+def context():
+    """Returns the default context of the process. Unless one has been set,
+    it is created from the command line options on first use."""
+    global _context
+    with _contextLock:
+        if _context is None:
+            _context = parse_args()
+        return _context
+
+
+def set_context(ctx):
+    global _context
+    with _contextLock:
+        _context = ctx
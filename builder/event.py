@@ -1,4 +1,4 @@
-import os, glob, shutil, time
+import os, glob, shutil, time, json, html
 import build_number
 from . import config
 from . import utils
@@ -8,20 +8,32 @@ def log_filename(package, osIdent, ext='txt.gz'):
     return 'buildlog-%s-%s.%s' % (package, osIdent, ext)
 
 
+# Number of compilation/link units listed in the timings of a build report.
+SLOWEST_UNITS = 50
+
+
 class Event:
     """Build event. Manages the contents of a single build directory under
     the event directory."""
 
-    def __init__(self, build=None, latestAvailable=False):
+    def __init__(self, build=None, latestAvailable=False, ctx=None):
         """Any .txt logs present in the build directory are compressed into
         a combined .txt.gz (one per package)."""
 
-        if latestAvailable:
-            # Look for the latest build.
-            build = int(build_number.todays_build())
-            while not os.path.exists(os.path.join(config.EVENT_DIR, 'build%i' % build)):
-                build -= 1
-                if build == 0: raise Exception("No builds available")
+        self.ctx = ctx or config.context()
+
+        if build is None and self.ctx.build:
+            # The task is about a specific build.
+            build = int(self.ctx.build)
+        elif latestAvailable:
+            # Look for the latest build. When several builds are made in a
+            # day, the numbers run ahead of today's number.
+            numbers = []
+            if os.path.exists(self.ctx.eventDir):
+                numbers = [int(n[5:]) for n in os.listdir(self.ctx.eventDir)
+                           if n[:5] == 'build' and n[5:].isdigit()]
+            if not numbers: raise Exception("No builds available")
+            build = max(numbers)
 
         if build is None:
             # Use today's build number.
@@ -37,7 +49,7 @@ class Event:
             self.num = int(build[5:])
 
         # Where the build is located.
-        self.buildDir = os.path.join(config.EVENT_DIR, self.name)
+        self.buildDir = os.path.join(self.ctx.eventDir, self.name)
 
         self.packages = ['doomsday', 'doomsday_app', 'doomsday_shell_app', 'fmod']
 
@@ -323,6 +335,24 @@ class Event:
 
         return msg
 
+    def reused_packages(self):
+        """Packages that were reused from an identical earlier build
+        (reused-*.json). Their contents still carry the number of that
+        build.
+
+        Returns:
+            Dict of package file names and the original build numbers.
+        """
+        reused = {}
+        for fn in glob.glob(self.file_path('reused-*.json')):
+            try:
+                info = json.load(open(fn, 'rt'))
+            except ValueError:
+                continue
+            for name in info['packages']:
+                reused[name] = str(info['build'])
+        return reused
+
     def html_description(self, encoded=True):
         """Composes an HTML build report."""
 
@@ -334,6 +364,7 @@ class Event:
 
         # What do we have here?
         files = self.list_package_files()
+        reused = self.reused_packages()
 
         # Print out the matrix.
         msg += '<h2>Packages</h2>\n'
@@ -368,6 +399,9 @@ class Event:
                     isFirst = False
                 msg += '<td>'
                 msg += '<a href="%s">%s</a>' % (self.download_fallback_uri(binary), binary)
+                if binary in reused:
+                    msg += ' (reused from build %s, whose number it reports)' % \
+                        html.escape(reused[binary])
                 if self.download_fallback_uri(binary) != self.download_uri(binary):
                     msg += ' (<a href="%s">SF.net</a>)' % (self.download_uri(binary))
 
@@ -384,6 +418,9 @@ class Event:
 
         msg += '</table></p>'
 
+        msg += self.html_timings()
+        msg += self.html_resource_usage()
+
         # Changes.
         chgFn = self.file_path('changes.html')
         if os.path.exists(chgFn):
@@ -394,6 +431,96 @@ class Event:
         if encoded: return '<![CDATA[' + msg + ']]>'
         return msg
 
+    def previous_file_path(self, fileName):
+        """Finds the same file in the latest earlier build that has it.
+        Returns None if there is no such build."""
+        numbers = []
+        for name in os.listdir(self.ctx.eventDir):
+            if name[:5] == 'build' and name[5:].isdigit() and int(name[5:]) < self.number():
+                numbers.append(int(name[5:]))
+        for num in sorted(numbers, reverse=True):
+            fn = os.path.join(self.ctx.eventDir, 'build%i' % num, fileName)
+            if os.path.exists(fn): return fn
+        return None
+
+    def html_timings(self):
+        """Lists the slowest compilation and link units of each built
+        configuration (timings-*.json), compared to the previous build."""
+        msg = ''
+        for fn in sorted(glob.glob(self.file_path('timings-*.json'))):
+            try:
+                timings = json.load(open(fn, 'rt'))
+            except ValueError:
+                continue
+            previous = {}
+            prevTotal = None
+            prevFn = self.previous_file_path(os.path.basename(fn))
+            if prevFn:
+                try:
+                    prevTimings = json.load(open(prevFn, 'rt'))
+                    previous = dict([((u['kind'], u['name']), u['seconds'])
+                                     for u in prevTimings['units']])
+                    prevTotal = prevTimings['total']
+                except (ValueError, KeyError):
+                    pass
+
+            def change(seconds, prevSeconds):
+                if prevSeconds is None: return '<td>'
+                return '<td>%+.1f' % (seconds - prevSeconds)
+
+            if not msg: msg = '<h2>Slowest units</h2>\n'
+            msg += '<p>%s (%s): build took %.1f s' % \
+                (html.escape(os.path.basename(fn)[8:-5]),
+                 html.escape(timings['options'] or 'default options'), timings['total'])
+            if prevTotal is not None:
+                msg += ' (%+.1f s compared to build %s)' % \
+                    (timings['total'] - prevTotal, html.escape(str(prevTimings['build'])))
+            msg += '</p>\n<p><table cellspacing="4" border="0">'
+            msg += '<tr style="text-align:left;"><th>Unit<th>Target<th>Seconds<th>Change</tr>'
+            for unit in timings['units'][:SLOWEST_UNITS]:
+                msg += '<tr><td>%s%s<td>%s<td>%.1f' % \
+                    ('(link) ' if unit['kind'] == 'link' else '', html.escape(unit['name']),
+                     html.escape(unit['target'] or ''), unit['seconds'])
+                msg += change(unit['seconds'], previous.get((unit['kind'], unit['name'])))
+                msg += '</tr>'
+            msg += '</table></p>'
+        return msg
+
+    def html_resource_usage(self):
+        """Lists the peak resource usage of the commands recorded in the
+        usage-*.json files (see builder.resources)."""
+        from . import resources
+        msg = ''
+        for fn in sorted(glob.glob(self.file_path('usage-*.json'))):
+            try:
+                records = json.load(open(fn, 'rt'))
+            except ValueError:
+                continue
+            if not msg: msg = '<h2>Resource usage</h2>\n'
+            msg += '<p>%s</p>\n<p><table cellspacing="4" border="0">' % os.path.basename(fn)[6:-5]
+            msg += '<tr style="text-align:left;"><th>Command<th>Seconds<th>CPU seconds' \
+                   '<th>Cores<th>Memory (MB)<th>Processes<th>Read/write (MB/s)<th>Swap (MB)</tr>'
+            for record in records:
+                peak = resources.summary(record)
+
+                def value(v, form='%.0f'):
+                    return '' if v is None else form % v
+
+                cmd = record['command']
+                if len(cmd) > 60: cmd = cmd[:57] + '...'
+                msg += '<tr><td>%s<td>%.0f<td>%s<td>%s<td>%s<td>%s<td>%s' % \
+                    (html.escape(cmd), record['duration'], value(record.get('cpuTime')),
+                     value(peak['cpu'], '%.1f'), value(peak['rss']), value(peak['procs']),
+                     '' if peak['read'] is None else '%.0f/%.0f' % (peak['read'], peak['write']))
+                if peak['swapGrowth']:
+                    # The machine was swapping.
+                    msg += '<td bgcolor="#ff4444">+%i' % peak['swapGrowth']
+                else:
+                    msg += '<td>'
+                msg += '</tr>'
+            msg += '</table></p>'
+        return msg
+
     def release_type(self):
         """Returns the release type as a lower-case string."""
         fn = self.file_path('releaseType.txt')
@@ -477,11 +604,12 @@ class Event:
     #     return msg + '</build>'
 
 
-def find_newest_event():
+def find_newest_event(ctx=None):
+    ctx = ctx or config.context()
     newest = None
-    for fn in os.listdir(config.EVENT_DIR):
+    for fn in os.listdir(ctx.eventDir):
         if fn[:5] != 'build': continue
-        ev = Event(fn)
+        ev = Event(fn, ctx=ctx)
         bt = ev.timestamp()
         if newest is None or newest[0] < bt:
             newest = (bt, ev)
@@ -492,23 +620,24 @@ def find_newest_event():
         return {'event':newest[1], 'tag':newest[1].tag(), 'time':newest[0]}
 
 
-def find_old_events(atLeastSecs):
+def find_old_events(atLeastSecs, ctx=None):
     """Returns a list of Event instances."""
+    ctx = ctx or config.context()
     result = []
     now = time.time()
-    if not os.path.exists(config.EVENT_DIR): return result
-    for fn in os.listdir(config.EVENT_DIR):
+    if not os.path.exists(ctx.eventDir): return result
+    for fn in os.listdir(ctx.eventDir):
         if fn[:5] != 'build': continue
-        ev = Event(fn)
+        ev = Event(fn, ctx=ctx)
         if now - ev.timestamp() >= atLeastSecs:
             result.append(ev)
     return result
 
 
-def find_empty_events(baseDir=None):
+def find_empty_events(baseDir=None, ctx=None):
     """Returns a list of build directory paths."""
     result = []
-    if not baseDir: baseDir = config.EVENT_DIR
+    if not baseDir: baseDir = (ctx or config.context()).eventDir
     print('Finding empty subdirs in', baseDir)
     for fn in os.listdir(baseDir):
         path = os.path.join(baseDir, fn)
@@ -524,11 +653,12 @@ def find_empty_events(baseDir=None):
     return result
 
 
-def events_by_time():
+def events_by_time(ctx=None):
+    ctx = ctx or config.context()
     builds = []
-    for fn in os.listdir(config.EVENT_DIR):
+    for fn in os.listdir(ctx.eventDir):
         if fn[:5] == 'build':
-            builds.append((Event(fn).timestamp(), Event(fn)))
+            builds.append((Event(fn, ctx=ctx).timestamp(), Event(fn, ctx=ctx)))
     builds.sort()
     builds.reverse()
     return builds
@@ -1,47 +1,236 @@
 import os
 import builder.config
 import subprocess
+import threading
 
+# Location of the version information in the Doomsday repository.
+VERSION_CMAKE_PATH = 'doomsday/cmake/Version.cmake'
 
-def run_git(cmdLine, ignoreResult=False):
-    result = subprocess.call(cmdLine, shell=True)
+
+def run_git(cmdLine, ignoreResult=False, cwd=None):
+    result = subprocess.call(cmdLine, shell=True, cwd=cwd)
     if result and not ignoreResult:
         raise Exception("Failed to run git: " + cmdLine)
 
 
-def git_checkout(ident):
+def run_git_in(repoDir, args):
+    result = subprocess.call(['git'] + args, cwd=repoDir)
+    if result:
+        raise Exception("Failed to run git %s (in %s)" % (' '.join(args), repoDir))
+
+
+def git_checkout(ident, ctx=None):
     """Checkout the branch or tag @a ident from the repository."""
+    ctx = ctx or builder.config.context()
     print('Checking out %s...' % ident)
-    os.chdir(builder.config.DOOMSDAY_DIR)
-    run_git("git checkout %s" % ident)
-    os.chdir(builder.config.DISTRIB_DIR)
-
-
-def git_pull():
-    """Updates the source with a git pull and submodule update."""
-    print('Updating source from branch %s...' % builder.config.BRANCH)
-    os.chdir(builder.config.DISTRIB_DIR)
-    run_git("git pull") # update deng-distrib itself
-    os.chdir(builder.config.DOOMSDAY_DIR)
-    run_git("git checkout " + builder.config.BRANCH)
-    run_git("git pull --recurse-submodules")
-    run_git("git submodule update")
-    os.chdir(builder.config.DISTRIB_DIR)
-    
-    
-def git_tag(tag):
-    """Tags the source with a new tag."""
-    print('Tagging with %s...' % tag)
-    os.chdir(builder.config.DOOMSDAY_DIR)
-    run_git("git tag %s" % tag, ignoreResult=True)
-    run_git("git push --tags")
-    os.chdir(builder.config.DISTRIB_DIR)
-
-
-def git_head():
+    run_git("git checkout %s" % ident, cwd=ctx.doomsdayDir)
+
+
+def git_output(args, cwd):
+    """Returns the stripped output of a git command, or None if it fails."""
+    try:
+        return subprocess.check_output(['git'] + args, cwd=cwd,
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def git_remote_head(branch, repoDir):
+    """Asks the remote for the current commit of `branch` without fetching
+    anything. Returns None if the remote cannot be reached."""
+    out = git_output(['ls-remote', 'origin', 'refs/heads/' + branch], repoDir)
+    if not out: return None
+    return out.split()[0]
+
+
+def synced_path(ctx=None):
+    ctx = ctx or builder.config.context()
+    return os.path.join(ctx.cacheDir, 'synced')
+
+
+def read_synced(ctx=None):
+    """Returns the commits that repositories were last synced to, as a
+    dictionary keyed by repository path."""
+    synced = {}
+    fn = synced_path(ctx)
+    if os.path.exists(fn):
+        for line in open(fn, 'rt').readlines():
+            commit, path = line.strip().split(' ', 1)
+            synced[path] = commit
+    return synced
+
+
+def mark_synced(repoDir, commit, ctx=None):
+    """Records that `repoDir` and its submodules are up to date at `commit`."""
+    synced = read_synced(ctx)
+    synced[repoDir] = commit
+    fn = synced_path(ctx)
+    if not os.path.exists(os.path.dirname(fn)): os.makedirs(os.path.dirname(fn))
+    tmpName = fn + '.%i.tmp' % os.getpid()
+    f = open(tmpName, 'wt')
+    for path in synced:
+        print('%s %s' % (synced[path], path), file=f)
+    f.close()
+    os.replace(tmpName, fn)
+
+
+def git_is_synced(repoDir, branch, commit, ctx=None):
+    """Checks if `branch` is checked out in `repoDir` at the commit it was
+    last synced to, and that commit is `commit` or a descendant of it."""
+    syncedCommit = read_synced(ctx).get(repoDir)
+    if not syncedCommit:
+        return False
+    if syncedCommit != commit and \
+            subprocess.call(['git', 'merge-base', '--is-ancestor', commit, syncedCommit],
+                            cwd=repoDir, stderr=subprocess.DEVNULL) != 0:
+        return False
+    return git_output(['symbolic-ref', '--short', 'HEAD'], repoDir) == branch and \
+           git_output(['rev-parse', 'HEAD'], repoDir) == syncedCommit
+
+
+def git_pull_distrib(ctx=None):
+    """Updates deng-distrib itself, unless it already matches the remote."""
+    ctx = ctx or builder.config.context()
+    branch = git_output(['symbolic-ref', '--short', 'HEAD'], ctx.distribDir)
+    if branch and git_remote_head(branch, ctx.distribDir) == \
+            git_output(['rev-parse', 'HEAD'], ctx.distribDir):
+        return
+    run_git("git pull", cwd=ctx.distribDir)
+
+
+def git_pull(ctx=None):
+    """Updates the source with a git pull and submodule update. Nothing is
+    done if the checkout was already synced to the target commit, which is
+    the task's commit (--commit) or else the remote head of the branch."""
+    ctx = ctx or builder.config.context()
+    print('Updating source from branch %s...' % ctx.branch)
+    git_pull_distrib(ctx)
+    if ctx.mirrorDir:
+        import builder.mirror
+        builder.mirror.mirror_sync(ctx)
+    target = ctx.commit or git_remote_head(ctx.branch, ctx.doomsdayDir)
+    if target and git_is_synced(ctx.doomsdayDir, ctx.branch, target, ctx):
+        print('Source is already up to date with %s.' % target)
+        return
+    run_git("git checkout " + ctx.branch, cwd=ctx.doomsdayDir)
+    if ctx.mirrorDir:
+        # Submodule mirrors are fetched as needed by the update.
+        run_git("git pull", cwd=ctx.doomsdayDir)
+        builder.mirror.submodule_update(ctx.doomsdayDir, ctx)
+    else:
+        run_git("git pull --recurse-submodules", cwd=ctx.doomsdayDir)
+        run_git("git submodule update", cwd=ctx.doomsdayDir)
+    mark_synced(ctx.doomsdayDir, git_head(ctx), ctx)
+
+
+def git_fetch(ctx=None):
+    """Fetches new commits and tags without touching the Doomsday checkout."""
+    ctx = ctx or builder.config.context()
+    print('Fetching source...')
+    git_pull_distrib(ctx)
+    if ctx.mirrorDir:
+        import builder.mirror
+        builder.mirror.mirror_sync(ctx)
+    run_git("git fetch --tags", cwd=ctx.doomsdayDir)
+
+
+def git_update(ctx=None):
+    """Brings the source up to date for carrying out a task. When tasks use
+    their own worktrees, the shared checkout is left alone."""
+    ctx = ctx or builder.config.context()
+    if ctx.worktreeDir:
+        git_fetch(ctx)
+    else:
+        git_pull(ctx)
+
+
+def git_tag(tag, ctx=None, commit=None):
+    """Tags the source with a new tag, at `commit` or else at HEAD."""
+    ctx = ctx or builder.config.context()
+    print('Tagging %s with %s...' % (commit or 'HEAD', tag))
+    run_git("git tag %s %s" % (tag, commit or ''), ignoreResult=True, cwd=ctx.doomsdayDir)
+    run_git("git push --tags", cwd=ctx.doomsdayDir)
+
+
+def git_head(ctx=None):
     """Returns the current HEAD commit hash."""
-    os.chdir(builder.config.DOOMSDAY_DIR)
-    head = subprocess.check_output('git rev-parse HEAD', shell=True) \
+    ctx = ctx or builder.config.context()
+    return subprocess.check_output('git rev-parse HEAD', shell=True, cwd=ctx.doomsdayDir) \
                      .decode('utf-8').strip()
-    os.chdir(builder.config.DISTRIB_DIR)
-    return head
+
+
+class GitObjectReader:
+    """Reads files of any commit straight from the object database using a
+    persistent `git cat-file --batch` process. The working tree is never
+    touched, so the checkout may be at any ref. Reads are serialized, so
+    one reader can be shared by several threads."""
+
+    def __init__(self, repoDir):
+        self.repoDir = repoDir
+        self.lock = threading.Lock()
+        self.proc = None
+
+    def start(self):
+        self.proc = subprocess.Popen(['git', 'cat-file', '--batch'], cwd=self.repoDir,
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def read(self, ref, path):
+        """Returns the contents of `path` at `ref` as bytes, or None if
+        there is no such file."""
+        with self.lock:
+            if self.proc is None or self.proc.poll() is not None:
+                self.start()
+            self.proc.stdin.write(('%s:%s\n' % (ref, path)).encode('utf-8'))
+            self.proc.stdin.flush()
+            header = self.proc.stdout.readline().decode('utf-8').split()
+            if len(header) != 3:
+                # "<object> missing" or "<object> ambiguous"
+                return None
+            size = int(header[2])
+            data = self.proc.stdout.read(size + 1) # followed by a newline
+            return data[:size]
+
+    def close(self):
+        with self.lock:
+            if self.proc is not None:
+                self.proc.stdin.close()
+                self.proc.wait()
+                self.proc = None
+
+
+_readers = {}
+_readersLock = threading.Lock()
+
+def git_reader(repoDir):
+    """Returns the shared object reader for a repository."""
+    repoDir = os.path.abspath(repoDir)
+    with _readersLock:
+        if repoDir not in _readers:
+            _readers[repoDir] = GitObjectReader(repoDir)
+        return _readers[repoDir]
+
+
+def git_read_file(ref, path, ctx=None):
+    """Returns the text contents of `path` at `ref` of the Doomsday
+    repository without a checkout, or None if the file does not exist at
+    that ref."""
+    ctx = ctx or builder.config.context()
+    data = git_reader(ctx.doomsdayDir).read(ref, path)
+    if data is None: return None
+    return data.decode('utf-8')
+
+
+def git_version(ref, ctx=None):
+    """Determines the Doomsday version at `ref` without a checkout.
+
+    Returns:
+        Tuple (full version, release type), e.g., ("2.3.1", "Unstable").
+    """
+    import build_version
+    text = git_read_file(ref, VERSION_CMAKE_PATH, ctx)
+    if text is None:
+        raise Exception("%s not found at %s" % (VERSION_CMAKE_PATH, ref))
+    major, minor, revision, name, releaseType = build_version.parse_cmake_text_for_version(text)
+    version = "%s.%s.%s" % (major, minor, revision)
+    if name: version += "-" + name
+    return (version, releaseType or "Unstable")
@@ -0,0 +1,166 @@
+import os
+import hashlib
+import subprocess
+from . import config
+from .git import git_output, run_git_in
+
+
+def mirror_path(url, ctx=None):
+    """Location of the local bare mirror of the repository at `url`."""
+    ctx = ctx or config.context()
+    name = os.path.basename(url.rstrip('/'))
+    if name.endswith('.git'): name = name[:-4]
+    digest = hashlib.sha1(url.encode('utf-8')).hexdigest()[:8]
+    return os.path.join(ctx.mirrorDir, '%s-%s.git' % (name, digest))
+
+
+def resolve_url(url, baseUrl):
+    """Resolves a relative submodule URL ("../name.git") against the URL of
+    the superproject."""
+    if not url.startswith('./') and not url.startswith('../'):
+        return url
+    base = baseUrl.rstrip('/')
+    for part in url.split('/'):
+        if part == '..':
+            # Keep the separator in case it is the ':' of an scp-style URL.
+            base = base[:max(base.rfind('/'), base.rfind(':')) + 1]
+        elif part != '.':
+            if not base.endswith('/') and not base.endswith(':'): base += '/'
+            base += part
+    return base
+
+
+def has_commit(repoDir, commit):
+    return subprocess.call(['git', 'cat-file', '-e', commit + '^{commit}'], cwd=repoDir,
+                           stderr=subprocess.DEVNULL) == 0
+
+
+def mirror_update(url, ctx=None, commit=None):
+    """Creates or updates the local bare mirror of `url`.
+
+    The mirror is only fetched when the remote has changed: if `commit` is
+    given, when the mirror does not have it yet; otherwise when the refs
+    listed by the remote differ from the ones seen at the previous fetch.
+    Mirrors never prune objects, because checkouts borrow objects from them.
+
+    Returns:
+        Path of the mirror.
+    """
+    ctx = ctx or config.context()
+    path = mirror_path(url, ctx)
+    if not os.path.exists(path):
+        print('Creating mirror of %s in %s...' % (url, path))
+        if not os.path.exists(ctx.mirrorDir): os.makedirs(ctx.mirrorDir)
+        run_git_in(ctx.mirrorDir, ['clone', '--mirror', url, path])
+        run_git_in(path, ['config', 'gc.pruneExpire', 'never'])
+        if commit is None:
+            save_remote_fingerprint(path, remote_fingerprint(path))
+        return path
+    if commit is not None:
+        if not has_commit(path, commit):
+            print('Fetching %s into mirror...' % url)
+            run_git_in(path, ['fetch', '--quiet', 'origin'])
+        return path
+    fingerprint = remote_fingerprint(path)
+    if fingerprint is None or fingerprint != read_remote_fingerprint(path):
+        print('Fetching %s into mirror...' % url)
+        run_git_in(path, ['fetch', '--quiet', 'origin'])
+        save_remote_fingerprint(path, fingerprint)
+    return path
+
+
+def remote_fingerprint(path):
+    """Hash of the branches and tags of the mirror's upstream repository, or
+    None if the upstream cannot be reached."""
+    refs = git_output(['ls-remote', '--heads', '--tags', 'origin'], path)
+    if refs is None: return None
+    return hashlib.sha1(refs.encode('utf-8')).hexdigest()
+
+
+def read_remote_fingerprint(path):
+    fn = os.path.join(path, 'remote-fingerprint')
+    if not os.path.exists(fn): return None
+    return open(fn, 'rt').read().strip()
+
+
+def save_remote_fingerprint(path, fingerprint):
+    if fingerprint is None: return
+    print(fingerprint, file=open(os.path.join(path, 'remote-fingerprint'), 'wt'))
+
+
+def upstream_url(repoDir):
+    """Returns the upstream URL of a checkout. Once a checkout uses a mirror,
+    the upstream remains as its push URL."""
+    return git_output(['config', '--get', 'remote.origin.pushurl'], repoDir) or \
+           git_output(['config', '--get', 'remote.origin.url'], repoDir)
+
+
+def use_mirror(repoDir, url, mirror):
+    """Makes a checkout fetch from `mirror` and borrow its objects. Pushes
+    still go to the upstream `url`."""
+    gitDir = git_output(['rev-parse', '--git-common-dir'], repoDir)
+    if gitDir is None:
+        raise Exception("Not a git repository: " + repoDir)
+    altFile = os.path.join(repoDir, gitDir, 'objects', 'info', 'alternates')
+    mirrorObjects = os.path.join(mirror, 'objects')
+    alternates = open(altFile, 'rt').read().split() if os.path.exists(altFile) else []
+    if mirrorObjects not in alternates:
+        if not os.path.exists(os.path.dirname(altFile)): os.makedirs(os.path.dirname(altFile))
+        print(mirrorObjects, file=open(altFile, 'at'))
+    if git_output(['config', '--get', 'remote.origin.pushurl'], repoDir) != url:
+        run_git_in(repoDir, ['remote', 'set-url', '--push', 'origin', url])
+    if git_output(['config', '--get', 'remote.origin.url'], repoDir) != mirror:
+        run_git_in(repoDir, ['remote', 'set-url', 'origin', mirror])
+
+
+def mirror_sync(ctx=None):
+    """Updates the mirror of the Doomsday repository and makes the Doomsday
+    checkout use it."""
+    ctx = ctx or config.context()
+    url = upstream_url(ctx.doomsdayDir)
+    if url is None:
+        raise Exception("Doomsday repository has no origin remote")
+    use_mirror(ctx.doomsdayDir, url, mirror_update(url, ctx))
+
+
+def submodules(repoDir):
+    """Returns (name, path, url) tuples of the submodules listed in
+    .gitmodules of a checkout."""
+    if not os.path.exists(os.path.join(repoDir, '.gitmodules')):
+        return []
+    out = git_output(['config', '-f', '.gitmodules', '--get-regexp',
+                      r'^submodule\..*\.(path|url)$'], repoDir) or ''
+    found = {}
+    for line in out.splitlines():
+        key, value = line.split(' ', 1)
+        name, attr = key[len('submodule.'):].rsplit('.', 1)
+        found.setdefault(name, {})[attr] = value
+    return [(name, found[name]['path'], found[name]['url']) for name in sorted(found)
+            if 'path' in found[name] and 'url' in found[name]]
+
+
+def submodule_update(repoDir, ctx=None):
+    """Initializes and updates the submodules of a checkout recursively. With
+    mirrors enabled, each submodule is cloned from and kept fetching from a
+    local mirror of its upstream, which is fetched only when the recorded
+    submodule commit is missing from it."""
+    ctx = ctx or config.context()
+    if not ctx.mirrorDir:
+        run_git_in(repoDir, ['submodule', 'update', '--init', '--recursive'])
+        return
+    baseUrl = upstream_url(repoDir)
+    for name, path, url in submodules(repoDir):
+        url = resolve_url(url, baseUrl)
+        entry = git_output(['ls-tree', 'HEAD', path], repoDir)
+        commit = entry.split()[2] if entry else None
+        mirror = mirror_update(url, ctx, commit)
+        run_git_in(repoDir, ['config', 'submodule.%s.url' % name, mirror])
+        subDir = os.path.join(repoDir, path)
+        if os.path.exists(os.path.join(subDir, '.git')):
+            # Fetch missing commits from the mirror, too.
+            use_mirror(subDir, url, mirror)
+        # Submodule commands only use local repositories when allowed explicitly.
+        run_git_in(repoDir, ['-c', 'protocol.file.allow=always',
+                             'submodule', 'update', '--init', '--', path])
+        use_mirror(subDir, url, mirror)
+        submodule_update(subDir, ctx)
@@ -0,0 +1,223 @@
+import os
+import sys
+import json
+import time
+import threading
+import subprocess
+
+# Seconds between samples at first. The interval is doubled whenever the
+# series grows beyond MAX_SAMPLES, so long builds still have compact series.
+SAMPLE_INTERVAL = 1.0
+MAX_SAMPLES = 600
+
+_writeLock = threading.Lock()
+
+if sys.platform.startswith('linux'):
+    _TICKS = os.sysconf('SC_CLK_TCK')
+    _PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def _proc_tree(rootPid):
+    """Returns the PIDs of a process and its descendants (Linux /proc)."""
+    children = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit(): continue
+        try:
+            stat = open('/proc/%s/stat' % name, 'rt').read()
+        except OSError:
+            continue
+        ppid = int(stat[stat.rfind(')') + 2:].split()[1])
+        children.setdefault(ppid, []).append(int(name))
+    tree = [rootPid]
+    i = 0
+    while i < len(tree):
+        tree += children.get(tree[i], [])
+        i += 1
+    return tree
+
+
+def _proc_counters(pid):
+    """Returns (CPU seconds, RSS bytes, bytes read, bytes written) of one
+    process, or None if it has exited."""
+    try:
+        fields = open('/proc/%i/stat' % pid, 'rt').read()
+        fields = fields[fields.rfind(')') + 2:].split()
+        cpu = (int(fields[11]) + int(fields[12])) / float(_TICKS)
+        rss = int(fields[21]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return None
+    read = written = 0
+    try:
+        for line in open('/proc/%i/io' % pid, 'rt'):
+            if line.startswith('read_bytes:'): read = int(line.split()[1])
+            elif line.startswith('write_bytes:'): written = int(line.split()[1])
+    except OSError:
+        pass
+    return cpu, rss, read, written
+
+
+def _psutil_counters(rootPid):
+    """Same as _proc_counters for each process of the tree, via psutil.
+    Returns None if psutil is not available."""
+    try:
+        import psutil
+    except ImportError:
+        return None
+    counters = {}
+    try:
+        root = psutil.Process(rootPid)
+        procs = [root] + root.children(recursive=True)
+    except psutil.Error:
+        return counters
+    for proc in procs:
+        try:
+            times = proc.cpu_times()
+            read = written = 0
+            if hasattr(proc, 'io_counters'):
+                io = proc.io_counters()
+                read, written = io.read_bytes, io.write_bytes
+            counters[proc.pid] = (times.user + times.system, proc.memory_info().rss,
+                                  read, written)
+        except psutil.Error:
+            pass
+    return counters
+
+
+def _tree_counters(rootPid):
+    """Returns {pid: counters} for the process tree, or None if the
+    platform provides no way to sample processes."""
+    if sys.platform.startswith('linux'):
+        counters = {}
+        for pid in _proc_tree(rootPid):
+            c = _proc_counters(pid)
+            if c: counters[pid] = c
+        return counters
+    return _psutil_counters(rootPid)
+
+
+def _swap_used():
+    """System-wide swap in use in megabytes, or None."""
+    if not os.path.exists('/proc/meminfo'): return None
+    info = {}
+    for line in open('/proc/meminfo', 'rt'):
+        parts = line.split()
+        if len(parts) >= 2: info[parts[0]] = int(parts[1])
+    if 'SwapTotal:' not in info: return None
+    return (info['SwapTotal:'] - info.get('SwapFree:', 0)) // 1024
+
+
+class Sampler(threading.Thread):
+    """Samples the resource usage of a process tree until stopped.
+
+    Each sample is a list: [seconds since start, CPU cores in use, RSS of
+    the tree (MB), processes, MB/s read, MB/s written, swap in use (MB)]."""
+
+    def __init__(self, pid):
+        threading.Thread.__init__(self, daemon=True)
+        self.pid = pid
+        self.startedAt = time.time()
+        self.interval = SAMPLE_INTERVAL
+        self.samples = []
+        self.previous = {}
+        self.stopped = threading.Event()
+
+    def run(self):
+        lastTime = self.startedAt
+        while not self.stopped.wait(self.interval):
+            counters = _tree_counters(self.pid)
+            if counters is None: return
+            now = time.time()
+            span = max(now - lastTime, 1e-3)
+            lastTime = now
+            cpu = read = written = 0
+            for pid in counters:
+                prev = self.previous.get(pid, (0, 0, 0, 0))
+                cpu += counters[pid][0] - prev[0]
+                read += counters[pid][2] - prev[2]
+                written += counters[pid][3] - prev[3]
+            self.previous = counters
+            mb = 1024.0 * 1024.0
+            self.add([round(now - self.startedAt, 1), round(cpu / span, 2),
+                      round(sum(c[1] for c in counters.values()) / mb),
+                      len(counters), round(read / mb / span, 1), round(written / mb / span, 1),
+                      _swap_used()])
+
+    def add(self, sample):
+        self.samples.append(sample)
+        if len(self.samples) > MAX_SAMPLES:
+            # Halve the resolution, keeping the higher values.
+            merged = []
+            for i in range(0, len(self.samples), 2):
+                pair = self.samples[i:i + 2]
+                merged.append([pair[-1][0]] + [max(v[k] for v in pair) if pair[0][k] is not None
+                                               else None for k in range(1, len(sample))])
+            self.samples = merged
+            self.interval *= 2
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def summary(record):
+    """Peak values of a usage record."""
+    samples = record['samples']
+
+    def peak(k):
+        values = [s[k] for s in samples if s[k] is not None]
+        return max(values) if values else None
+
+    swap = [s[6] for s in samples if s[6] is not None]
+    return {'cpu': peak(1), 'rss': max(filter(None, [peak(2), record.get('maxRss')]),
+                                       default=None),
+            'procs': peak(3), 'read': peak(4), 'write': peak(5),
+            'swapGrowth': max(swap) - swap[0] if swap else None}
+
+
+def save_record(usageFile, record):
+    """Appends a record to a usage file (a JSON list of records)."""
+    with _writeLock:
+        records = []
+        if os.path.exists(usageFile):
+            try:
+                records = json.load(open(usageFile, 'rt'))
+            except ValueError:
+                pass
+        records.append(record)
+        tmpName = usageFile + '.tmp'
+        json.dump(records, open(tmpName, 'wt'), separators=(',', ':'))
+        os.replace(tmpName, usageFile)
+
+
+def run_sampled(cmd, usageFile, cwd=None, stdout=None, stderr=None):
+    """Runs a shell command and appends its resource usage to `usageFile`:
+    the command, duration, total CPU time, the peak RSS of its largest
+    process and the time series of samples (see Sampler).
+
+    Returns:
+        Exit code of the command.
+    """
+    startedAt = time.time()
+    proc = subprocess.Popen(cmd, shell=True, cwd=cwd, stdout=stdout, stderr=stderr)
+    sampler = Sampler(proc.pid)
+    sampler.start()
+    record = {'command': cmd, 'start': startedAt}
+    if hasattr(os, 'wait4'):
+        # The usage includes all the descendants waited for by the process.
+        pid, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        record['cpuTime'] = round(usage.ru_utime + usage.ru_stime, 1)
+        # Kilobytes on Linux, bytes on macOS.
+        record['maxRss'] = round(usage.ru_maxrss / (1024.0 * 1024.0 if sys.platform == 'darwin'
+                                                    else 1024.0))
+    else:
+        proc.wait()
+    sampler.stop()
+    record['duration'] = round(time.time() - startedAt, 1)
+    record['exit'] = proc.returncode
+    record['samples'] = sampler.samples
+    try:
+        save_record(usageFile, record)
+    except OSError as x:
+        print('Cannot save resource usage to %s: %s' % (usageFile, x))
+    return proc.returncode
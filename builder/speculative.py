@@ -0,0 +1,110 @@
+import os
+import sys
+import time
+import signal
+import shutil
+import subprocess
+from . import config
+from .git import git_output
+
+# Kinds of background jobs that prepare for an upcoming build. Each kind
+# has a state file (<kind>.txt) and a log (<kind>.log) in the cache directory.
+SPECULATIVE_BUILD = 'speculative-build'
+WARMUP = 'warmup'
+KINDS = [SPECULATIVE_BUILD, WARMUP]
+
+
+def state_path(kind, ctx=None):
+    ctx = ctx or config.context()
+    return os.path.join(ctx.cacheDir, kind + '.txt')
+
+
+def is_running(pid):
+    try:
+        # Reap it if it was started by this process.
+        if os.waitpid(pid, os.WNOHANG)[0] == pid: return False
+    except ChildProcessError:
+        pass
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def start(commandLine, commit, ctx=None, kind=SPECULATIVE_BUILD, lowPriority=False):
+    """Starts a background job for `commit`, replacing any earlier job of
+    the same kind. Not supported on Windows.
+
+    Arguments:
+        commandLine: Shell command of the job.
+        commit:      Commit that the upcoming build is expected to be at.
+        kind:        SPECULATIVE_BUILD or WARMUP.
+        lowPriority: Run with the lowest CPU and I/O priority.
+    """
+    ctx = ctx or config.context()
+    if sys.platform == 'win32': return
+    discard(ctx, kind)
+    if not os.path.exists(ctx.cacheDir): os.makedirs(ctx.cacheDir)
+    log = open(os.path.join(ctx.cacheDir, kind + '.log'), 'wt')
+    if lowPriority:
+        commandLine = 'nice -n 19 ' + commandLine
+        if shutil.which('ionice'):
+            commandLine = 'ionice -c 3 ' + commandLine
+    # The job gets its own process group so it can be stopped as a whole.
+    proc = subprocess.Popen(commandLine, shell=True, stdout=log, stderr=subprocess.STDOUT,
+                            start_new_session=True)
+    print('%i %s' % (proc.pid, commit), file=open(state_path(kind, ctx), 'wt'))
+    print('Started %s of %s (pid %i)' % (kind, commit, proc.pid))
+
+
+def current(ctx=None, kind=SPECULATIVE_BUILD):
+    """Returns (pid, commit) of the running job of a kind, or None."""
+    ctx = ctx or config.context()
+    path = state_path(kind, ctx)
+    if not os.path.exists(path): return None
+    pid, commit = open(path, 'rt').read().split()
+    if not is_running(int(pid)):
+        os.remove(path)
+        return None
+    return int(pid), commit
+
+
+def discard(ctx=None, kind=SPECULATIVE_BUILD):
+    """Stops the running job of a kind, if any."""
+    running = current(ctx, kind)
+    if not running: return
+    print('Discarding the %s of %s' % (kind, running[1]))
+    try:
+        os.killpg(running[0], signal.SIGTERM)
+    except OSError:
+        pass
+    while is_running(running[0]):
+        time.sleep(1)
+    os.remove(state_path(kind, ctx))
+
+
+def adopt(ref, ctx=None):
+    """Called before building `ref`. If a speculative build or a warm-up of
+    the same commit is running, waits for it to finish: the packages of a
+    speculative build are then in the artifact cache, and the build
+    directories are up to date. Jobs for any other commit are discarded.
+
+    Returns:
+        True if a speculative build was adopted.
+    """
+    ctx = ctx or config.context()
+    adopted = False
+    for kind in KINDS:
+        running = current(ctx, kind)
+        if not running: continue
+        commit = git_output(['rev-parse', ref + '^{commit}'], ctx.doomsdayDir)
+        if commit != running[1]:
+            discard(ctx, kind)
+            continue
+        print('Waiting for the %s of %s to finish...' % (kind, commit))
+        while is_running(running[0]):
+            time.sleep(5)
+        if os.path.exists(state_path(kind, ctx)): os.remove(state_path(kind, ctx))
+        adopted = adopted or kind == SPECULATIVE_BUILD
+    return adopted
@@ -0,0 +1,179 @@
+import os
+import sys
+import errno
+import shutil
+import hashlib
+import threading
+from . import config
+
+# Files smaller than this are copied rather than stored (logs and such).
+STORE_MIN_SIZE = 1024 * 1024
+
+# ioctl that makes a file share the blocks of another (Btrfs, XFS).
+FICLONE = 0x40049409
+
+
+def reflink(src, dst):
+    """Makes `dst` a copy-on-write clone of `src`. Returns False if the
+    file system does not support it."""
+    if not sys.platform.startswith('linux'): return False
+    import fcntl
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            return True
+        except OSError:
+            return False
+
+
+def copy_range(src, dst):
+    """Copies the contents in the kernel without passing them through user
+    space. Returns False if not possible."""
+    if not hasattr(os, 'copy_file_range'): return False
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        remaining = os.fstat(s.fileno()).st_size
+        try:
+            while remaining > 0:
+                count = os.copy_file_range(s.fileno(), d.fileno(), remaining)
+                if count == 0: break
+                remaining -= count
+        except OSError:
+            return False
+        return remaining == 0
+
+
+def fast_copy(src, dst):
+    """Copies a file and its timestamps, cloning it if the file system
+    supports that."""
+    if not reflink(src, dst) and not copy_range(src, dst):
+        shutil.copyfile(src, dst)
+    shutil.copystat(src, dst)
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data: break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def temp_name(path):
+    # Unique for each thread, as files are placed in parallel.
+    return '%s.%i-%i.tmp' % (path, os.getpid(), threading.get_ident())
+
+
+def device_of(path):
+    """Device of the file system where `path` is or would be created."""
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path: break
+        path = parent
+    return os.stat(path).st_dev
+
+
+def replace_with_link(target, dst):
+    """Makes `dst` a hard link of `target`, or a copy if they are on
+    different file systems. Readers never see a partial file."""
+    dstDir = os.path.dirname(dst)
+    if dstDir and not os.path.exists(dstDir): os.makedirs(dstDir)
+    tmpName = temp_name(dst)
+    try:
+        os.link(target, tmpName)
+    except OSError as x:
+        if x.errno not in [errno.EXDEV, errno.EMLINK, errno.EPERM]: raise
+        fast_copy(target, tmpName)
+    os.replace(tmpName, dst)
+
+
+class ContentStore:
+    """Files kept once by their contents, in the cache directory.
+
+    Published files (packages in the event and apt directories) are hard
+    links to the stored copy, so identical files take up space only once.
+    Published files must therefore never be modified in place, only
+    replaced. Destinations on another file system than the store get plain
+    copies."""
+
+    def __init__(self, ctx=None):
+        ctx = ctx or config.context()
+        self.path = os.path.join(ctx.cacheDir, 'store')
+
+    def object_path(self, digest):
+        return os.path.join(self.path, digest[:2], digest[2:])
+
+    def ingest(self, src):
+        """Adds a file to the store, unless it is already there.
+
+        Returns:
+            Path of the stored file.
+        """
+        objPath = self.object_path(file_digest(src))
+        if not os.path.exists(objPath):
+            os.makedirs(os.path.dirname(objPath), exist_ok=True)
+            tmpName = temp_name(objPath)
+            # A clone, not a link: the source may still be rewritten.
+            fast_copy(src, tmpName)
+            os.replace(tmpName, objPath)
+        return objPath
+
+    def place(self, src, dst):
+        """Copies `src` to `dst` via the store."""
+        if os.path.getsize(src) < STORE_MIN_SIZE or \
+                device_of(dst) != device_of(self.path):
+            # Linking is not possible or not worth it.
+            dstDir = os.path.dirname(dst)
+            if dstDir and not os.path.exists(dstDir): os.makedirs(dstDir)
+            tmpName = temp_name(dst)
+            fast_copy(src, tmpName)
+            os.replace(tmpName, dst)
+            return
+        objPath = self.ingest(src)
+        if os.path.exists(dst) and os.path.samefile(objPath, dst):
+            return
+        replace_with_link(objPath, dst)
+
+    def prune(self):
+        """Removes stored files that are no longer published anywhere.
+
+        Returns:
+            Number of bytes freed.
+        """
+        freed = 0
+        if not os.path.exists(self.path): return freed
+        for root, dirs, names in os.walk(self.path):
+            for name in names:
+                path = os.path.join(root, name)
+                st = os.stat(path)
+                if st.st_nlink == 1 and not name.endswith('.tmp'):
+                    os.remove(path)
+                    freed += st.st_size
+        return freed
+
+
+def link_tree(srcDir, dstDir):
+    """Mirrors a directory tree with hard links, copying only where linking
+    is not possible. Files missing from `srcDir` are removed from
+    `dstDir`."""
+    present = set()
+    for root, dirs, names in os.walk(srcDir):
+        relRoot = os.path.relpath(root, srcDir)
+        for name in names:
+            rel = os.path.normpath(os.path.join(relRoot, name))
+            present.add(rel)
+            src = os.path.join(srcDir, rel)
+            dst = os.path.join(dstDir, rel)
+            if os.path.exists(dst):
+                srcStat, dstStat = os.stat(src), os.stat(dst)
+                if os.path.samestat(srcStat, dstStat) or \
+                        (srcStat.st_size == dstStat.st_size and
+                         int(srcStat.st_mtime) == int(dstStat.st_mtime)):
+                    continue
+            replace_with_link(src, dst)
+    for root, dirs, names in os.walk(dstDir):
+        for name in names:
+            path = os.path.join(root, name)
+            if os.path.normpath(os.path.relpath(path, dstDir)) not in present:
+                os.remove(path)
@@ -0,0 +1,154 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+from . import config
+from .store import ContentStore
+
+# Files copied at the same time.
+TRANSFER_STREAMS = 4
+# Attempts per file before giving up.
+TRANSFER_ATTEMPTS = 3
+
+
+def split_target(path):
+    """Splits an scp-style target "[user@]host:path" into (host, path). The
+    host is None for local paths (including Windows drive letters)."""
+    path = path.replace('\\', '/')
+    colon = path.find(':')
+    if colon <= 1 or '/' in path[:colon]:
+        return None, path
+    return path[:colon], path[colon + 1:]
+
+
+class Transfer:
+    """Batch of files to copy to local directories or remote hosts.
+
+    All copies to a remote host go through one multiplexed SSH connection
+    (ControlMaster), so there is only one handshake per host. Files are
+    copied in parallel streams with rsync if it is available, otherwise with
+    scp. Failed copies are retried. Local copies go via the content store
+    (see store.ContentStore).
+    """
+
+    def __init__(self, streams=TRANSFER_STREAMS, attempts=TRANSFER_ATTEMPTS, ctx=None):
+        self.ctx = ctx or config.context()
+        self.streams = streams
+        self.attempts = attempts
+        self.files = [] # (src, dst)
+        self.results = []
+        self.controlDir = None
+        self.connected = set() # hosts with a master connection
+
+    def add(self, src, dst):
+        self.files.append((src, dst))
+
+    def ssh_options(self, host):
+        if host not in self.connected:
+            return []
+        return ['-o', 'ControlMaster=no',
+                '-o', 'ControlPath=' + os.path.join(self.controlDir, '%C')]
+
+    def open_connection(self, host):
+        """Starts the master connection to a host. Returns True if the
+        copies can use it."""
+        return subprocess.call(['ssh', '-o', 'ControlMaster=yes', '-o', 'ControlPersist=yes',
+                                '-o', 'ControlPath=' + os.path.join(self.controlDir, '%C'),
+                                '-o', 'BatchMode=yes', '-fN', host]) == 0
+
+    def close_connection(self, host):
+        subprocess.call(['ssh', '-o', 'ControlPath=' + os.path.join(self.controlDir, '%C'),
+                         '-O', 'exit', host], stderr=subprocess.DEVNULL)
+
+    def copy_local(self, src, dst):
+        # Large files are linked to a single stored copy.
+        ContentStore(self.ctx).place(src, dst)
+
+    def copy_remote(self, src, host, path):
+        if shutil.which('rsync'):
+            cmd = ['rsync', '--times', '--partial']
+            if self.ssh_options(host):
+                cmd += ['-e', ' '.join(['ssh'] + self.ssh_options(host))]
+            cmd += [src, '%s:%s' % (host, path)]
+        else:
+            cmd = ['scp', '-q', '-p'] + self.ssh_options(host) + [src, '%s:%s' % (host, path)]
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if proc.returncode:
+            raise Exception(proc.stdout.decode('utf-8', 'replace').strip() or
+                            '%s returned error code %i' % (cmd[0], proc.returncode))
+
+    def copy(self, src, dst):
+        """Copies one file, retrying if necessary. Returns the result."""
+        result = {'src': src, 'dst': dst, 'ok': False, 'bytes': 0, 'seconds': 0.0,
+                  'attempts': 0, 'error': None}
+        if not os.path.exists(src):
+            result['error'] = 'missing'
+            return result
+        result['bytes'] = os.path.getsize(src)
+        host, path = split_target(dst)
+        while result['attempts'] < self.attempts:
+            result['attempts'] += 1
+            startedAt = time.time()
+            try:
+                if host:
+                    self.copy_remote(src, host, path)
+                else:
+                    self.copy_local(src, path)
+                result['ok'] = True
+                result['seconds'] = time.time() - startedAt
+                break
+            except Exception as x:
+                result['error'] = str(x)
+                if result['attempts'] < self.attempts:
+                    time.sleep(2 ** result['attempts'])
+        return result
+
+    def run(self):
+        """Copies all the files and prints the status of each.
+
+        Returns:
+            List of results: dicts with 'src', 'dst', 'ok', 'bytes',
+            'seconds', 'attempts' and 'error'. Raises an exception if any
+            file could not be copied.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        hosts = set(filter(None, [split_target(dst)[0] for src, dst in self.files]))
+        startedAt = time.time()
+        if hosts and sys.platform != 'win32':
+            # Without a master connection, each copy makes its own.
+            self.controlDir = tempfile.mkdtemp(prefix='transfer-')
+            self.connected = set(host for host in hosts if self.open_connection(host))
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, self.streams)) as pool:
+                self.results = list(pool.map(lambda f: self.copy(*f), self.files))
+        finally:
+            for host in self.connected:
+                self.close_connection(host)
+            self.connected = set()
+            if self.controlDir:
+                shutil.rmtree(self.controlDir, True)
+                self.controlDir = None
+        self.report(time.time() - startedAt)
+        failed = [r for r in self.results if not r['ok']]
+        if failed:
+            raise Exception("Failed to copy %s" % ', '.join(
+                '%s (%s)' % (os.path.basename(r['src']), r['error']) for r in failed))
+        return self.results
+
+    def report(self, duration):
+        total = 0
+        for r in self.results:
+            status = 'ok' if r['ok'] else 'FAILED'
+            if r['attempts'] > 1: status += ' (%i attempts)' % r['attempts']
+            rate = ''
+            if r['ok'] and r['seconds'] > 0:
+                rate = ' %.1f MB/s' % (r['bytes'] / r['seconds'] / 1e6)
+            print('  %-50s %9.1f KB%s %s' % (os.path.basename(r['dst']), r['bytes'] / 1e3,
+                                            rate, status))
+            if r['ok']: total += r['bytes']
+        if self.results:
+            print('Copied %i of %i files (%.1f MB) in %.1f seconds' % \
+                  (len([r for r in self.results if r['ok']]), len(self.results),
+                   total / 1e6, duration))
@@ -0,0 +1,287 @@
+import os
+import sys
+import hashlib
+import shutil
+import subprocess
+import time
+from . import config
+
+# Settings that are tuned, in the order they are tried. None means the
+# default of CMake or of the project. The number of parallel jobs is not
+# tuned: it is not a CMake option, and platform_release.py decides it from
+# the cores and memory of each builder.
+DIMENSIONS = ['generator', 'unity', 'pch', 'linkpool']
+
+# Options that every release build has (see platform_release.py).
+RELEASE_OPTIONS = '-DCMAKE_BUILD_TYPE=Release'
+
+# A setting is only changed if it makes the build this much faster, so
+# that noise in the timings does not change the settings.
+MIN_IMPROVEMENT = 0.03
+
+
+def options_path(ctx=None):
+    ctx = ctx or config.context()
+    return os.path.join(ctx.distribDir, 'cmake.%s.rsp' % ctx.branch)
+
+
+def read_option_sets(ctx=None):
+    """Returns the configurations of the branch's CMake options file."""
+    try:
+        opts = open(options_path(ctx), 'rt').read().replace('\n', ' ')
+    except OSError:
+        opts = ''
+    return list(map(str.strip, opts.split('-----')))
+
+
+def candidate_values(dimension):
+    """Values of a setting that are worth measuring on this machine."""
+    cpus = os.cpu_count() or 1
+    if dimension == 'generator':
+        # The default is Unix Makefiles, or Visual Studio on Windows.
+        if sys.platform == 'win32': return [None]
+        return [None] + (['Ninja'] if shutil.which('ninja') else [])
+    if dimension == 'unity':
+        return [None, 'ON']
+    if dimension == 'pch':
+        return [None, 'ON', 'OFF']
+    if dimension == 'linkpool':
+        return [None] + sorted(set([1, max(1, cpus // 4), max(1, cpus // 2)]))
+    raise Exception("Unknown setting: " + dimension)
+
+
+def applicable(settings):
+    # Job pools are a Ninja feature.
+    return settings['linkpool'] is None or settings['generator'] == 'Ninja'
+
+
+def cmake_options(settings):
+    """CMake options for the tuned settings."""
+    opts = []
+    if settings['generator']:
+        opts.append('-G "%s"' % settings['generator'])
+    if settings['unity']:
+        opts.append('-DCMAKE_UNITY_BUILD=%s' % settings['unity'])
+    if settings['pch']:
+        # Precompiled headers via cotire; the option was renamed in 3.0.
+        opts.append('-DDENG_ENABLE_COTIRE=%s -DDE_ENABLE_COTIRE=%s' % \
+                    (settings['pch'], settings['pch']))
+    if settings['linkpool']:
+        opts.append('-DCMAKE_JOB_POOLS=link=%i -DCMAKE_JOB_POOL_LINK=link' % settings['linkpool'])
+    return ' '.join(opts)
+
+
+def describe(settings):
+    return ', '.join(['%s=%s' % (dim, settings[dim]) for dim in DIMENSIONS
+                      if settings[dim] is not None]) or 'defaults'
+
+
+def run_measured(cmd, cwd, log):
+    """Runs a shell command.
+
+    Returns:
+        Tuple (exit code, peak resident set size of the process tree in
+        megabytes or None if not available).
+    """
+    env = dict(os.environ)
+    # Cached compilations would make the timings meaningless.
+    env['CCACHE_DISABLE'] = '1'
+    # __DATE__ and __TIME__ must not make the outputs differ.
+    env['SOURCE_DATE_EPOCH'] = '0'
+    print('>', cmd, file=log)
+    log.flush()
+    proc = subprocess.Popen(cmd, shell=True, cwd=cwd, stdout=log, stderr=subprocess.STDOUT,
+                            env=env)
+    if not hasattr(os, 'wait4'):
+        return proc.wait(), None
+    # The usage includes all descendants waited for by the process.
+    pid, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    # Kilobytes on Linux, bytes on macOS.
+    rss = usage.ru_maxrss / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0)
+    return proc.returncode, rss
+
+
+def installed_files(installDir):
+    """Returns a dict of the installed files. The values are tuples
+    (is binary, hash of the contents)."""
+    files = {}
+    for root, dirs, names in os.walk(installDir):
+        for name in names:
+            path = os.path.join(root, name)
+            digest = hashlib.sha1()
+            binary = False
+            if os.path.islink(path):
+                digest.update(os.readlink(path).encode('utf-8'))
+            else:
+                with open(path, 'rb') as f:
+                    for block in iter(lambda: f.read(1 << 20), b''):
+                        # Text files do not contain null bytes.
+                        binary = binary or b'\0' in block
+                        digest.update(block)
+            files[os.path.relpath(path, installDir)] = (binary, digest.hexdigest())
+    return files
+
+
+def compare_outputs(a, b):
+    """Compares two installations. Binaries built with different settings
+    (unity builds, precompiled headers, link order) are rarely identical
+    byte for byte, so they are only reported.
+
+    Returns:
+        Tuple (names of files that are missing from either installation or
+        are text files with different contents, names of binaries with
+        different contents).
+    """
+    different, binaries = [], []
+    for name in sorted(set(a) | set(b)):
+        if a.get(name) == b.get(name):
+            continue
+        if name in a and name in b and a[name][0] and b[name][0]:
+            binaries.append(name)
+        else:
+            different.append(name)
+    return different, binaries
+
+
+def list_names(names, count=5):
+    return ', '.join(names[:count]) + (', ...' if len(names) > count else '')
+
+
+class Benchmark:
+    """Clean builds of one configuration with different settings. Each
+    build is installed so that the outputs can be compared."""
+
+    def __init__(self, sourceDir, workDir, options):
+        self.sourceDir = sourceDir
+        self.workDir = workDir
+        self.options = options
+        self.jobs = os.cpu_count() or 1
+        self.results = {}
+        self.count = 0
+
+    def measure(self, settings):
+        """Builds with the settings, unless already measured.
+
+        Returns:
+            Dict with 'settings', 'ok', 'seconds' (configure and build),
+            'rss' (peak megabytes), 'files' (see installed_files()) and
+            'differingBinaries' (filled in by tune_configuration()).
+        """
+        key = tuple(settings[dim] for dim in DIMENSIONS)
+        if key in self.results:
+            return self.results[key]
+        self.count += 1
+        buildDir = os.path.join(self.workDir, 'build')
+        installDir = os.path.join(self.workDir, 'install')
+        for path in [buildDir, installDir]:
+            if os.path.exists(path): shutil.rmtree(path, True)
+        os.makedirs(buildDir)
+        result = {'settings': dict(settings), 'ok': False, 'seconds': None, 'rss': None,
+                  'files': None, 'differingBinaries': []}
+        log = open(os.path.join(self.workDir, 'tune%i.log' % self.count), 'wt')
+        try:
+            startedAt = time.time()
+            rss = []
+            for cmd in ['cmake %s %s %s "%s"' % (self.options, RELEASE_OPTIONS,
+                                                 cmake_options(settings), self.sourceDir),
+                        'cmake --build . --config Release --parallel %i' % self.jobs]:
+                code, peak = run_measured(cmd, buildDir, log)
+                if peak is not None: rss.append(peak)
+                if code: break
+            else:
+                result['seconds'] = time.time() - startedAt
+                result['rss'] = max(rss) if rss else None
+                if run_measured('cmake --install . --config Release --prefix "%s"' % installDir,
+                                buildDir, log)[0] == 0:
+                    result['files'] = installed_files(installDir)
+                    result['ok'] = True
+        finally:
+            log.close()
+        print('  %-55s %s' % (describe(settings), format_result(result)))
+        self.results[key] = result
+        return result
+
+
+def format_result(result):
+    if not result['ok']: return 'failed'
+    msg = '%7.1f s' % result['seconds']
+    if result['rss'] is not None: msg += ' %7.0f MB' % result['rss']
+    return msg
+
+
+def tune_configuration(sourceDir, workDir, options, dimensions):
+    """Finds the fastest settings for building one configuration. The
+    settings are tuned one at a time, starting from the current ones. A
+    setting is only changed if the build installs the same files, with the
+    same contents apart from binaries (see compare_outputs()).
+
+    Returns:
+        Tuple (baseline result, best result).
+    """
+    bench = Benchmark(sourceDir, workDir, options)
+    current = dict([(dim, None) for dim in DIMENSIONS])
+    baseline = bench.measure(current)
+    if not baseline['ok']:
+        raise Exception("Build with the current settings failed (see %s)" % workDir)
+    best = baseline
+    for dim in dimensions:
+        for value in candidate_values(dim):
+            settings = dict(current)
+            settings[dim] = value
+            if not applicable(settings): continue
+            result = bench.measure(settings)
+            if not result['ok']:
+                continue
+            different, binaries = compare_outputs(result['files'], baseline['files'])
+            if different:
+                print('  (output differs from the current settings, rejected: %s)' % \
+                      list_names(different))
+                continue
+            result['differingBinaries'] = binaries
+            if binaries:
+                print('  (binaries differ from the current settings: %s)' % list_names(binaries))
+            if result['seconds'] < best['seconds'] * (1 - MIN_IMPROVEMENT):
+                best = result
+        current = dict(best['settings'])
+    return baseline, best
+
+
+def tune(sourceDir, workDir, dimensions=DIMENSIONS, ctx=None):
+    """Measures build settings for each configuration of the branch's CMake
+    options file. The options with the best settings are written to
+    cmake.<branch>.rsp.suggested and a summary to tune.<branch>.txt in the
+    cache directory, for copying to the distrib directory by hand.
+
+    Returns:
+        Path of the suggested options file.
+    """
+    ctx = ctx or config.context()
+    optionSets = read_option_sets(ctx)
+    suggested = []
+    report = []
+    for index, options in enumerate(optionSets):
+        print('Tuning configuration %i: %s' % (index, options or 'default options'))
+        baseline, best = tune_configuration(sourceDir, os.path.join(workDir, 'config%i' % index),
+                                            options, dimensions)
+        suggested.append(' '.join(filter(None, [options, cmake_options(best['settings'])])))
+        report.append('Configuration %i: %s' % (index, options or 'default options'))
+        report.append('  current:   %-55s %s' % (describe(baseline['settings']),
+                                                 format_result(baseline)))
+        report.append('  suggested: %-55s %s' % (describe(best['settings']),
+                                                 format_result(best)))
+        if best['rss'] is not None:
+            report.append('  largest process: %.0f MB' % best['rss'])
+        binaries = best['differingBinaries']
+        if binaries:
+            report.append('  outputs: same files, %i binaries differ (%s)' % \
+                          (len(binaries), list_names(binaries)))
+        elif best is not baseline:
+            report.append('  outputs: identical')
+    if not os.path.exists(ctx.cacheDir): os.makedirs(ctx.cacheDir)
+    path = os.path.join(ctx.cacheDir, os.path.basename(options_path(ctx)) + '.suggested')
+    open(path, 'wt').write('\n-----\n'.join(suggested) + '\n')
+    report = '\n'.join(report)
+    open(os.path.join(ctx.cacheDir, 'tune.%s.txt' % ctx.branch), 'wt').write(report + '\n')
+    print(report)
+    return path
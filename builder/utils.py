@@ -3,7 +3,6 @@ import shutil
 import subprocess
 import string
 import glob
-import gzip
 import codecs
 import time
 import build_number
@@ -97,8 +96,12 @@ def sys_id():
 
 
 def remote_copy(src, dst):
-    dst = dst.replace('\\', '/')
-    os.system('scp %s %s' % (src, dst))
+    """Copies a single file to a local or remote (scp-style) destination.
+    To copy several files, use builder.transfer.Transfer."""
+    from .transfer import Transfer
+    transfer = Transfer()
+    transfer.add(src, dst)
+    transfer.run()
 
 
 def collated(s):
@@ -114,24 +117,32 @@ def todays_build_tag():
 
 
 def deb_arch():
-    os.system('dpkg --print-architecture > __debarch.tmp')
-    arch = open('__debarch.tmp', 'rt').read().strip()
-    os.remove('__debarch.tmp')
-    return arch
+    return subprocess.check_output(['dpkg', '--print-architecture']).decode('utf-8').strip()
 
 
-def aptrepo_by_time():
+def deb_distribution():
+    """Returns the codename of the host distribution (e.g., "focal"). This
+    is the distribution a released Debian changelog entry is targeted at."""
+    try:
+        return subprocess.check_output(['lsb_release', '-cs']).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unstable'
+
+
+def aptrepo_by_time(ctx=None):
+    ctx = ctx or config.context()
     files = []
-    for fn in os.listdir(os.path.join(config.APT_REPO_DIR,
+    for fn in os.listdir(os.path.join(ctx.aptRepoDir,
                                       'dists/unstable/main/binary-' + deb_arch())):
         if fn[-4:] == '.deb':
             files.append(fn)
     return files
 
 
-def aptrepo_find_latest_tag():
-    debs = aptrepo_by_time()
-    if not debs: return config.BRANCH
+def aptrepo_find_latest_tag(ctx=None):
+    ctx = ctx or config.context()
+    debs = aptrepo_by_time(ctx)
+    if not debs: return ctx.branch
     arch = deb_arch()
     biggest = 0
     for deb in debs:
@@ -141,6 +152,7 @@ def aptrepo_find_latest_tag():
 
 
 def count_log_word(fn, word):
+    import gzip
     count = 0
     try:
         for txt in [str(rl, 'latin1').lower() for rl in string.split(gzip.open(fn).read(), '\n')]:
@@ -215,8 +227,45 @@ def version_cmp(a, b):
     return 0
 
 
-def system_command(cmd):
-    result = subprocess.call(cmd, shell=True)
+# Files that a build reads first.
+SOURCE_EXTENSIONS = ['.h', '.hh', '.hpp', '.hxx', '.inl', '.c', '.cc', '.cpp', '.cxx',
+                     '.m', '.mm', '.cmake', '.txt']
+
+
+def preread_files(path, extensions=SOURCE_EXTENSIONS):
+    """Loads the source files under `path` into the operating system's
+    disk cache. Returns the number of files."""
+    count = 0
+    for root, dirs, names in os.walk(path):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for name in names:
+            if os.path.splitext(name)[1].lower() not in extensions: continue
+            try:
+                f = open(os.path.join(root, name), 'rb')
+            except OSError:
+                continue
+            if hasattr(os, 'posix_fadvise'):
+                # Read ahead asynchronously without copying the data.
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            else:
+                while f.read(1 << 20): pass
+            f.close()
+            count += 1
+    return count
+
+
+def system_command(cmd, cwd=None, usage=None):
+    """Runs a shell command. Raises an exception if it fails.
+
+    Arguments:
+        usage: File where the command's resource usage is recorded
+               (see builder.resources), or None.
+    """
+    if usage:
+        from . import resources
+        result = resources.run_sampled(cmd, usage, cwd=cwd)
+    else:
+        result = subprocess.call(cmd, shell=True, cwd=cwd)
     if result != 0:
         raise Exception("System command \"%s\" returned error code %i" % (cmd, result))
 
@@ -228,5 +277,5 @@ def python3_executable():
         return '/usr/bin/env python3'  # required by Snowberry
 
 
-def run_python3(script):
-    system_command(python3_executable() + " " + script)
+def run_python3(script, cwd=None, usage=None):
+    system_command(python3_executable() + " " + script, cwd=cwd, usage=usage)
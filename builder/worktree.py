@@ -0,0 +1,166 @@
+import os
+import shutil
+import subprocess
+from contextlib import contextmanager
+from . import config
+from .git import git_checkout, git_output, run_git_in
+from .mirror import submodule_update
+
+
+def task_dir_path(ref, task, ctx=None):
+    """Directory where a task's worktree and outputs are kept."""
+    ctx = ctx or config.context()
+    return os.path.join(ctx.worktreeDir, '%s-%s' % (ref.replace('/', '_'), task))
+
+
+def worktree_add(path, ref, ctx=None):
+    """Creates a new worktree of the Doomsday repository at `path`, with
+    `ref` checked out (detached) and submodules updated. The worktree
+    shares the object store of the main repository, and the submodules come
+    from the local mirrors if they are enabled (--mirrors)."""
+    ctx = ctx or config.context()
+    if os.path.exists(path):
+        worktree_remove(path, ctx)
+    print('Creating worktree for %s in %s...' % (ref, path))
+    run_git_in(ctx.doomsdayDir, ['worktree', 'add', '--detach', path, ref])
+    submodule_update(path, ctx)
+
+
+def worktree_checkout(path, ref, ctx=None):
+    """Switches an existing worktree to `ref` in place. Files that do not
+    change keep their timestamps, so incremental builds of the worktree
+    only recompile what changed."""
+    ctx = ctx or config.context()
+    print('Checking out %s in %s...' % (ref, path))
+    run_git_in(path, ['checkout', '--force', '--detach', ref])
+    run_git_in(path, ['clean', '-fdx'])
+    submodule_update(path, ctx)
+
+
+def worktree_remove(path, ctx=None):
+    ctx = ctx or config.context()
+    print('Removing worktree %s...' % path)
+    subprocess.call(['git', 'worktree', 'remove', '--force', path], cwd=ctx.doomsdayDir)
+    if os.path.exists(path):
+        shutil.rmtree(path, True)
+    worktree_prune(ctx)
+
+
+def worktree_prune(ctx=None):
+    """Forgets worktrees whose directories no longer exist."""
+    ctx = ctx or config.context()
+    subprocess.call(['git', 'worktree', 'prune'], cwd=ctx.doomsdayDir)
+
+
+def prepared_path(taskDir):
+    return os.path.join(taskDir, 'prepared-commit.txt')
+
+
+def new_task_dir(taskDir, ref, ctx):
+    srcDir = os.path.join(taskDir, 'src')
+    if os.path.exists(taskDir):
+        worktree_remove(srcDir, ctx)
+        shutil.rmtree(taskDir, True)
+    os.makedirs(taskDir)
+    worktree_add(srcDir, ref, ctx)
+
+
+def switch_task_dir(taskDir, ref, ctx):
+    """Switches the worktree of a persistent task directory to `ref`. It is
+    created anew if missing or if switching fails, for example after an
+    earlier job was stopped in the middle of a checkout."""
+    srcDir = os.path.join(taskDir, 'src')
+    if os.path.exists(os.path.join(srcDir, '.git')):
+        try:
+            worktree_checkout(srcDir, ref, ctx)
+            return
+        except Exception as x:
+            print('Cannot reuse the worktree:', x)
+    new_task_dir(taskDir, ref, ctx)
+
+
+def prepare_task_source(ref, task, commit, persistent=False, ctx=None):
+    """Creates the worktree of a task in advance, with `commit` checked out.
+    task_source() uses the worktree as is if `ref` turns out to be at the
+    same commit. Requires worktrees (--worktrees). See task_source() for
+    `persistent`.
+
+    Returns:
+        Tuple (source root directory, task directory).
+    """
+    ctx = ctx or config.context()
+    taskDir = task_dir_path(ctx.branch if persistent else ref, task, ctx)
+    srcDir = os.path.join(taskDir, 'src')
+    if persistent:
+        switch_task_dir(taskDir, commit, ctx)
+    else:
+        new_task_dir(taskDir, commit, ctx)
+    print(commit, file=open(prepared_path(taskDir), 'wt'))
+    return srcDir, taskDir
+
+
+def is_prepared(taskDir, ref, ctx):
+    if not os.path.exists(prepared_path(taskDir)): return False
+    commit = open(prepared_path(taskDir), 'rt').read().strip()
+    return commit == git_output(['rev-parse', ref + '^{commit}'], ctx.doomsdayDir)
+
+
+def clear_task_dir(taskDir):
+    """Removes everything but the worktree from a task directory."""
+    for name in os.listdir(taskDir):
+        path = os.path.join(taskDir, name)
+        if name == 'src':
+            continue
+        if os.path.isdir(path):
+            shutil.rmtree(path, True)
+        else:
+            os.remove(path)
+
+
+@contextmanager
+def task_source(ref, task, persistent=False, ctx=None):
+    """Provides the Doomsday source tree at `ref` for carrying out a task.
+
+    When worktrees are enabled (--worktrees), each ref and task gets its own
+    worktree and task directory, which are removed afterwards. Otherwise the
+    shared checkout is switched to `ref` and back to the branch, and the
+    distrib directory is used as the task directory.
+
+    With `persistent`, the branch and task share one worktree that is kept
+    between runs and switched to `ref` in place. Its path and the
+    timestamps of unchanged files stay the same, so incremental builds in
+    it remain incremental. Outputs left in the worktree are removed only
+    by the next run; the rest of the task directory is cleared afterwards.
+
+    Yields:
+        Tuple (source root directory, task directory).
+    """
+    ctx = ctx or config.context()
+    if not ctx.worktreeDir:
+        git_checkout(ref, ctx)
+        try:
+            yield (ctx.doomsdayDir, ctx.distribDir)
+        finally:
+            git_checkout(ctx.branch, ctx)
+        return
+
+    taskDir = task_dir_path(ctx.branch if persistent else ref, task, ctx)
+    srcDir = os.path.join(taskDir, 'src')
+    if ref == ctx.branch:
+        # Only the remote-tracking branch is kept up to date.
+        ref = 'origin/' + ref
+    if is_prepared(taskDir, ref, ctx):
+        print('Using the prepared worktree', srcDir)
+        os.remove(prepared_path(taskDir))
+    elif persistent:
+        switch_task_dir(taskDir, ref, ctx)
+    else:
+        new_task_dir(taskDir, ref, ctx)
+    try:
+        yield (srcDir, taskDir)
+    finally:
+        if persistent:
+            clear_task_dir(taskDir)
+        else:
+            worktree_remove(srcDir, ctx)
+            shutil.rmtree(taskDir, True)
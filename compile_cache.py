@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# Compiler launcher that shares compilation work via the build pilot.
+# Usage: compile_cache.py [--timings file] [--basedir dir]... compiler [arguments]
+#
+# With --timings, the duration of the command is appended to the file as a
+# line: kind (compile/link), seconds, source or output file, output file.
+#
+# Paths under a --basedir (the source root and the build directory) do not
+# affect the object identifiers, so the same sources compiled in another
+# checkout or on another builder use the same cached objects. Like
+# CCACHE_BASEDIR, but the compiler is also told to map the base directories
+# to "." in the objects (-ffile-prefix-map) when it supports that.
+#
+# The pilot server is given in environment variables ("host:port"):
+#
+# PILOT_OBJCACHE: Objects are identified by a hash of the compiler, the
+#   compiler arguments and the preprocessed source. If the server already
+#   has the object, it is used instead of compiling. Otherwise the object is
+#   sent to the server after compiling.
+# PILOT_DISTCC: The preprocessed source is sent via the server to an idle
+#   client with the same toolchain, which compiles it.
+#
+# Any problem with the pilot falls back to plain local compilation.
+
+import sys
+import os
+import time
+import json
+import hashlib
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Launchers that may precede the actual compiler on the command line.
+LAUNCHERS = ['ccache', 'sccache']
+
+SOURCE_SUFFIXES = {'.c': '.i', '.m': '.mi', '.mm': '.mii'} # others are C++: '.ii'
+
+# Preprocessor options (with a value) that are not needed for compiling
+# preprocessed source.
+PREPROCESSOR_OPTIONS = ['-I', '-D', '-U', '-include', '-imacros', '-isystem', '-iquote',
+                        '-idirafter', '-MF', '-MT', '-MQ']
+PREPROCESSOR_FLAGS = ['-MD', '-MMD', '-MP', '-M', '-MM']
+
+
+def compile_args(command):
+    """Finds the output object of a single-source compile command.
+
+    Returns:
+        Tuple (object path, command for preprocessing to stdout), or None
+        if the command cannot be cached.
+    """
+    if '-c' not in command or '-o' not in command:
+        return None
+    outPos = command.index('-o')
+    if outPos + 1 >= len(command):
+        return None
+    objPath = command[outPos + 1]
+    preprocess = command[:outPos] + command[outPos + 2:]
+    preprocess[preprocess.index('-c')] = '-E'
+    if ('-MD' in command or '-MMD' in command) and \
+            '-MT' not in command and '-MQ' not in command:
+        # The dependency file is written when preprocessing, which would
+        # name the object after the source instead.
+        preprocess += ['-MT', objPath]
+    return objPath, preprocess
+
+
+def strip_launchers(command):
+    while command and os.path.basename(command[0]) in LAUNCHERS:
+        command = command[1:]
+    return command
+
+
+def toolchain_cache_path():
+    return os.path.join(tempfile.gettempdir(), 'compile_cache-toolchains-%s.json' %
+                        (os.getenv('USER') or os.getenv('USERNAME') or 'user'))
+
+
+def probe_toolchain(compiler):
+    """Runs the compiler to find out its identity and features."""
+    try:
+        ident = subprocess.check_output([compiler, '--version'], stderr=subprocess.STDOUT) + \
+                subprocess.check_output([compiler, '-dumpmachine'], stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    prefixMap = subprocess.call([compiler, '-ffile-prefix-map=/=/', '-E', '-x', 'c', os.devnull],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+    return {'key': hashlib.sha1(sys.platform.encode('utf-8') + ident).hexdigest(),
+            'prefixMap': prefixMap}
+
+
+def toolchain_info(compiler):
+    """Returns a dict with the toolchain 'key' of the compiler, and whether
+    it supports -ffile-prefix-map ('prefixMap'), or None if the compiler is
+    not available. The results are cached on disk per compiler executable,
+    so that each compile does not run the compiler a few extra times."""
+    import shutil
+    exe = shutil.which(compiler)
+    if not exe:
+        return None
+    exe = os.path.realpath(exe)
+    st = os.stat(exe)
+    # A compiler replaced at the same path is probed again.
+    ident = '%s:%i:%i' % (exe, st.st_mtime_ns, st.st_size)
+    cachePath = toolchain_cache_path()
+    try:
+        cache = json.load(open(cachePath, 'rt'))
+    except (OSError, ValueError):
+        cache = {}
+    if ident not in cache:
+        cache[ident] = probe_toolchain(exe)
+        tmpName = '%s.%i.tmp' % (cachePath, os.getpid())
+        try:
+            json.dump(cache, open(tmpName, 'wt'))
+            os.replace(tmpName, cachePath)
+        except OSError:
+            pass
+    return cache[ident]
+
+
+def toolchain_key(compiler):
+    """Identifies a compiler and its target. Returns None if the compiler is
+    not available."""
+    info = toolchain_info(compiler)
+    return info['key'] if info else None
+
+
+def relocated(text, baseDirs):
+    """Replaces the base directories in a string or bytes with placeholders."""
+    # Nested directories are replaced first.
+    for i, base in enumerate(sorted(baseDirs, key=len, reverse=True)):
+        if isinstance(text, bytes):
+            text = text.replace(base.encode('utf-8'), b'<base%i>' % i)
+        elif text == base or text.startswith(base + os.sep):
+            text = '<base%i>' % i + text[len(base):]
+        else:
+            # Options like -I/path.
+            text = text.replace('=' + base, '=<base%i>' % i)
+            for opt in ['-I', '-isystem', '-iquote', '-include', '-MF', '-MT', '-MQ']:
+                if text.startswith(opt + base):
+                    text = opt + '<base%i>' % i + text[len(opt + base):]
+    return text
+
+
+def object_key(command, objPath, preprocessed, baseDirs=[]):
+    """Identifies the object compiled by `command`, or returns None if the
+    compiler is not available. Paths under `baseDirs` do not count."""
+    command = strip_launchers(command)
+    key = toolchain_key(command[0])
+    if not key:
+        return None
+    digest = hashlib.sha256()
+    digest.update(key.encode('utf-8') + b'\0')
+    # The output path does not affect the contents of the object.
+    for arg in command[1:]:
+        if arg != objPath:
+            digest.update(relocated(arg, baseDirs).encode('utf-8') + b'\0')
+    # Line markers and __FILE__ contain the full paths of the sources.
+    digest.update(relocated(preprocessed, baseDirs))
+    return digest.hexdigest()
+
+
+def prefix_map_args(command, baseDirs):
+    """Compiler options that map the base directories to "." in the
+    outputs, if the compiler supports them."""
+    if not baseDirs: return []
+    info = toolchain_info(strip_launchers(command)[0])
+    if not info or not info['prefixMap']: return []
+    return ['-ffile-prefix-map=%s=.' % base for base in baseDirs]
+
+
+def pilot_request(var, q):
+    import pilot
+    host, port = os.environ[var].rsplit(':', 1)
+    response = pilot.request(host, int(port), q)
+    if response.get('result') != 'ok':
+        raise Exception(response.get('error', 'request failed'))
+    return response
+
+
+def remote_job(command, preprocessed):
+    """Composes a compile job for the preprocessed source. Returns None if
+    the command is not suitable for compiling elsewhere."""
+    command = strip_launchers(command)
+    key = toolchain_key(command[0])
+    if not key:
+        return None
+    args = []
+    source = None
+    i = 1
+    while i < len(command):
+        arg = command[i]
+        if arg in ['-o'] + PREPROCESSOR_OPTIONS:
+            i += 2
+            continue
+        if arg == '-c' or arg in PREPROCESSOR_FLAGS or \
+                any(arg.startswith(opt) for opt in ['-I', '-D', '-U']):
+            i += 1
+            continue
+        if not arg.startswith('-') and os.path.isfile(arg):
+            source = arg
+        else:
+            args.append(arg)
+        i += 1
+    if source is None:
+        return None
+    suffix = SOURCE_SUFFIXES.get(os.path.splitext(source)[1], '.ii')
+    return {'key': key, 'args': args, 'source': preprocessed, 'suffix': suffix}
+
+
+def compile_preprocessed(compiler, job):
+    """Compiles a job's preprocessed source.
+
+    Returns:
+        Dictionary with the 'exit' code, the 'object' (bytes) and 'stderr'.
+    """
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmpDir:
+        srcPath = os.path.join(tmpDir, 'job' + job['suffix'])
+        objPath = os.path.join(tmpDir, 'job.o')
+        f = open(srcPath, 'wb')
+        f.write(job['source'])
+        f.close()
+        proc = subprocess.run([compiler] + job['args'] + ['-c', srcPath, '-o', objPath],
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = {'exit': proc.returncode, 'object': None,
+                  'stderr': proc.stdout.decode('utf-8', 'replace')}
+        if proc.returncode == 0:
+            output['object'] = open(objPath, 'rb').read()
+        return output
+
+
+def remote_compile(command, objPath, preprocessed):
+    """Has an idle client compile the source. Returns True if the object was
+    written."""
+    job = remote_job(command, preprocessed)
+    if not job:
+        return False
+    output = pilot_request('PILOT_DISTCC', {'action': 'compile_submit', 'job': job})['output']
+    if not output or output['exit'] != 0:
+        # Compile locally to get the actual errors.
+        return False
+    f = open(objPath, 'wb')
+    f.write(output['object'])
+    f.close()
+    sys.stderr.write(output['stderr'])
+    return True
+
+
+def source_file(command):
+    for arg in reversed(command[1:]):
+        if not arg.startswith('-') and os.path.splitext(arg)[1] in \
+                ['.c', '.cc', '.cpp', '.cxx', '.c++', '.m', '.mm'] and os.path.isfile(arg):
+            return os.path.abspath(arg)
+    return None
+
+
+def record_timing(fileName, command, seconds):
+    """Appends the duration of a compile or link command to the timings file."""
+    output = command[command.index('-o') + 1] if '-o' in command[:-1] else ''
+    if '-c' in command:
+        line = 'compile\t%.3f\t%s\t%s\n' % (seconds, source_file(command) or output,
+                                              os.path.abspath(output))
+    else:
+        line = 'link\t%.3f\t%s\t%s\n' % (seconds, os.path.basename(output),
+                                           os.path.abspath(output))
+    # A single short append is atomic, so parallel jobs can share the file.
+    fd = os.open(fileName, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    os.write(fd, line.encode('utf-8'))
+    os.close(fd)
+
+
+def main():
+    command = sys.argv[1:]
+    timings = None
+    baseDirs = []
+    while command[:1] in [['--timings'], ['--basedir']]:
+        if command[0] == '--timings':
+            timings = command[1]
+        else:
+            baseDirs.append(os.path.abspath(command[1]))
+        command = command[2:]
+    startedAt = time.time()
+    result = launch(command, baseDirs)
+    if timings:
+        record_timing(timings, command, time.time() - startedAt)
+    return result
+
+
+def launch(command, baseDirs=[]):
+    args = None
+    if 'PILOT_OBJCACHE' in os.environ or 'PILOT_DISTCC' in os.environ:
+        args = compile_args(command)
+    if not args:
+        return subprocess.call(command)
+    # Objects do not depend on where the sources are.
+    command = command + prefix_map_args(command, baseDirs)
+    objPath, preprocess = compile_args(command)
+
+    useCache = 'PILOT_OBJCACHE' in os.environ
+    try:
+        proc = subprocess.run(preprocess, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if proc.returncode:
+            # Let the compiler report the errors.
+            return subprocess.call(command)
+        key = object_key(command, objPath, proc.stdout, baseDirs)
+        if key is None:
+            useCache = False
+        if useCache:
+            data = pilot_request('PILOT_OBJCACHE', {'query': 'objcache_get', 'key': key})['data']
+            if data is not None:
+                f = open(objPath, 'wb')
+                f.write(data)
+                f.close()
+                return 0
+    except Exception as x:
+        print('compile_cache.py: %s' % x, file=sys.stderr)
+        return subprocess.call(command)
+
+    result = None
+    if 'PILOT_DISTCC' in os.environ:
+        try:
+            if remote_compile(command, objPath, proc.stdout):
+                result = 0
+        except Exception as x:
+            print('compile_cache.py: %s' % x, file=sys.stderr)
+    if result is None:
+        result = subprocess.call(command)
+    if result == 0 and useCache:
+        try:
+            pilot_request('PILOT_OBJCACHE', {'action': 'objcache_put', 'key': key,
+                                             'data': open(objPath, 'rb').read()})
+        except Exception as x:
+            print('compile_cache.py: %s' % x, file=sys.stderr)
+    return result
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -29,18 +29,15 @@
 
 import sys
 import os
-import platform
-import subprocess
 import pickle
 import struct
 import time
+import threading
 import socketserver
-import builder.utils
-import builder.git
 
 def homeDir():
     """Determines the path of the pilot home directory."""
-    if 'Windows' in platform.platform():
+    if sys.platform == 'win32':
         return os.path.join(os.getenv('USERPROFILE'), '.pilot')
     return os.path.join(os.getenv('HOME'), '.pilot')
 
@@ -59,7 +56,19 @@ pilotcfg.py contains information such as (global variables):
 - DISTRIB_DIR: distrib directory path
 - EVENTS_DIR: events directory path
 - APT_DIR: apt repository path (for Linux systems)
+- WORKTREE_DIR: directory for per-task git worktrees (optional)
+- MIRROR_DIR: directory for local mirrors of the upstream repositories,
+  shared by all checkouts on the system (optional)
 - IGNORED_TASKS: list of tasks to quietly ignore (marked as complete)
+- AUTOBUILD_SUBPROCESS: run autobuild commands in a separate interpreter
+- OBJCACHE_SIZE: size limit in bytes of the compilation cache hosted by the
+  server (the cache is disabled if not defined)
+- OBJCACHE: use the server's compilation cache when building (clients)
+- DISTCC: send compile jobs to idle clients via the server when building
+- COMPILE_WORKER: compile jobs of other clients while idle
+- COMPILERS: compilers that can be used for compile jobs (default: cc, c++)
+- SPECULATIVE_BUILD: start building the new branch head in the background
+  when a build is announced, before it is tagged (needs WORKTREE_DIR)
 
 The function 'postTaskHook(task)' can be defined for actions to be carried out
 after a successful execution of a task.""")
@@ -75,9 +84,13 @@ def main():
     try:
         if isServer():
             listen()
+        elif isWorker():
+            serveCompileJobs()
         else:
             # Client mode. Check quietly for new tasks.
-            checkForTasks()
+            if not checkForTasks() and 'COMPILE_WORKER' in dir(pilotcfg) and \
+                    pilotcfg.COMPILE_WORKER:
+                serveCompileJobs()
     except Exception as x:
         # Unexpected problem!
         import traceback
@@ -94,6 +107,10 @@ def isServer():
     return 'server' in sys.argv
 
 
+def isWorker():
+    return 'worker' in sys.argv
+
+
 def checkHome():
     if not os.path.exists(homeDir()):
         raise Exception(".pilot home directory does not exist.")
@@ -151,14 +168,47 @@ def markBranchHead(branch, commit):
     f.close()
 
 
-def checkBranchHeadForChanges():
-    """Checks if the current branch has moved since the previous check.
-    The current Git head is marked in ~/.pilot/heads.
+def lastBuildFileName():
+    return os.path.join(homeDir(), 'lastbuild')
+
+
+def allocateBuildNumber():
+    """Allocates the number of a new build event. Several builds may be in
+    progress at the same time, so each gets its own number: today's number,
+    or the one after the latest build if that is already taken."""
+    import build_number
+    last = 0
+    if os.path.exists(lastBuildFileName()):
+        last = int(open(lastBuildFileName(), 'rt').read().strip())
+    if 'EVENTS_DIR' in dir(pilotcfg) and os.path.exists(pilotcfg.EVENTS_DIR):
+        for name in os.listdir(pilotcfg.EVENTS_DIR):
+            if name[:5] == 'build' and name[5:].isdigit():
+                last = max(last, int(name[5:]))
+    number = build_number.next_build(last)
+    print(number, file=open(lastBuildFileName(), 'wt'))
+    return number
+
+
+def splitTaskName(task):
+    """Splits a task name of the form "name@N" into the name and the build
+    number N. The number is empty if the task is not about a specific build."""
+    if '@' in task:
+        return tuple(task.split('@', 1))
+    return task, ''
+
+
+def buildTaskName(name, build):
+    return name + '@' + build if build else name
+
+
+def checkBranchHeadForChanges(branch):
+    """Checks if `branch` has moved since the previous check. The branch
+    must be checked out. The current Git head is marked in ~/.pilot/heads.
 
     Returns:
         True, if the branch head has moved.
     """
-    branch = currentBranch()
+    import builder.git
     currentHead = builder.git.git_head()
     markedHead = markedBranchHead(branch)
     print('Current head:', currentHead)
@@ -197,6 +247,8 @@ def checkMasterActions():
 def pidFileName():
     if isServer():
         return 'server.pid'
+    elif isWorker():
+        return 'worker.pid'
     else:
         return 'client.pid'
 
@@ -261,6 +313,165 @@ def packs(s):
     return struct.pack('!i', len(s)) + s
 
 
+def recvExactly(sock, count):
+    """Receives `count` bytes from the socket."""
+    data = bytearray()
+    while len(data) < count:
+        chunk = sock.recv(min(count - len(data), 1 << 20))
+        if not chunk:
+            raise Exception("Connection closed by peer")
+        data += chunk
+    return bytes(data)
+
+
+class ObjectCache:
+    """Content-addressed store of compiled objects, kept under
+    ~/.pilot/__objcache. The least recently used objects are removed when
+    the total size exceeds the limit."""
+
+    def __init__(self, path, maxSize):
+        self.path = path
+        self.maxSize = maxSize
+        self.lock = threading.Lock()
+        self.size = 0
+        if not os.path.exists(path): os.makedirs(path)
+        for fn in self.files():
+            self.size += os.path.getsize(fn)
+
+    def files(self):
+        for sub in os.listdir(self.path):
+            subPath = os.path.join(self.path, sub)
+            if os.path.isdir(subPath):
+                for name in os.listdir(subPath):
+                    if not name.endswith('.tmp'):
+                        yield os.path.join(subPath, name)
+
+    def objectPath(self, key):
+        if len(key) < 8 or not all(c in '0123456789abcdef' for c in key):
+            raise Exception("Invalid object key: " + key)
+        return os.path.join(self.path, key[:2], key[2:])
+
+    def get(self, key):
+        """Returns the object's data, or None if it is not cached."""
+        fn = self.objectPath(key)
+        try:
+            data = open(fn, 'rb').read()
+            os.utime(fn) # Recently used.
+            return data
+        except OSError:
+            return None
+
+    def put(self, key, data):
+        fn = self.objectPath(key)
+        if os.path.exists(fn): return
+        if not os.path.exists(os.path.dirname(fn)): os.makedirs(os.path.dirname(fn), exist_ok=True)
+        tmpName = '%s.%i.tmp' % (fn, threading.get_ident())
+        f = open(tmpName, 'wb')
+        f.write(data)
+        f.close()
+        os.replace(tmpName, fn)
+        with self.lock:
+            self.size += len(data)
+            if self.size > self.maxSize:
+                self.evict()
+
+    def evict(self):
+        entries = sorted([(os.path.getmtime(fn), fn) for fn in self.files()])
+        for mtime, fn in entries:
+            if self.size <= self.maxSize * 9 // 10: break
+            try:
+                size = os.path.getsize(fn)
+                os.remove(fn)
+                self.size -= size
+            except OSError:
+                pass
+
+
+class CompileQueue:
+    """Compile jobs waiting to be carried out by idle clients. Each job has
+    a toolchain key, and it is only given to a client that has a compiler
+    with the same key. A worker is busy from taking a job until it returns
+    the result or asks for another job."""
+
+    WORKER_TIMEOUT = 30 # seconds without polling until a worker is gone
+    PICKUP_TIMEOUT = 5  # seconds until an unclaimed job is compiled locally
+    JOB_TIMEOUT = 60    # seconds until a claimed job is compiled locally
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.pending = []
+        self.running = {}
+        self.workers = {} # worker id -> {'keys', 'seen', 'busy'}
+        self.nextId = 1
+
+    def idleWorkers(self, key=None):
+        now = time.time()
+        return len([w for w in self.workers.values()
+                    if not w['busy'] and now - w['seen'] < CompileQueue.WORKER_TIMEOUT and \
+                       (key is None or key in w['keys'])])
+
+    def submit(self, job):
+        """Waits until a worker has carried out the job. Returns the output
+        of the job, or None if no worker could carry it out in time."""
+        with self.cond:
+            if not self.idleWorkers(job['key']):
+                return None
+            job['id'] = self.nextId
+            self.nextId += 1
+            job['done'] = threading.Event()
+            job['output'] = None
+            self.pending.append(job)
+            self.cond.notify_all()
+            deadline = time.time() + CompileQueue.PICKUP_TIMEOUT
+            while job in self.pending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    # The idle workers went away.
+                    self.pending.remove(job)
+                    return None
+                self.cond.wait(remaining)
+        if not job['done'].wait(CompileQueue.JOB_TIMEOUT):
+            with self.cond:
+                self.running.pop(job['id'], None)
+            msg('Compile job %i timed out (worker %s)' % (job['id'], job.get('worker')))
+        return job['output']
+
+    def take(self, workerId, keys, wait=10):
+        """Waits for a job that the worker can carry out. Returns the job,
+        or None if there was nothing to do."""
+        deadline = time.time() + wait
+        with self.cond:
+            while True:
+                self.workers[workerId] = {'keys': set(keys), 'seen': time.time(), 'busy': False}
+                for job in self.pending:
+                    if job['key'] in keys:
+                        self.pending.remove(job)
+                        job['worker'] = workerId
+                        self.running[job['id']] = job
+                        self.workers[workerId]['busy'] = True
+                        self.cond.notify_all()
+                        return dict([(k, job[k]) for k in ['id', 'key', 'args', 'source', 'suffix']])
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+
+    def finish(self, jobId, output):
+        with self.cond:
+            job = self.running.pop(jobId, None)
+            if job and job['worker'] in self.workers:
+                self.workers[job['worker']]['busy'] = False
+                self.workers[job['worker']]['seen'] = time.time()
+        if job:
+            job['output'] = output
+            job['done'].set()
+
+
+objectCache = None
+compileQueue = CompileQueue()
+taskLock = threading.Lock()
+
+
 class ReqHandler(socketserver.StreamRequestHandler):
     """Handler for requests from clients."""
 
@@ -295,42 +506,81 @@ class ReqHandler(socketserver.StreamRequestHandler):
 
     def doQuery(self):
         qry = self.request['query']
+        if qry == 'objcache_get' and objectCache:
+            self.respond({ 'data': objectCache.get(self.request['key']), 'result': 'ok' })
+            return
+        if qry == 'compile_workers':
+            self.respond({ 'workers': compileQueue.idleWorkers(), 'result': 'ok' })
+            return
+        if qry == 'compile_job':
+            self.respond({ 'job': compileQueue.take(self.request['worker'], self.request['keys']),
+                           'result': 'ok' })
+            return
+        with taskLock:
+            self.doTaskQuery(qry)
+
+    def doTaskQuery(self, qry):
         if qry == 'get_tasks':
             # Returns the tasks that a client should work on next.
-            self.respond({ 'tasks': listTasks(self.clientId(),
-                includeCompleted=False), 'result': 'ok' })
+            tasks = listTasks(self.clientId(), includeCompleted=False)
+            self.respond({ 'tasks': tasks,
+                           'params': dict([(t, taskParams(t, self.clientId())) for t in tasks]),
+                           'result': 'ok' })
         else:
             raise Exception("Unknown query: " + qry)
 
     def doAction(self):
         act = self.request['action']
-        if act == 'complete_task':
-            completeTask(self.request['task'], self.clientId())
+        if act == 'objcache_put' and objectCache:
+            objectCache.put(self.request['key'], self.request['data'])
+            self.respond({ 'result': 'ok', 'did_action': act })
+        elif act == 'compile_submit':
+            self.respond({ 'output': compileQueue.submit(self.request['job']), 'result': 'ok' })
+        elif act == 'compile_result':
+            compileQueue.finish(self.request['job_id'], self.request['output'])
+            self.respond({ 'result': 'ok', 'did_action': act })
+        elif act == 'complete_task':
+            with taskLock:
+                completeTask(self.request['task'], self.clientId())
             self.respond({ 'result': 'ok', 'did_action': act })
         else:
             raise Exception("Unknown action: " + act)
 
 
+class Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
 def listen():
+    global objectCache
     print(APP_NAME + ' starting in server mode (port %i).' % pilotcfg.PORT)
-    server = socketserver.TCPServer(('0.0.0.0', pilotcfg.PORT), ReqHandler)
+    if 'OBJCACHE_SIZE' in dir(pilotcfg):
+        objectCache = ObjectCache(os.path.join(homeDir(), '__objcache'), pilotcfg.OBJCACHE_SIZE)
+        print('Hosting a compilation cache of %i MB.' % (pilotcfg.OBJCACHE_SIZE // 1000000))
+    server = Server(('0.0.0.0', pilotcfg.PORT), ReqHandler)
     server.serve_forever()
 
 
+def request(host, port, q, timeout=None):
+    """Sends a request to a pilot server and returns the response."""
+    import socket
+    sock = socket.create_connection((host, port), timeout)
+    try:
+        sock.sendall(packs(pickle.dumps(q, 2)))
+        bytes = struct.unpack('!i', recvExactly(sock, 4))[0]
+        return pickle.loads(recvExactly(sock, bytes))
+    finally:
+        sock.close()
+
+
 def query(q):
     """Sends a query to the server and returns the result."""
     import socket
     attempts = 10
-    response = None
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     while attempts > 0:
         try:
-            sock.connect((pilotcfg.HOST, pilotcfg.PORT))
-            sock.send(packs(pickle.dumps(q, 2)))
-            bytes = struct.unpack('!i', sock.recv(4))[0]
-            response = pickle.loads(sock.recv(bytes))
-            sock.close()
-            return response
+            return request(pilotcfg.HOST, pilotcfg.PORT, q)
         except socket.gaierror:
             attempts -= 1
             time.sleep(8)
@@ -338,8 +588,11 @@ def query(q):
 
 
 def checkForTasks():
-    for task in query({'id': pilotcfg.ID, 'query': 'get_tasks'})['tasks']:
-        if not doTask(task):
+    """Carries out the client's tasks. Returns True if there were any."""
+    response = query({'id': pilotcfg.ID, 'query': 'get_tasks'})
+    params = response.get('params', {})
+    for task in response['tasks']:
+        if not doTask(task, params.get(task, {})):
             # Ignore this task... (It will be done later.)
             continue
 
@@ -351,10 +604,52 @@ def checkForTasks():
         query({'action': 'complete_task',
                'task': task,
                'id': pilotcfg.ID})
+    return len(response['tasks']) > 0
+
+
+def serveCompileJobs(duration=50):
+    """Carries out compile jobs of other clients for a while. There is one
+    worker per core; each asks the server for jobs matching the compilers
+    available here. Stops in time for the next periodic check for tasks."""
+    import compile_cache
+    from concurrent.futures import ThreadPoolExecutor
+    compilers = pilotcfg.COMPILERS if 'COMPILERS' in dir(pilotcfg) else ['cc', 'c++']
+    toolchains = {}
+    for compiler in compilers:
+        key = compile_cache.toolchain_key(compiler)
+        if key: toolchains[key] = compiler
+    if not toolchains:
+        return
+    msg("Serving compile jobs (%s)" % ', '.join(toolchains.values()))
+    endTime = time.time() + duration
+
+    def work(index):
+        workerId = '%s/%i' % (pilotcfg.ID, index)
+        while time.time() < endTime:
+            job = query({'query': 'compile_job', 'worker': workerId,
+                         'keys': list(toolchains.keys())})['job']
+            if job:
+                output = compile_cache.compile_preprocessed(toolchains[job['key']], job)
+                query({'action': 'compile_result', 'job_id': job['id'], 'output': output})
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as pool:
+        for future in [pool.submit(work, i) for i in range(os.cpu_count() or 1)]:
+            future.result()
+
+
+def doTask(task, params={}):
+    """Throws an exception if the task fails.
+
+    Arguments:
+        task:   Name of the task.
+        params: Task parameters. 'commit' is the commit the task is about
+                and 'branch' the branch it is built from.
+    """
 
-
-def doTask(task):
-    """Throws an exception if the task fails."""
+    # Tasks of a specific build event have the build number as a suffix.
+    task, build = splitTaskName(task)
+    if build:
+        params = dict(params, build=build)
 
     # Are we supposed to ignore this task?
     if 'IGNORED_TASKS' in dir(pilotcfg) and \
@@ -369,51 +664,62 @@ def doTask(task):
             autobuild('pull')
 
     elif task.startswith('buildfrom_'):
-        branch = task[10:]
-        msg("SWITCH TO BRANCH FOR BUILD: " + branch)
-        autobuild('pull')
-        switchToBranch(branch)
-        return autobuild('pull')
+        # The branch travels with the build's tasks. Other builds may be in
+        # progress on other branches, so the current branch is left alone.
+        params = dict(params, branch=params.get('branch') or task[10:])
+        msg("PREPARE FOR BUILD ON BRANCH: " + params['branch'])
+        autobuild('pull', params)
+        if isSpeculativeBuildEnabled() and params.get('commit'):
+            startBackgroundJob('prebuild', params, 'speculative-build')
+        return True
+
+    elif task.startswith('warmup_'):
+        params = dict(params, branch=params.get('branch') or task[7:])
+        msg("WARM UP FOR BUILD: " + params['branch'])
+        # A speculative build does everything the warm-up would.
+        if not isSpeculativeBuildEnabled() and params.get('commit'):
+            startBackgroundJob('warmup', params, 'warmup', lowPriority=True)
+        return True
 
     elif task.startswith('check_'):
         if pilotcfg.ID == 'master':
-            os.chdir(os.path.abspath(os.path.dirname(__file__)))
-            oldBranch = currentBranch()
             branch = task[6:]
             msg("CHECK BRANCH: " + branch)
-            autobuild('pull')
-            if switchToBranch(branch):
-                autobuild('pull')
-            if checkBranchHeadForChanges():
-                newTask('buildfrom_' + branch, allClients=True)
-            else:
-                switchToBranch(oldBranch)
-                autobuild('pull')
+            autobuild('pull', {'branch': branch})
+            if checkBranchHeadForChanges(branch):
+                # Earlier builds may still be in progress.
+                build = allocateBuildNumber()
+                params = {'commit': markedBranchHead(branch), 'branch': branch}
+                newTask(buildTaskName('buildfrom_' + branch, build), allClients=True,
+                        params=params)
+                # Prepare for the build while waiting for the tag.
+                newTask(buildTaskName('warmup_' + branch, build), allClients=True,
+                        params=params)
         return True
 
     elif task == 'tag_build':
         msg("TAG MASTER BRANCH")
-        return autobuild('create')
+        return autobuild('create', params)
 
     elif task == 'deb_changes':
         msg("UPDATE .DEB CHANGELOG")
-        return autobuild('debchanges')
+        return autobuild('debchanges', params)
 
     elif task == 'build':
         msg("BUILD RELEASE")
-        return autobuild('platform_release')
+        return autobuild('platform_release', params)
 
     elif task == 'source':
         msg("PACKAGE SOURCE")
-        return autobuild('source')
+        return autobuild('source', params)
 
     elif task == 'sign':
         msg("SIGN PACKAGES")
-        return autobuild('sign')
+        return autobuild('sign', params)
 
     elif task == 'publish':
         msg("PUBLISH")
-        return autobuild("publish")
+        return autobuild("publish", params)
 
     elif task == 'apt_refresh':
         msg("APT REPOSITORY REFRESH")
@@ -430,7 +736,7 @@ def doTask(task):
 
     elif task == 'generate_apidoc':
         msg("GENERATE API DOCUMENTATION")
-        return autobuild('apidoc')
+        return autobuild('apidoc', params)
 
     elif task == 'mirror_files':
         msg("MIRROR TO FILES.DENGINE.NET")
@@ -446,68 +752,143 @@ def handleCompletedTasks():
         tasks = listTasks(allClients=True, onlyCompleted=True)
         if len(tasks) == 0: break
 
-        task = tasks[0][:-5] # Remove '.done'
-        assert isTaskComplete(task)
+        fullName = tasks[0][:-5] # Remove '.done'
+        assert isTaskComplete(fullName)
 
-        clearTask(task)
+        # The follow-up tasks concern the same commit and build.
+        params = completedTaskParams(fullName)
+        clearTask(fullName)
+        task, build = splitTaskName(fullName)
 
-        print("Task '%s' has been completed (noticed at %s)" % (task, time.asctime()))
+        print("Task '%s' has been completed (noticed at %s)" % (fullName, time.asctime()))
 
         if task.startswith('buildfrom_'):
             # Commence with a build when everyone is ready.
-            newTask('tag_build', forClient='master')
+            newTask(buildTaskName('tag_build', build), forClient='master', params=params)
 
         elif task == 'tag_build':
-            newTask('build', allClients=True)
-            newTask('generate_wiki', forClient='master')
+            newTask(buildTaskName('build', build), allClients=True, params=params)
+            newTask(buildTaskName('generate_wiki', build), forClient='master', params=params)
 
         elif task == 'build':
-            newTask('source', forClient='master')
+            newTask(buildTaskName('source', build), forClient='master', params=params)
 
         elif task == 'source':
-            newTask('sign', forClient='master')
+            newTask(buildTaskName('sign', build), forClient='master', params=params)
 
         elif task == 'sign':
-            newTask('publish', forClient='master')
-            # After the build we can switch to the master again.
-            newTask('branch_master', allClients=True)
+            newTask(buildTaskName('publish', build), forClient='master', params=params)
 
         elif task == 'publish':
-            newTask('mirror_files', forClient='master')
-
-
-def autobuild(cmd):
-    cmdLine = "%s %s" % (os.path.join(pilotcfg.DISTRIB_DIR, 'autobuild.py'), cmd)
-    cmdLine += " --distrib %s" % pilotcfg.DISTRIB_DIR
+            newTask(buildTaskName('mirror_files', build), forClient='master', params=params)
+
+
+def autobuildOptions(params={}):
+    """Returns the settings for autobuild commands (keyword arguments of
+    builder.config.Context). The branch is the task's own, if it has one.
+    The environment variables for the compilers launched by platform_release
+    are set, too."""
+    options = {'distribDir': pilotcfg.DISTRIB_DIR,
+               'branch': params.get('branch') or currentBranch(),
+               'commit': params.get('commit', ''),
+               'build': params.get('build', '')}
     if 'EVENTS_DIR' in dir(pilotcfg):
-        cmdLine += " --events %s" % pilotcfg.EVENTS_DIR
+        options['eventDir'] = pilotcfg.EVENTS_DIR
     if 'APT_DIR' in dir(pilotcfg):
-        cmdLine += " --apt %s" % pilotcfg.APT_DIR
+        options['aptRepoDir'] = pilotcfg.APT_DIR
+    if 'WORKTREE_DIR' in dir(pilotcfg):
+        options['worktreeDir'] = pilotcfg.WORKTREE_DIR
+    if 'MIRROR_DIR' in dir(pilotcfg):
+        options['mirrorDir'] = pilotcfg.MIRROR_DIR
+    if 'OBJCACHE' in dir(pilotcfg) and pilotcfg.OBJCACHE:
+        # Compilers launched by platform_release use the server's cache.
+        os.environ['PILOT_OBJCACHE'] = '%s:%i' % (pilotcfg.HOST, pilotcfg.PORT)
+    if 'DISTCC' in dir(pilotcfg) and pilotcfg.DISTCC:
+        # ...and send compile jobs to idle clients.
+        os.environ['PILOT_DISTCC'] = '%s:%i' % (pilotcfg.HOST, pilotcfg.PORT)
+    if pilotcfg.DISTRIB_DIR not in sys.path:
+        sys.path.insert(0, pilotcfg.DISTRIB_DIR)
+    return options
+
+
+def autobuild(cmd, params={}):
+    """Carries out an autobuild command. The command runs in this process
+    unless pilotcfg.AUTOBUILD_SUBPROCESS is set."""
+    options = autobuildOptions(params)
+    isolated = 'AUTOBUILD_SUBPROCESS' in dir(pilotcfg) and pilotcfg.AUTOBUILD_SUBPROCESS
+    import autobuild
+    result = autobuild.run_command(cmd, isolated=isolated, **options)
+    msg("%s done in %.1f seconds" % (cmd, result['duration']))
+    return True
 
-    cmdLine += " --branch %s" % currentBranch()
 
-    builder.utils.run_python3(cmdLine)
-    return True
+def startBackgroundJob(cmd, params, kind, lowPriority=False):
+    """Starts an autobuild command that prepares for a build-to-be in the
+    background (see builder.speculative). The build task waits for it if
+    the build gets tagged at the same commit."""
+    options = autobuildOptions(params)
+    import autobuild
+    import builder
+    ctx = builder.config.Context(**options)
+    builder.speculative.start(builder.utils.python3_executable() + ' ' +
+                              autobuild.command_line(cmd, ctx), params['commit'], ctx,
+                              kind=kind, lowPriority=lowPriority)
+
+
+def isSpeculativeBuildEnabled():
+    return 'SPECULATIVE_BUILD' in dir(pilotcfg) and pilotcfg.SPECULATIVE_BUILD
 
 
 def systemCommand(cmd):
+    import subprocess
     result = subprocess.call(cmd, shell=True)
     if result != 0:
         raise Exception("Error from " + cmd)
 
 
-def newTask(name, forClient=None, allClients=False):
+def newTask(name, forClient=None, allClients=False, params={}):
+    """Creates a task file. The first line of the file is the creation time,
+    followed by the task parameters as "key: value" lines."""
     if allClients:
         for fn in os.listdir(homeDir()):
             if fn.startswith('__'): continue
             if os.path.isdir(os.path.join(homeDir(), fn)):
-                newTask(name, fn)
+                newTask(name, fn, params=params)
         return
 
     path = os.path.join(homeDir(), forClient)
     print("New task '%s' for client '%s'" % (name, forClient))
 
-    print(time.asctime(), file=open(os.path.join(path, 'task_' + name), 'wt'))
+    f = open(os.path.join(path, 'task_' + name), 'wt')
+    print(time.asctime(), file=f)
+    for key in sorted(params):
+        if params[key]: print('%s: %s' % (key, params[key]), file=f)
+    f.close()
+
+
+def readTaskParams(fn):
+    params = {}
+    if os.path.exists(fn):
+        for line in open(fn, 'rt').readlines()[1:]:
+            if ':' not in line: continue
+            key, value = line.split(':', 1)
+            params[key.strip()] = value.strip()
+    return params
+
+
+def taskParams(name, clientId):
+    """Returns the parameters of a client's task."""
+    return readTaskParams(os.path.join(homeDir(), clientId, 'task_' + name))
+
+
+def completedTaskParams(name):
+    """Returns the parameters of a task that all clients have completed."""
+    for fn in os.listdir(homeDir()):
+        if fn.startswith('__'): continue
+        path = os.path.join(homeDir(), fn, 'task_' + name + '.done')
+        if os.path.exists(path):
+            return readTaskParams(path)
+    return {}
 
 
 def completeTask(name, byClient):
@@ -537,7 +918,7 @@ def isTaskComplete(name):
     if name[-5:] == '.done': name = name[:-5]
     # Check that everyone has completed it.
     for task in listTasks(allClients=True):
-        if task.startswith(name) and not task.endswith('.done'):
+        if task == name:
             # This one is not complete.
             return False
     return True
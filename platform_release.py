@@ -7,33 +7,57 @@ import os
 import platform
 import shutil
 import string
+import subprocess
 import time
 import glob
+import hashlib
+import json
+import pickle
+import re
+import threading
 import build_version
 import build_number
+import builder.config
+import builder.resources
+import builder.store
 import builder.utils
 
 # Configuration.
+# Usage: platform_release.py [doomsday_dir] [--work dir] [--output dir]
+#                             [--builds dir] [--artifacts dir] [--branch name]
+#                             [--build number] [--configure-only]
 LAUNCH_DIR    = os.path.abspath(os.path.dirname(__file__))
-DOOMSDAY_DIR  = os.path.abspath(os.path.join(LAUNCH_DIR, '..', 'deng', 'doomsday')) \
-                if len(sys.argv) == 1 else os.path.abspath(sys.argv[1])
-WORK_DIR      = os.path.join(LAUNCH_DIR, 'work')
-OUTPUT_DIR    = os.path.join(LAUNCH_DIR, 'releases')
+DOOMSDAY_DIR  = os.path.abspath(sys.argv[1]) \
+                if len(sys.argv) > 1 and not sys.argv[1].startswith('--') \
+                else os.path.abspath(os.path.join(LAUNCH_DIR, '..', 'deng', 'doomsday'))
+WORK_DIR      = os.path.abspath(builder.config.get_arg('--work') or \
+                                os.path.join(LAUNCH_DIR, 'work'))
+OUTPUT_DIR    = os.path.abspath(builder.config.get_arg('--output') or \
+                                os.path.join(LAUNCH_DIR, 'releases'))
+# Incremental builds are kept here, one directory per branch and options.
+BUILDS_DIR    = os.path.abspath(builder.config.get_arg('--builds')) \
+                if builder.config.get_arg('--builds') else None
+# Packages of earlier builds, for reuse when nothing has changed.
+ARTIFACTS_DIR = os.path.abspath(builder.config.get_arg('--artifacts')) \
+                if builder.config.get_arg('--artifacts') else None
+ARTIFACT_CACHE_SIZE = 20 # entries
+# Only configure the incremental builds, in preparation for an upcoming build.
+CONFIGURE_ONLY = '--configure-only' in sys.argv
 DOOMSDAY_VERSION_FULL       = "0.0.0-Name"
 DOOMSDAY_VERSION_FULL_PLAIN = "0.0.0"
 DOOMSDAY_VERSION_MAJOR      = 0
 DOOMSDAY_VERSION_MINOR      = 0
 DOOMSDAY_VERSION_REVISION   = 0
 DOOMSDAY_RELEASE_TYPE       = "Unstable"
-DOOMSDAY_BUILD_NUMBER       = build_number.todays_build()
+DOOMSDAY_BUILD_NUMBER       = build_number.current_build()
 DOOMSDAY_BUILD              = 'build' + DOOMSDAY_BUILD_NUMBER
+os.environ['DOOMSDAY_BUILD'] = DOOMSDAY_BUILD_NUMBER # for build_version.py
 
 TIMESTAMP = time.strftime('%y-%m-%d')
 now = time.localtime()
 
 
 def exit_with_error():
-    os.chdir(LAUNCH_DIR)
     sys.exit(1)
 
 
@@ -135,61 +159,585 @@ def output_filename(ext='', extra=''):
         return 'doomsday_' + extra + DOOMSDAY_VERSION_FULL + "_" + DOOMSDAY_BUILD + ext
 
 
-def cmake_options_path():
+def current_branch():
+    branch = builder.config.get_arg('--branch')
+    if branch: return branch
     import pilot
-    return 'cmake.%s.rsp' % pilot.currentBranch()
+    return pilot.currentBranch()
 
 
-def cmake_options():
+def cmake_options_path():
+    return 'cmake.%s.rsp' % current_branch()
+
+
+def cmake_option_sets():
     """Reads the contents of the CMake options file that determines which flags are used
-    when building a release."""
+    when building a release. Each set of options is a separate configuration."""
     try:
         opts = open(os.path.join(LAUNCH_DIR, cmake_options_path()), 'rt').read().replace('\n', ' ')
     except:
         print(("No additional options provided for CMake (%s missing)" % cmake_options_path()))
         opts = ''
-    common = ' -DCMAKE_BUILD_TYPE=Release -DDENG_BUILD=%s -DDE_BUILD=%s' % (
+    return list(map(str.strip, opts.split('-----')))
+
+
+def cmake_common_options():
+    return ' -DCMAKE_BUILD_TYPE=Release -DDENG_BUILD=%s -DDE_BUILD=%s' % (
         DOOMSDAY_BUILD_NUMBER, DOOMSDAY_BUILD_NUMBER)
-    return [o + common for o in map(str.strip, opts.split('-----'))]
 
 
-def cmake_release(makeOptions, outputGlobs):
-    """Runs cmake in the work directory and copies the output files to OUTPUT_DIR."""
-    for currentOptions in cmake_options():
-        os.chdir(LAUNCH_DIR)
-        remkdir(WORK_DIR)
-        os.chdir(WORK_DIR)
+def cmake_options():
+    return [o + cmake_common_options() for o in cmake_option_sets()]
 
-        try:
-            postCommand = open(os.path.join(LAUNCH_DIR, 'postcommand.txt'), 'rt').read()
-        except:
-            postCommand = None
 
-        if os.system('cmake %s %s' % (currentOptions, DOOMSDAY_DIR)):
-            raise Exception("Failed to configure the build.")
-        if os.system('cmake --build . --config Release' + (' -- %s' % makeOptions if makeOptions else '')):
-            raise Exception("Build failed!")
+def command_output(cmd):
+    try:
+        return subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT).decode('utf-8')
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def compiler_cache():
+    """Returns the compiler cache program to use, or None if one is not
+    available."""
+    for name in ['ccache', 'sccache']:
+        if shutil.which(name): return name
+    return None
+
+
+def compiler_launcher(timingsFile=None, useCache=True, baseDirs=[]):
+    """Returns the compiler launcher command as a CMake list, or None. When
+    the pilot provides a compilation cache (PILOT_OBJCACHE) or distributed
+    compilation (PILOT_DISTCC), or the durations of the compiler runs are
+    recorded in `timingsFile`, the compiler runs via compile_cache.py. Paths
+    under `baseDirs` do not affect the pilot's cache keys."""
+    launcher = []
+    if os.getenv('PILOT_OBJCACHE') or os.getenv('PILOT_DISTCC') or timingsFile:
+        launcher += [sys.executable, os.path.join(LAUNCH_DIR, 'compile_cache.py')]
+        if timingsFile:
+            launcher += ['--timings', timingsFile]
+        for baseDir in baseDirs:
+            launcher += ['--basedir', baseDir]
+    if useCache and compiler_cache():
+        launcher.append(compiler_cache())
+    return ';'.join(launcher) or None
+
+
+def launcher_options(launcher, linkLauncher):
+    """CMake options for running the compilers and linkers via launchers.
+    (Linker launchers need CMake 3.21.)"""
+    options = ''
+    for lang in ['C', 'CXX']:
+        if launcher:
+            options += ' -DCMAKE_%s_COMPILER_LAUNCHER="%s"' % (lang, launcher)
+        if linkLauncher:
+            options += ' -DCMAKE_%s_LINKER_LAUNCHER="%s"' % (lang, linkLauncher)
+    return options
+
+
+def timing_target(path):
+    """Name of the CMake target of an object file, from its
+    "CMakeFiles/<target>.dir" directory."""
+    found = re.search(r'CMakeFiles[/\\]([^/\\]+)\.dir[/\\]', path)
+    return found.group(1) if found else None
+
+
+def source_relative(path):
+    """Path of a source file relative to the source directory, so that
+    timings of different checkouts can be compared."""
+    if path.startswith(DOOMSDAY_DIR + os.sep):
+        return path[len(DOOMSDAY_DIR) + 1:].replace(os.sep, '/')
+    return path
+
+
+def build_timings(index, options, timingsFile, totalDuration):
+    """Collects the durations recorded by compile_cache.py during a build of
+    a configuration.
+
+    Returns:
+        Dictionary with the total duration of the build, the summed compile
+        and link time per target, and the compiled/linked units sorted from
+        slowest to fastest.
+    """
+    units = []
+    targets = {}
+    if os.path.exists(timingsFile):
+        for line in open(timingsFile, 'rt'):
+            parts = line.rstrip('\n').split('\t')
+            if len(parts) != 4: continue
+            kind, seconds, name, output = parts
+            if kind == 'compile':
+                target = timing_target(output)
+                name = source_relative(name)
+            else:
+                target = name
+            units.append({'kind': kind, 'seconds': float(seconds), 'name': name,
+                          'target': target})
+            if target:
+                targets[target] = targets.get(target, 0.0) + float(seconds)
+    units.sort(key=lambda u: u['seconds'], reverse=True)
+    return {'build': DOOMSDAY_BUILD_NUMBER,
+            'config': index,
+            'options': options,
+            'total': totalDuration,
+            'targets': targets,
+            'units': units}
+
+
+def toolchain_fingerprint():
+    """Identifies the compilers and build tools. Incremental build
+    directories are cleared when this changes."""
+    ident = [platform.platform(), command_output('cmake --version'),
+             str(compiler_cache())]
+    for var, default in [('CC', 'cc'), ('CXX', 'c++')]:
+        ident.append(command_output('"%s" --version' % os.getenv(var, default)))
+    return hashlib.sha1('\n'.join(ident).encode('utf-8')).hexdigest()
+
+
+class IncrementalBuild:
+    """Build directory that is kept between builds of a branch with the same
+    options. The build is redone from scratch when the options or the
+    toolchain change. Builds of a branch normally use the same source
+    directory (the branch's persistent worktree). If it moves, e.g., when
+    worktrees are taken into use, the build directory is reconfigured."""
+
+    def __init__(self, options):
+        # The build number changes every day, so it does not count.
+        self.fingerprint = {'options': options,
+                            'toolchain': toolchain_fingerprint()}
+        digest = hashlib.sha1(options.encode('utf-8')).hexdigest()[:12]
+        self.path = os.path.join(BUILDS_DIR, '%s-%s' % (current_branch().replace('/', '_'), digest))
+        self.statePath = os.path.join(self.path, 'release-state.pickle')
+        self.state = {}
+        if os.path.exists(self.statePath):
+            try:
+                self.state = pickle.load(open(self.statePath, 'rb'))
+            except Exception:
+                pass
+        self.clean = (self.state.get('fingerprint') != self.fingerprint)
+
+    def prepare(self, outputGlobs):
+        if self.clean:
+            print('Clean build in', self.path)
+            if not os.path.exists(BUILDS_DIR): os.makedirs(BUILDS_DIR)
+            remkdir(self.path)
+        else:
+            print('Incremental build in', self.path)
+            source = self.state.get('source')
+            if source and source != DOOMSDAY_DIR:
+                # CMake refuses to use a cache made for another source
+                # directory. The objects are kept; recompiling the moved
+                # sources mostly hits the compiler cache (CCACHE_BASEDIR).
+                print('Source directory moved from %s, reconfiguring' % source)
+                remove(os.path.join(self.path, 'CMakeCache.txt'))
+            # Old packages must not be mistaken for new ones.
+            for outputGlob in outputGlobs:
+                for fn in glob.glob(os.path.join(self.path, outputGlob)):
+                    remove(fn)
+
+    def finish(self, duration):
+        """Saves the state after building. `duration` is None if the build
+        was only configured; the next build then counts as a clean one."""
+        self.state['fingerprint'] = self.fingerprint
+        self.state['source'] = DOOMSDAY_DIR
+        if duration is None:
+            self.state['configuredOnly'] = self.clean
+            pickle.dump(self.state, open(self.statePath, 'wb'), 2)
+            return
+        if self.state.pop('configuredOnly', False):
+            self.clean = True
+        if self.clean:
+            self.state['cleanDuration'] = duration
+        else:
+            print('Incremental build took %.1f seconds' % duration, end='')
+            if 'cleanDuration' in self.state:
+                print(' (saved %.1f seconds compared to the last clean build)' % \
+                      (self.state['cleanDuration'] - duration), end='')
+            print('.')
+        pickle.dump(self.state, open(self.statePath, 'wb'), 2)
+
+
+def compiler_cache_stats(tool):
+    """Returns the compiler cache's counters as a dictionary."""
+    stats = {}
+    if tool == 'ccache':
+        for line in command_output('ccache --print-stats').splitlines():
+            parts = line.split('\t')
+            if len(parts) == 2 and parts[1].isdigit():
+                stats[parts[0]] = int(parts[1])
+    return stats
+
+
+def report_compiler_cache(tool, before):
+    if not tool: return
+    after = compiler_cache_stats(tool)
+    if not after:
+        print(command_output('%s -s' % tool))
+        return
+    diff = dict([(k, after[k] - before.get(k, 0)) for k in after])
+    hits = diff.get('direct_cache_hit', 0) + diff.get('preprocessed_cache_hit', 0)
+    misses = diff.get('cache_miss', 0)
+    if hits + misses:
+        print('Compiler cache: %i hits, %i misses (%.0f%% hit rate)' % \
+              (hits, misses, 100.0 * hits / (hits + misses)))
+
+
+# Memory needed per compiler or linker job, in megabytes.
+MEMORY_PER_JOB = 1536
+
+
+def available_memory():
+    """Returns the available memory in megabytes, or None if unknown."""
+    if os.path.exists('/proc/meminfo'):
+        for line in open('/proc/meminfo', 'rt').readlines():
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) // 1024
+    if sys.platform == 'darwin':
+        out = command_output('sysctl -n hw.memsize').strip()
+        if out.isdigit(): return int(out) // (1024 * 1024)
+    return None
+
+
+def remote_workers():
+    """Number of idle clients available for compiling (see compile_cache.py)."""
+    if not os.getenv('PILOT_DISTCC'): return 0
+    try:
+        import pilot
+        host, port = os.environ['PILOT_DISTCC'].rsplit(':', 1)
+        return pilot.request(host, int(port), {'query': 'compile_workers'}, timeout=10)['workers']
+    except Exception as x:
+        print('Cannot query compile workers:', x)
+        return 0
+
+
+def job_counts(configCount):
+    """Decides how many configurations to build at the same time, and the
+    number of parallel jobs for each. The jobs are limited by the number of
+    cores and by the available memory, so that link steps do not run out of
+    memory. Idle clients accepting compile jobs add to the total.
+
+    Returns:
+        Tuple (concurrent configurations, jobs per configuration).
+    """
+    totalJobs = os.cpu_count() or 1
+    memory = available_memory()
+    if memory is not None:
+        totalJobs = max(1, min(totalJobs, memory // MEMORY_PER_JOB))
+    totalJobs += remote_workers()
+    concurrent = max(1, min(configCount, totalJobs))
+    return concurrent, max(1, totalJobs // concurrent)
+
+
+class ConfigurationLog:
+    """Log file for the output of a configuration's commands. Captured
+    commands may run concurrently; the output of each is written as one
+    block when the command finishes. The resource usage of the commands is
+    recorded next to the log (<name>-usage.json)."""
+
+    def __init__(self, path):
+        self.file = open(path, 'wt')
+        self.usagePath = os.path.splitext(path)[0] + '-usage.json'
+        if os.path.exists(self.usagePath): remove(self.usagePath)
+        self.lock = threading.Lock()
+
+    def run(self, cmd, cwd, capture=False):
+        """Runs a shell command. Returns the exit code."""
+        if not capture:
+            with self.lock:
+                print('>', cmd, file=self.file)
+                self.file.flush()
+            return builder.resources.run_sampled(cmd, self.usagePath, cwd=cwd,
+                                                 stdout=self.file, stderr=subprocess.STDOUT)
+        import tempfile
+        with tempfile.TemporaryFile() as output:
+            result = builder.resources.run_sampled(cmd, self.usagePath, cwd=cwd,
+                                                   stdout=output, stderr=subprocess.STDOUT)
+            output.seek(0)
+            with self.lock:
+                print('>', cmd, file=self.file)
+                self.file.write(output.read().decode('utf-8', 'replace'))
+                self.file.flush()
+        return result
+
+    def close(self):
+        self.file.close()
+
+
+def cpack_generators(workDir):
+    """Returns the CPack generators configured in a build directory."""
+    fn = os.path.join(workDir, 'CPackConfig.cmake')
+    if not os.path.exists(fn): return []
+    found = re.search(r'set\(CPACK_GENERATOR\s+"([^"]*)"\)', open(fn, 'rt').read())
+    if not found: return []
+    return [gen for gen in found.group(1).split(';') if gen]
+
+
+def package_configuration(index, workDir, log, outputGlobs, postCommand):
+    """Creates the packages of a built configuration. Each CPack generator
+    runs as a separate job with its own output directory. As soon as a
+    generator finishes, the post-command is run on its packages and they are
+    moved to OUTPUT_DIR.
+
+    Returns:
+        Names of the packages.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    def finish_package(fn):
+        if postCommand:
+            log.run(postCommand % os.path.basename(fn), os.path.dirname(fn), capture=True)
+        shutil.move(fn, os.path.join(OUTPUT_DIR, os.path.basename(fn)))
+        print('Configuration %i: %s is ready.' % (index, os.path.basename(fn)))
+        return os.path.basename(fn)
+
+    def cpack(generator):
+        packageDir = os.path.join(workDir, 'package-' + generator)
+        remkdir(packageDir)
+        if log.run('cpack -G %s -C Release -B "%s"' % (generator, packageDir), workDir,
+                   capture=True):
+            raise Exception("Failed to create the %s package (configuration %i)." % \
+                            (generator, index))
+        return packageDir
+
+    generators = cpack_generators(workDir)
+    errors = []
+    with ThreadPoolExecutor(max_workers=max(1, len(generators))) as packers, \
+         ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as finishers:
+        if generators:
+            packaged = [packers.submit(cpack, gen) for gen in generators]
+        else:
+            # Let the build system decide how to package.
+            if log.run('cmake --build . --config Release --target package', workDir):
+                raise Exception("Failed to package the binaries (configuration %i)." % index)
+            packaged = [packers.submit(lambda: workDir)]
+        finished = []
+        for future in as_completed(packaged):
+            try:
+                packageDir = future.result()
+            except Exception as x:
+                errors.append(str(x))
+                continue
+            for outputGlob in outputGlobs:
+                for fn in glob.glob(os.path.join(packageDir, outputGlob)):
+                    finished.append(finishers.submit(finish_package, fn))
+        names = [future.result() for future in finished]
+    if errors:
+        raise Exception(' '.join(errors))
+    return names
+
+
+def source_tree_hash():
+    """Returns the hash of the committed tree of the whole repository, not
+    just the doomsday directory. The tree includes the commits of the
+    submodules. Returns None if the checkout or a submodule has changes."""
+    topDir = command_output('git -C "%s" rev-parse --show-toplevel' % DOOMSDAY_DIR).strip()
+    if not os.path.isdir(topDir):
+        return None
+    status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no',
+                             '--ignore-submodules=none'],
+                            cwd=topDir, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if status.returncode or status.stdout.strip():
+        return None
+    tree = command_output('git -C "%s" rev-parse "HEAD^{tree}"' % topDir).strip()
+    return tree if len(tree) == 40 else None
+
+
+def relabel(name, oldBuild, newBuild):
+    """Replaces the build number in a file name."""
+    return re.sub(r'(?<![0-9])%s(?![0-9])' % oldBuild, newBuild, name)
+
+
+class ArtifactCache:
+    """Packages produced earlier, keyed by everything that affects their
+    contents except the build number: the source tree with its submodules,
+    the CMake options, the toolchain and the packaging steps.
+
+    Only the file names of reused packages get the new build number. The
+    build number compiled into the binaries and the version in the package
+    metadata remain those of the original build."""
+
+    def __init__(self, options, postCommand=None):
+        tree = source_tree_hash()
+        self.key = None
+        self.originalBuild = None
+        if tree:
+            script = hashlib.sha1(open(os.path.abspath(__file__), 'rb').read()).hexdigest()
+            self.key = hashlib.sha1('\n'.join([tree, options, toolchain_fingerprint(),
+                                               postCommand or '', script])
+                                    .encode('utf-8')).hexdigest()
+            self.path = os.path.join(ARTIFACTS_DIR, self.key)
+
+    def fetch(self):
+        """Copies the cached packages to OUTPUT_DIR, with the build number
+        of their names changed to the current one. The number of the build
+        that produced them is kept in `originalBuild`.
+
+        Returns:
+            List of package names, or None if there are no cached packages.
+        """
+        if not self.key or not os.path.exists(os.path.join(self.path, 'build.txt')):
+            return None
+        oldBuild = open(os.path.join(self.path, 'build.txt'), 'rt').read().strip()
+        self.originalBuild = oldBuild
+        names = []
+        for name in sorted(os.listdir(self.path)):
+            if name == 'build.txt': continue
+            newName = relabel(name, oldBuild, DOOMSDAY_BUILD_NUMBER)
+            builder.store.fast_copy(os.path.join(self.path, name),
+                                    os.path.join(OUTPUT_DIR, newName))
+            names.append(newName)
+        os.utime(self.path) # Recently used.
+        return names
+
+    def store(self, names):
+        """Saves copies of the packages (in OUTPUT_DIR) in the cache."""
+        if not self.key: return
+        tmpPath = self.path + '.%i.tmp' % os.getpid()
+        remkdir_all(tmpPath)
+        for name in names:
+            builder.store.fast_copy(os.path.join(OUTPUT_DIR, name), os.path.join(tmpPath, name))
+        print(DOOMSDAY_BUILD_NUMBER, file=open(os.path.join(tmpPath, 'build.txt'), 'wt'))
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path, True)
+        os.rename(tmpPath, self.path)
+        self.prune()
+
+    def prune(self):
+        """Removes the least recently used entries above the cache size."""
+        entries = [os.path.join(ARTIFACTS_DIR, n) for n in os.listdir(ARTIFACTS_DIR)
+                   if not n.endswith('.tmp')]
+        entries.sort(key=os.path.getmtime, reverse=True)
+        for path in entries[ARTIFACT_CACHE_SIZE:]:
+            shutil.rmtree(path, True)
+
+
+def remkdir_all(n):
+    if os.path.exists(n):
+        shutil.rmtree(n, True)
+    os.makedirs(n)
+
+
+def build_configuration(index, options, makeOptions, outputGlobs, postCommand):
+    """Configures, builds and packages one set of options, and copies the
+    packages to OUTPUT_DIR. The output of the commands is written to
+    config<index>.log in the work directory."""
+    currentOptions = options + cmake_common_options()
+    startedAt = time.time()
+    if CONFIGURE_ONLY and not BUILDS_DIR:
+        return
+    artifacts = ArtifactCache(options, postCommand) \
+                if ARTIFACTS_DIR and not CONFIGURE_ONLY else None
+    reusedFile = os.path.join(WORK_DIR, 'config%i-reused.json' % index)
+    if os.path.exists(reusedFile): remove(reusedFile)
+    if artifacts:
+        names = artifacts.fetch()
+        if names is not None:
+            print('Configuration %i: reusing packages %s of the identical build %s. '
+                  'They still carry the number of that build inside.' % \
+                  (index, ', '.join(names), artifacts.originalBuild))
+            # Noted in the build report.
+            json.dump({'build': artifacts.originalBuild, 'packages': names},
+                      open(reusedFile, 'wt'))
+            return
+    incremental = None
+    if BUILDS_DIR:
+        incremental = IncrementalBuild(options)
+        incremental.prepare(outputGlobs)
+        workDir = incremental.path
+    else:
+        workDir = os.path.join(WORK_DIR, 'config%i' % index)
+        remkdir(workDir)
+
+    # Every compiler and linker run is timed. The compiler cache is only
+    # useful for incremental builds.
+    timingsFile = os.path.join(WORK_DIR, 'config%i.timings' % index)
+    if os.path.exists(timingsFile): remove(timingsFile)
+    # The same sources in other checkouts or builders share cached objects.
+    baseDirs = [os.path.dirname(DOOMSDAY_DIR), workDir]
+    currentOptions += launcher_options(compiler_launcher(timingsFile, useCache=bool(incremental),
+                                                         baseDirs=baseDirs),
+                                       compiler_launcher(timingsFile, useCache=False))
+
+    logName = os.path.join(WORK_DIR, 'config%i.log' % index)
+    print('Configuration %i: %s (log: %s)' % (index, options or 'default options', logName))
+    log = ConfigurationLog(logName)
+    try:
+        if log.run('cmake %s %s' % (currentOptions, DOOMSDAY_DIR), workDir):
+            raise Exception("Failed to configure the build (configuration %i)." % index)
+        if CONFIGURE_ONLY:
+            print('Configuration %i configured in %.1f seconds.' % (index, time.time() - startedAt))
+            incremental.finish(None)
+            return
+        buildStartedAt = time.time()
+        if log.run('cmake --build . --config Release -- %s' % makeOptions, workDir):
+            raise Exception("Build failed! (configuration %i)" % index)
+        timings = build_timings(index, options, timingsFile, time.time() - buildStartedAt)
+        json.dump(timings, open(os.path.join(WORK_DIR, 'config%i-timings.json' % index), 'wt'))
+        names = package_configuration(index, workDir, log, outputGlobs, postCommand)
+        if artifacts:
+            artifacts.store(names)
+    finally:
+        log.close()
+    print('Configuration %i done in %.1f seconds.' % (index, time.time() - startedAt))
+    if incremental:
+        incremental.finish(time.time() - startedAt)
+
+
+def cmake_release(makeOptions, outputGlobs):
+    """Builds each configuration of the CMake options in its own work directory
+    and copies the output files to OUTPUT_DIR. Independent configurations are
+    built concurrently. With --builds, each configuration is built
+    incrementally using a compiler cache if one is available.
+
+    Arguments:
+        makeOptions: Options for the native build tool; %i is replaced with
+                     the number of parallel jobs.
+        outputGlobs: Patterns of the package files.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    optionSets = cmake_option_sets()
+    concurrent, jobs = job_counts(len(optionSets))
+    print('Building %i configuration(s), %i at a time with %i jobs each.' % \
+          (len(optionSets), concurrent, jobs))
 
-        # Use CPack to create the package.
-        if os.system('cmake --build . --config Release --target package'):
-            raise Exception("Failed to package the binaries.")
-        for outputGlob in outputGlobs:
-            for fn in glob.glob(outputGlob):
-                if postCommand:
-                    os.system(postCommand % fn)
-                shutil.copy(fn, OUTPUT_DIR)
+    try:
+        postCommand = open(os.path.join(LAUNCH_DIR, 'postcommand.txt'), 'rt').read()
+    except:
+        postCommand = None
+
+    cacheTool = compiler_cache() if BUILDS_DIR else None
+    if cacheTool:
+        # Cache hits also across different source directories.
+        os.environ['CCACHE_BASEDIR'] = os.path.dirname(DOOMSDAY_DIR)
+    cacheStats = compiler_cache_stats(cacheTool)
+
+    with ThreadPoolExecutor(max_workers=concurrent) as pool:
+        futures = [pool.submit(build_configuration, index, options, makeOptions % jobs,
+                               outputGlobs, postCommand)
+                   for index, options in enumerate(optionSets)]
+        errors = []
+        for future in futures:
+            try:
+                future.result()
+            except Exception as x:
+                print(x)
+                errors.append(str(x))
+    report_compiler_cache(cacheTool, cacheStats)
+    if errors:
+        raise Exception(' '.join(errors))
 
 
 def mac_release():
-    cmake_release('-j4', ['*.dmg'])
+    cmake_release('-j%i', ['*.dmg'])
 
 
 def win_release():
-    cmake_release('/m', ['*.msi', '*.zip'])
+    cmake_release('/m:%i', ['*.msi', '*.zip'])
 
 
 def linux_release():
-    cmake_release('-j`nproc`', ['*.deb', '*.rpm'])
+    cmake_release('-j%i', ['*.deb', '*.rpm'])
 
 
 def main():
@@ -217,7 +765,6 @@ def main():
         print(x)
         exit_with_error()
 
-    os.chdir(LAUNCH_DIR)
     print("Done.")
 
 
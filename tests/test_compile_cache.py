@@ -0,0 +1,164 @@
+# The pilot's compilation cache (compile_cache.py), with a pilot server on
+# localhost and two checkouts of the same sources in different directories.
+
+import os
+import sys
+import shutil
+import tempfile
+import time
+import threading
+import subprocess
+import unittest
+from unittest import mock
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+import pilot
+import compile_cache
+
+HEADER = '#define GREETING "hello"\n'
+SOURCE = '#include "greeting.h"\nconst char *where(void) { return __FILE__; }\n' \
+         'const char *greeting(void) { return GREETING; }\n'
+
+# Compiler that records its compile runs, so that cache hits can be counted.
+WRAPPER = '#!/bin/sh\ncase " $* " in *" -c "*) echo "$*" >> "%s";; esac\nexec cc "$@"\n'
+
+
+@unittest.skipUnless(shutil.which('cc') and sys.platform != 'win32', 'needs cc')
+class CompileCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='test-compile-cache-')
+        pilot.objectCache = pilot.ObjectCache(os.path.join(self.tmp, 'objcache'), 10000000)
+        self.server = pilot.Server(('127.0.0.1', 0), pilot.ReqHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.compiles = os.path.join(self.tmp, 'compiles.txt')
+        self.compiler = os.path.join(self.tmp, 'cc-wrapper')
+        open(self.compiler, 'wt').write(WRAPPER % self.compiles)
+        os.chmod(self.compiler, 0o755)
+        self.env = dict(os.environ, PILOT_OBJCACHE='127.0.0.1:%i' % self.server.server_address[1],
+                        TMPDIR=self.tmp)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        pilot.objectCache = None
+        shutil.rmtree(self.tmp, True)
+
+    def checkout(self, name):
+        srcDir = os.path.join(self.tmp, name, 'src')
+        os.makedirs(os.path.join(srcDir, 'include'))
+        open(os.path.join(srcDir, 'include', 'greeting.h'), 'wt').write(HEADER)
+        open(os.path.join(srcDir, 'greeting.c'), 'wt').write(SOURCE)
+        buildDir = os.path.join(self.tmp, name, 'build')
+        os.makedirs(buildDir)
+        return srcDir, buildDir
+
+    def compile(self, srcDir, buildDir, extraArgs=[], env=None):
+        objPath = os.path.join(buildDir, 'greeting.o')
+        subprocess.check_call([sys.executable, os.path.join(ROOT, 'compile_cache.py'),
+                               '--basedir', srcDir, '--basedir', buildDir,
+                               self.compiler, '-O2', '-I' + os.path.join(srcDir, 'include'),
+                               '-MD', '-MF', objPath + '.d'] + extraArgs +
+                              ['-c', os.path.join(srcDir, 'greeting.c'), '-o', objPath],
+                              cwd=buildDir, env=env or self.env)
+        return open(objPath, 'rb').read()
+
+    def compile_count(self):
+        if not os.path.exists(self.compiles): return 0
+        return len(open(self.compiles, 'rt').readlines())
+
+    def test_second_checkout_hits(self):
+        first = self.compile(*self.checkout('build1'))
+        self.assertEqual(self.compile_count(), 1)
+        second = self.compile(*self.checkout('build2'))
+        self.assertEqual(self.compile_count(), 1)
+        self.assertEqual(first, second)
+        # The checkout paths are not in the object.
+        self.assertNotIn(self.tmp.encode('utf-8'), first)
+
+    def test_different_options_miss(self):
+        srcDir, buildDir = self.checkout('build1')
+        self.compile(srcDir, buildDir)
+        self.compile(srcDir, buildDir, ['-DEXTRA'])
+        self.assertEqual(self.compile_count(), 2)
+
+    def test_remote_compile_matches_local(self):
+        port = self.server.server_address[1]
+        env = dict(self.env, PILOT_DISTCC='127.0.0.1:%i' % port)
+        del env['PILOT_OBJCACHE']
+        with mock.patch.object(compile_cache, 'toolchain_cache_path',
+                               lambda: os.path.join(self.tmp, 'toolchains.json')):
+            key = compile_cache.toolchain_key(self.compiler)
+        jobs = []
+
+        def work():
+            # Like pilot.serveCompileJobs(), with the actual compiler so
+            # that the compile is not counted.
+            job = pilot.request('127.0.0.1', port, {'query': 'compile_job', 'worker': 'w1',
+                                                    'keys': [key]})['job']
+            if job:
+                jobs.append(job)
+                pilot.request('127.0.0.1', port, {'action': 'compile_result', 'job_id': job['id'],
+                                                  'output': compile_cache.compile_preprocessed(
+                                                      'cc', job)})
+
+        with mock.patch.object(pilot, 'compileQueue', pilot.CompileQueue()):
+            worker = threading.Thread(target=work, daemon=True)
+            worker.start()
+            while not pilot.compileQueue.idleWorkers(key):
+                time.sleep(0.01)
+            srcDir, buildDir = self.checkout('remote')
+            remote = self.compile(srcDir, buildDir, ['-DUNUSED=1'], env=env)
+            worker.join()
+            self.assertEqual(self.compile_count(), 0)
+            self.assertEqual(len(jobs), 1)
+            # Only the options for compiling the preprocessed source are sent.
+            self.assertEqual(jobs[0]['suffix'], '.i')
+            self.assertIn(b'"hello"', jobs[0]['source'])
+            for arg in jobs[0]['args']:
+                self.assertFalse(arg.startswith(('-I', '-D', '-M', '-c', '-o')), arg)
+                self.assertNotIn('greeting.c', arg)
+            # The dependencies are still written for the build tool.
+            deps = open(os.path.join(buildDir, 'greeting.o.d'), 'rt').read()
+            self.assertTrue(deps.startswith(os.path.join(buildDir, 'greeting.o') + ':'), deps)
+            self.assertIn('greeting.h', deps)
+
+            # The worker no longer polls: compiled locally with the same options.
+            with mock.patch.object(pilot.CompileQueue, 'PICKUP_TIMEOUT', 0.2):
+                local = self.compile(*self.checkout('local'), ['-DUNUSED=1'], env=env)
+        self.assertEqual(self.compile_count(), 1)
+        self.assertEqual(remote, local)
+
+    def test_key_ignores_launchers(self):
+        command = [self.compiler, '-c', 'a.c', '-o', 'a.o']
+        with mock.patch.object(compile_cache, 'toolchain_cache_path',
+                               lambda: os.path.join(self.tmp, 'toolchains.json')):
+            key = compile_cache.object_key(command, 'a.o', b'int a;')
+            self.assertEqual(compile_cache.object_key(['ccache'] + command, 'a.o', b'int a;'),
+                             key)
+            self.assertNotEqual(compile_cache.object_key(command, 'a.o', b'int b;'), key)
+
+    def test_toolchain_is_probed_once(self):
+        probes = []
+        realProbe = compile_cache.probe_toolchain
+
+        def probe(exe):
+            probes.append(exe)
+            return dict(realProbe(exe), key='version%i' % len(probes))
+
+        with mock.patch.object(compile_cache, 'toolchain_cache_path',
+                               lambda: os.path.join(self.tmp, 'toolchains.json')), \
+             mock.patch.object(compile_cache, 'probe_toolchain', probe):
+            command = [self.compiler, '-c', 'a.c', '-o', 'a.o']
+            key = compile_cache.object_key(command, 'a.o', b'int a;')
+            self.assertEqual(compile_cache.object_key(command, 'a.o', b'int a;'), key)
+            self.assertEqual(len(probes), 1)
+            # A different compiler installed at the same path.
+            open(self.compiler, 'at').write('# version 2\n')
+            self.assertNotEqual(compile_cache.object_key(command, 'a.o', b'int a;'), key)
+            self.assertEqual(len(probes), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
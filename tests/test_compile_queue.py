@@ -0,0 +1,97 @@
+# Distribution of compile jobs to idle clients (pilot.CompileQueue), also
+# through a pilot server on localhost.
+
+import os
+import sys
+import time
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pilot
+
+
+def new_job(key='tc'):
+    return {'key': key, 'args': [], 'source': b'int a;', 'suffix': '.i'}
+
+
+class CompileQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = pilot.CompileQueue()
+
+    def serve(self, workerId, keys, compile=True):
+        """Worker that takes one job and, if `compile`, returns a result."""
+        def work():
+            job = self.queue.take(workerId, keys, wait=5)
+            if job and compile:
+                self.queue.finish(job['id'], {'exit': 0, 'object': b'obj', 'stderr': ''})
+        thread = threading.Thread(target=work, daemon=True)
+        thread.start()
+        # Wait until the worker is polling.
+        while workerId not in self.queue.workers or self.queue.workers[workerId]['busy']:
+            time.sleep(0.01)
+        return thread
+
+    def test_job_is_carried_out(self):
+        self.serve('w1', ['tc'])
+        self.assertEqual(self.queue.idleWorkers('tc'), 1)
+        self.assertEqual(self.queue.idleWorkers('other'), 0)
+        self.assertEqual(self.queue.submit(new_job())['object'], b'obj')
+
+    def test_no_matching_worker(self):
+        self.serve('w1', ['other'])
+        self.assertIsNone(self.queue.submit(new_job()))
+
+    def test_busy_worker_is_not_idle(self):
+        self.serve('w1', ['tc'], compile=False)
+        with mock.patch.object(pilot.CompileQueue, 'JOB_TIMEOUT', 0.2):
+            self.queue.submit(new_job())
+        self.assertEqual(self.queue.idleWorkers(), 0)
+        # Asking for another job makes the worker idle again.
+        self.serve('w1', ['tc'])
+        self.assertEqual(self.queue.idleWorkers(), 1)
+
+    def test_unclaimed_job_falls_back_quickly(self):
+        # A worker seen recently, but no longer polling.
+        self.queue.workers['gone'] = {'keys': {'tc'}, 'seen': time.time(), 'busy': False}
+        startedAt = time.time()
+        with mock.patch.object(pilot.CompileQueue, 'PICKUP_TIMEOUT', 0.2):
+            self.assertIsNone(self.queue.submit(new_job()))
+        self.assertLess(time.time() - startedAt, 2)
+        self.assertEqual(self.queue.pending, [])
+
+    def test_lost_worker_falls_back(self):
+        self.serve('w1', ['tc'], compile=False)
+        with mock.patch.object(pilot.CompileQueue, 'JOB_TIMEOUT', 0.2):
+            self.assertIsNone(self.queue.submit(new_job()))
+        self.assertEqual(self.queue.running, {})
+
+    def test_localhost_server(self):
+        queue = pilot.CompileQueue()
+        server = pilot.Server(('127.0.0.1', 0), pilot.ReqHandler)
+        port = server.server_address[1]
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            with mock.patch.object(pilot, 'compileQueue', queue):
+                def work():
+                    job = pilot.request('127.0.0.1', port, {'query': 'compile_job',
+                                                            'worker': 'w1', 'keys': ['tc']})['job']
+                    pilot.request('127.0.0.1', port, {'action': 'compile_result',
+                                                      'job_id': job['id'],
+                                                      'output': {'exit': 0, 'object': b'obj',
+                                                                 'stderr': ''}})
+                threading.Thread(target=work, daemon=True).start()
+                while not pilot.request('127.0.0.1', port, {'query': 'compile_workers'})['workers']:
+                    time.sleep(0.01)
+                output = pilot.request('127.0.0.1', port, {'action': 'compile_submit',
+                                                           'job': new_job()})['output']
+                self.assertEqual(output['object'], b'obj')
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+# Build reports of an event directory (builder/event.py).
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from builder.event import Event
+from builder.config import Context
+
+
+class EventReportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='test-event-')
+        self.ctx = Context(distribDir=self.tmp, eventDir=self.tmp)
+        os.makedirs(os.path.join(self.tmp, 'build5767'))
+        self.event = Event(5767, ctx=self.ctx)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, True)
+
+    def test_timings_are_escaped(self):
+        timings = {'build': '5767', 'options': '-DFLAGS="<a&b>"', 'total': 12.0,
+                   'units': [{'kind': 'compile', 'name': 'src/<generated>/a&b.cpp',
+                              'target': 'lib<core>', 'seconds': 3.5}]}
+        json.dump(timings, open(self.event.file_path('timings-linux2-64bit-config0.json'), 'wt'))
+        report = self.event.html_timings()
+        self.assertIn('src/&lt;generated&gt;/a&amp;b.cpp', report)
+        self.assertIn('lib&lt;core&gt;', report)
+        self.assertIn('-DFLAGS=&quot;&lt;a&amp;b&gt;&quot;', report)
+        self.assertNotIn('<generated>', report)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+# Local bare mirrors (builder/mirror.py), with a temporary bare repository
+# acting as the upstream.
+
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from builder import mirror
+from builder.config import Context
+from builder.git import git_output
+
+GIT_ENV = dict(os.environ, GIT_AUTHOR_NAME='Test', GIT_AUTHOR_EMAIL='test@example.com',
+               GIT_COMMITTER_NAME='Test', GIT_COMMITTER_EMAIL='test@example.com')
+
+
+def git(args, cwd):
+    return subprocess.check_output(['git'] + args, cwd=cwd, env=GIT_ENV,
+                                   stderr=subprocess.STDOUT).decode('utf-8').strip()
+
+
+def commit(repoDir, text):
+    open(os.path.join(repoDir, 'file.txt'), 'wt').write(text)
+    git(['add', 'file.txt'], repoDir)
+    git(['commit', '-q', '-m', text], repoDir)
+    return git(['rev-parse', 'HEAD'], repoDir)
+
+
+class MirrorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='test-mirror-')
+        self.upstream = os.path.join(self.tmp, 'upstream.git')
+        self.work = os.path.join(self.tmp, 'work')
+        git(['init', '-q', '--bare', self.upstream], self.tmp)
+        git(['clone', '-q', self.upstream, self.work], self.tmp)
+        commit(self.work, 'first')
+        git(['push', '-q', 'origin', 'HEAD:master'], self.work)
+        self.checkout = os.path.join(self.tmp, 'checkout')
+        git(['clone', '-q', self.upstream, self.checkout], self.tmp)
+        self.ctx = Context(distribDir=self.tmp, doomsdayDir=self.checkout,
+                           mirrorDir=os.path.join(self.tmp, 'mirrors'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, True)
+
+    def test_resolve_url(self):
+        self.assertEqual(mirror.resolve_url('../sub.git', 'https://host/org/main.git'),
+                         'https://host/org/sub.git')
+        self.assertEqual(mirror.resolve_url('../sub.git', 'git@host:main.git'),
+                         'git@host:sub.git')
+        self.assertEqual(mirror.resolve_url('https://other/x.git', 'https://host/y.git'),
+                         'https://other/x.git')
+
+    def test_checkout_uses_mirror(self):
+        mirror.mirror_sync(self.ctx)
+        path = mirror.mirror_path(self.upstream, self.ctx)
+        self.assertTrue(os.path.isdir(os.path.join(path, 'objects')))
+        self.assertEqual(git_output(['config', 'remote.origin.url'], self.checkout), path)
+        self.assertEqual(git_output(['config', 'remote.origin.pushurl'], self.checkout),
+                         self.upstream)
+        alternates = open(os.path.join(self.checkout, '.git', 'objects', 'info',
+                                       'alternates'), 'rt').read().split()
+        self.assertIn(os.path.join(path, 'objects'), alternates)
+        # Syncing again changes nothing.
+        mirror.mirror_sync(self.ctx)
+        self.assertEqual(open(os.path.join(self.checkout, '.git', 'objects', 'info',
+                                           'alternates'), 'rt').read().split(), alternates)
+
+    def test_fetch_only_when_upstream_changes(self):
+        path = mirror.mirror_update(self.upstream, self.ctx)
+        fetchHead = os.path.join(path, 'FETCH_HEAD')
+        mirror.mirror_update(self.upstream, self.ctx)
+        self.assertFalse(os.path.exists(fetchHead))
+        newCommit = commit(self.work, 'second')
+        git(['push', '-q', 'origin', 'HEAD:master'], self.work)
+        self.assertFalse(mirror.has_commit(path, newCommit))
+        mirror.mirror_update(self.upstream, self.ctx)
+        self.assertTrue(mirror.has_commit(path, newCommit))
+
+    def test_fetch_missing_commit(self):
+        path = mirror.mirror_update(self.upstream, self.ctx)
+        newCommit = commit(self.work, 'second')
+        git(['push', '-q', 'origin', 'HEAD:master'], self.work)
+        mirror.mirror_update(self.upstream, self.ctx, newCommit)
+        self.assertTrue(mirror.has_commit(path, newCommit))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+# Task flow of the pilot (pilot.py): the follow-up tasks of a build carry
+# its commit and branch, so builds of different branches can overlap.
+
+import os
+import sys
+import types
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pilot
+
+
+class TaskFlowTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='test-pilot-')
+        for client in ['master', 'linux']:
+            os.makedirs(os.path.join(self.tmp, client))
+        self.cfg = types.SimpleNamespace(ID='master', DISTRIB_DIR=self.tmp)
+        self.patches = [mock.patch.object(pilot, 'homeDir', lambda: self.tmp),
+                        mock.patch.object(pilot, 'pilotcfg', self.cfg, create=True)]
+        for patch in self.patches: patch.start()
+
+    def tearDown(self):
+        for patch in self.patches: patch.stop()
+        shutil.rmtree(self.tmp, True)
+
+    def complete(self, name):
+        for client in os.listdir(self.tmp):
+            path = os.path.join(self.tmp, client, 'task_' + name)
+            if os.path.exists(path):
+                pilot.completeTask(name, client)
+        pilot.handleCompletedTasks()
+
+    def test_follow_up_tasks_carry_branch(self):
+        pilot.switchToBranch('master')
+        params = {'commit': 'e1050357', 'branch': 'stable'}
+        pilot.newTask('sign@5767', forClient='master', params=params)
+        self.complete('sign@5767')
+        self.assertEqual(pilot.listTasks(allClients=True), ['publish@5767'])
+        self.assertEqual(pilot.taskParams('publish@5767', 'master'), params)
+        self.complete('publish@5767')
+        self.assertEqual(pilot.taskParams('mirror_files@5767', 'master'), params)
+        # Nobody is switched back to master in the middle of other builds.
+        self.assertEqual(pilot.listTasks(allClients=True), ['mirror_files@5767'])
+
+    def test_options_use_task_branch(self):
+        pilot.switchToBranch('master')
+        self.assertEqual(pilot.autobuildOptions({'branch': 'stable'})['branch'], 'stable')
+        self.assertEqual(pilot.autobuildOptions({})['branch'], 'master')
+
+    def test_build_is_prepared_on_its_branch(self):
+        pilot.switchToBranch('master')
+        calls = []
+        with mock.patch.object(pilot, 'autobuild', lambda cmd, params={}: calls.append(
+                (cmd, params))):
+            pilot.doTask('buildfrom_stable@5767', {'commit': 'e1050357'})
+        self.assertEqual(calls, [('pull', {'commit': 'e1050357', 'build': '5767',
+                                           'branch': 'stable'})])
+        self.assertEqual(pilot.currentBranch(), 'master')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+# Startup cost of the entry points. The pilot runs from cron every minute,
+# so importing it must not pull in the heavier builder modules.
+
+import os
+import sys
+import subprocess
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Modules that only specific commands need.
+HEAVY_MODULES = ['builder.changes', 'builder.event', 'builder.buildindex',
+                 'builder.worktree', 'builder.commitcache', 'builder.tune',
+                 'builder.resources', 'builder.transfer', 'builder.store',
+                 'email.utils', 'gzip', 'zipfile']
+
+# Upper limit for the cumulative import time of an entry point.
+MAX_IMPORT_SECONDS = 0.25
+
+
+def imported_modules(statement):
+    out = subprocess.check_output([sys.executable, '-c', statement +
+                                   '; import sys; print("\\n".join(sys.modules))'], cwd=ROOT)
+    return set(out.decode('utf-8').split())
+
+
+def import_seconds(module):
+    """Cumulative import time of a module according to -X importtime."""
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                          cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+    for line in proc.stderr.decode('utf-8').splitlines():
+        fields = [f.strip() for f in line.split('|')]
+        if len(fields) == 3 and fields[2] == module:
+            return int(fields[1]) / 1e6
+    raise Exception("No import time reported for " + module)
+
+
+class StartupTest(unittest.TestCase):
+
+    def test_builder_is_lazy(self):
+        mods = imported_modules('import builder')
+        self.assertEqual([m for m in HEAVY_MODULES if m in mods], [])
+
+    def test_builder_name_loads_its_module(self):
+        mods = imported_modules('import builder; builder.Event')
+        self.assertIn('builder.event', mods)
+        self.assertNotIn('builder.changes', mods)
+
+    def test_entry_points_are_lazy(self):
+        for module in ['pilot', 'autobuild']:
+            mods = imported_modules('import ' + module)
+            self.assertEqual([m for m in HEAVY_MODULES if m in mods], [], module)
+
+    def test_import_time(self):
+        for module in ['builder', 'pilot', 'autobuild']:
+            # Best of a few runs to ignore a cold disk cache.
+            best = min(import_seconds(module) for i in range(3))
+            self.assertLess(best, MAX_IMPORT_SECONDS, module)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+# Content store for published build artifacts (builder/store.py).
+
+import os
+import sys
+import stat
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from builder import store
+from builder.config import Context
+
+
+class StoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='test-store-')
+        self.store = store.ContentStore(Context(distribDir=self.tmp,
+                                                cacheDir=os.path.join(self.tmp, 'cache')))
+        self.package = os.path.join(self.tmp, 'releases', 'doomsday_2.3_amd64.deb')
+        os.makedirs(os.path.dirname(self.package))
+        open(self.package, 'wb').write(os.urandom(store.STORE_MIN_SIZE + 1))
+        os.chmod(self.package, 0o664)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, True)
+
+    def published(self):
+        return [os.path.join(self.tmp, 'events', 'build5767', 'doomsday_2.3_amd64.deb'),
+                os.path.join(self.tmp, 'apt', 'binary-amd64', 'doomsday_2.3_amd64.deb')]
+
+    def test_identical_files_are_stored_once(self):
+        for dst in self.published():
+            self.store.place(self.package, dst)
+        inodes = set(os.stat(dst).st_ino for dst in self.published())
+        self.assertEqual(len(inodes), 1)
+        # The published files and the stored copy.
+        self.assertEqual(os.stat(self.published()[0]).st_nlink, 3)
+        # The source is not linked, so it can still be rewritten.
+        self.assertNotIn(os.stat(self.package).st_ino, inodes)
+
+    def test_mode_is_kept(self):
+        dst = self.published()[0]
+        self.store.place(self.package, dst)
+        self.assertEqual(stat.S_IMODE(os.stat(dst).st_mode), 0o664)
+
+    def test_other_file_system_gets_a_copy(self):
+        dst = self.published()[0]
+        storeDevice = store.device_of(self.store.path)
+        with mock.patch.object(store, 'device_of',
+                               lambda path: storeDevice if path == self.store.path else -1):
+            self.store.place(self.package, dst)
+        self.assertEqual(os.stat(dst).st_nlink, 1)
+        self.assertFalse(os.path.exists(self.store.path))
+        self.assertEqual(open(dst, 'rb').read(), open(self.package, 'rb').read())
+
+    def test_prune(self):
+        for dst in self.published():
+            self.store.place(self.package, dst)
+        self.assertEqual(self.store.prune(), 0)
+        for dst in self.published():
+            os.remove(dst)
+        self.assertEqual(self.store.prune(), os.path.getsize(self.package))
+
+    def test_link_tree(self):
+        aptDir = os.path.join(self.tmp, 'apt')
+        self.store.place(self.package, self.published()[1])
+        open(os.path.join(aptDir, 'Release'), 'wt').write('Suite: unstable\n')
+        mirrorDir = os.path.join(self.tmp, 'events', 'apt')
+        os.makedirs(mirrorDir)
+        open(os.path.join(mirrorDir, 'obsolete.deb'), 'wt').write('old')
+        store.link_tree(aptDir, mirrorDir)
+        self.assertTrue(os.path.samefile(os.path.join(mirrorDir, 'binary-amd64',
+                                                      'doomsday_2.3_amd64.deb'),
+                                         self.published()[1]))
+        self.assertTrue(os.path.exists(os.path.join(mirrorDir, 'Release')))
+        self.assertFalse(os.path.exists(os.path.join(mirrorDir, 'obsolete.deb')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+# Batch copies of build outputs (builder/transfer.py) to local directories
+# and, with stand-ins for ssh and scp, to a "remote" host.
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from builder import transfer
+from builder.config import Context
+
+# Copies "host:path" targets to the local path, logging each run.
+FAKE_SCP = '''#!/bin/sh
+for last; do :; done
+echo "$@" >> "%s"
+while [ $# -gt 1 ]; do
+    case "$1" in -o) shift 2;; -*) shift;; *) break;; esac
+done
+cp "$1" "${last#*:}"
+'''
+FAKE_SSH = '#!/bin/sh\necho "$@" >> "%s"\nexit %i\n'
+
+
+class TransferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='test-transfer-')
+        self.ctx = Context(distribDir=self.tmp, cacheDir=os.path.join(self.tmp, 'cache'))
+        self.src = os.path.join(self.tmp, 'src')
+        os.makedirs(self.src)
+        self.files = {}
+        for name, size in [('doomsday_2.3_amd64.deb', 2 << 20), ('buildlog.txt', 100)]:
+            path = os.path.join(self.src, name)
+            open(path, 'wb').write(os.urandom(size))
+            self.files[name] = path
+        self.sleep = mock.patch.object(transfer.time, 'sleep', lambda s: None)
+        self.sleep.start()
+
+    def tearDown(self):
+        self.sleep.stop()
+        shutil.rmtree(self.tmp, True)
+
+    def read(self, path):
+        return open(path, 'rb').read()
+
+    def test_split_target(self):
+        self.assertEqual(transfer.split_target('user@host:/a/b'), ('user@host', '/a/b'))
+        self.assertEqual(transfer.split_target('/a/b:c'), (None, '/a/b:c'))
+        self.assertEqual(transfer.split_target('C:\\a\\b'), (None, 'C:/a/b'))
+
+    def test_local_copies(self):
+        dst = os.path.join(self.tmp, 'events', 'build5767')
+        t = transfer.Transfer(ctx=self.ctx)
+        for name, path in self.files.items():
+            t.add(path, os.path.join(dst, name))
+        results = t.run()
+        self.assertTrue(all(r['ok'] and r['attempts'] == 1 for r in results))
+        for name, path in self.files.items():
+            self.assertEqual(self.read(os.path.join(dst, name)), self.read(path))
+        self.assertEqual(sorted(os.listdir(dst)), sorted(self.files))
+
+    def test_missing_source_fails(self):
+        t = transfer.Transfer(ctx=self.ctx)
+        t.add(os.path.join(self.src, 'missing.deb'), os.path.join(self.tmp, 'out', 'x.deb'))
+        t.add(self.files['buildlog.txt'], os.path.join(self.tmp, 'out', 'log.txt'))
+        with self.assertRaises(Exception):
+            t.run()
+        self.assertEqual([r['ok'] for r in t.results], [False, True])
+
+    def test_failed_copy_is_retried(self):
+        failures = []
+        realCopy = transfer.Transfer.copy_local
+
+        def flaky(self, src, dst):
+            if not failures:
+                failures.append(dst)
+                raise OSError('disk hiccup')
+            realCopy(self, src, dst)
+
+        with mock.patch.object(transfer.Transfer, 'copy_local', flaky):
+            t = transfer.Transfer(ctx=self.ctx)
+            dst = os.path.join(self.tmp, 'out', 'log.txt')
+            t.add(self.files['buildlog.txt'], dst)
+            result = t.run()[0]
+        self.assertTrue(result['ok'])
+        self.assertEqual(result['attempts'], 2)
+        self.assertTrue(os.path.exists(dst))
+
+    def copy_remotely(self, sshExit):
+        """Copies the files to "localhost" with fake ssh and scp commands.
+        Returns the commands that were run."""
+        binDir = os.path.join(self.tmp, 'bin')
+        os.makedirs(binDir)
+        log = os.path.join(self.tmp, 'commands.txt')
+        for name, script in [('scp', FAKE_SCP % log), ('ssh', FAKE_SSH % (log, sshExit))]:
+            open(os.path.join(binDir, name), 'wt').write(script)
+            os.chmod(os.path.join(binDir, name), 0o755)
+        dst = os.path.join(self.tmp, 'remote')
+        os.makedirs(dst)
+        env = dict(os.environ, PATH=binDir + os.pathsep + os.environ['PATH'])
+        # Without rsync, scp is used.
+        with mock.patch.dict(os.environ, env), \
+             mock.patch.object(transfer.shutil, 'which', lambda name: None):
+            t = transfer.Transfer(ctx=self.ctx)
+            for name, path in self.files.items():
+                t.add(path, 'builder@localhost:' + os.path.join(dst, name))
+            t.run()
+        for name, path in self.files.items():
+            self.assertEqual(self.read(os.path.join(dst, name)), self.read(path))
+        return open(log, 'rt').read().splitlines()
+
+    @unittest.skipIf(sys.platform == 'win32', 'needs sh')
+    def test_remote_copies_share_connection(self):
+        commands = self.copy_remotely(0)
+        # The master connection, one scp per file, and closing the master.
+        self.assertEqual(len(commands), 4)
+        self.assertIn('ControlMaster=yes', commands[0])
+        self.assertTrue(all('ControlMaster=no' in c for c in commands[1:3]))
+        self.assertIn('-O exit', commands[3])
+
+    @unittest.skipIf(sys.platform == 'win32', 'needs sh')
+    def test_remote_copies_without_master(self):
+        commands = self.copy_remotely(255)
+        self.assertEqual(len(commands), 3)
+        self.assertFalse(any('ControlPath' in c for c in commands[1:]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+# Task worktrees (builder/worktree.py) of a temporary repository, in
+# particular the persistent worktree that the builds of a branch share.
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from builder import worktree
+from builder.config import Context
+
+GIT_ENV = dict(os.environ, GIT_AUTHOR_NAME='Test', GIT_AUTHOR_EMAIL='test@example.com',
+               GIT_COMMITTER_NAME='Test', GIT_COMMITTER_EMAIL='test@example.com')
+
+
+def git(args, cwd):
+    return subprocess.check_output(['git'] + args, cwd=cwd, env=GIT_ENV,
+                                   stderr=subprocess.STDOUT).decode('utf-8').strip()
+
+
+class WorktreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='test-worktree-')
+        self.repo = os.path.join(self.tmp, 'doomsday')
+        os.makedirs(self.repo)
+        git(['init', '-q', '-b', 'master'], self.repo)
+        self.tag('build100', {'unchanged.c': 'int a;', 'changed.c': 'int b;'})
+        self.tag('build101', {'changed.c': 'int c;'})
+        self.ctx = Context(distribDir=self.tmp, doomsdayDir=self.repo,
+                           worktreeDir=os.path.join(self.tmp, 'worktrees'))
+
+    def tearDown(self):
+        subprocess.call(['git', 'worktree', 'prune'], cwd=self.repo)
+        shutil.rmtree(self.tmp, True)
+
+    def tag(self, name, files):
+        for fn in files:
+            open(os.path.join(self.repo, fn), 'wt').write(files[fn])
+        git(['add', '.'], self.repo)
+        git(['commit', '-q', '-m', name], self.repo)
+        git(['tag', name], self.repo)
+
+    def build(self, tag, persistent=True):
+        """Runs a task at `tag`. Returns the source directory and the
+        modification times of the files, as seen during the task."""
+        with worktree.task_source(tag, 'build', persistent=persistent,
+                                  ctx=self.ctx) as (srcDir, taskDir):
+            open(os.path.join(taskDir, 'buildlog.txt'), 'wt').write(tag)
+            open(os.path.join(srcDir, 'generated.h'), 'wt').write(tag)
+            times = dict((fn, os.stat(os.path.join(srcDir, fn)).st_mtime_ns)
+                         for fn in ['unchanged.c', 'changed.c'])
+            return srcDir, times
+
+    def test_persistent_worktree_is_switched_in_place(self):
+        firstDir, first = self.build('build100')
+        time.sleep(0.05)
+        secondDir, second = self.build('build101')
+        self.assertEqual(firstDir, secondDir)
+        self.assertEqual(second['unchanged.c'], first['unchanged.c'])
+        self.assertNotEqual(second['changed.c'], first['changed.c'])
+        self.assertEqual(open(os.path.join(secondDir, 'changed.c')).read(), 'int c;')
+        # Outputs of the earlier run are gone.
+        self.assertFalse(os.path.exists(os.path.join(secondDir, '..', 'buildlog.txt')))
+        self.assertEqual(sorted(os.listdir(os.path.dirname(secondDir))), ['src'])
+
+    def test_generated_files_are_removed_by_next_run(self):
+        srcDir, times = self.build('build100')
+        self.assertTrue(os.path.exists(os.path.join(srcDir, 'generated.h')))
+        with worktree.task_source('build101', 'build', persistent=True,
+                                  ctx=self.ctx) as (srcDir, taskDir):
+            self.assertFalse(os.path.exists(os.path.join(srcDir, 'generated.h')))
+
+    def test_broken_worktree_is_recreated(self):
+        srcDir, times = self.build('build100')
+        # As if a discarded job had been stopped during a checkout.
+        open(os.path.join(self.repo, '.git', 'worktrees', 'src', 'index.lock'), 'wt').close()
+        srcDir, times = self.build('build101')
+        self.assertEqual(open(os.path.join(srcDir, 'changed.c')).read(), 'int c;')
+
+    def test_prepared_worktree_is_used(self):
+        commit = git(['rev-parse', 'build101'], self.repo)
+        srcDir, taskDir = worktree.prepare_task_source('build101', 'build', commit,
+                                                       persistent=True, ctx=self.ctx)
+        before = os.stat(os.path.join(srcDir, 'changed.c')).st_mtime_ns
+        time.sleep(0.05)
+        sameDir, times = self.build('build101')
+        self.assertEqual(sameDir, srcDir)
+        self.assertEqual(times['changed.c'], before)
+
+    def test_task_worktree_is_removed(self):
+        srcDir, times = self.build('build100', persistent=False)
+        self.assertIn('build100-build', srcDir)
+        self.assertFalse(os.path.exists(os.path.dirname(srcDir)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -76,7 +76,7 @@ def amethyst(input, ame_opts=[]):
 version = '%i.%i' % (build_version.DOOMSDAY_VERSION_MAJOR,
                      build_version.DOOMSDAY_VERSION_MINOR)
 prefix = 'guide:%s' % version
-src_root = os.path.join(builder.config.DOOMSDAY_DIR, 'doomsday/doc')
+src_root = os.path.join(builder.config.context().doomsdayDir, 'doomsday/doc')
 
 pages = [
     ('%s:readme_windows' % prefix, ['-dWIN32'], 'readme/readme.ame'),